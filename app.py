@@ -4,11 +4,20 @@ from io import BytesIO
 import os
 import json # Оставляем, так как может использоваться в get_diff_for_instruction или format_instruction_for_display
 import html
+import functools
 # import textwrap # По-прежнему не вижу его использования, можно удалить, если уверены
 
 try:
-    from core.llm_handler import build_graph, GraphState # Убедитесь, что llm_handler содержит build_graph
-    from core.docx_modifier import extract_text_from_doc, modify_document_with_structured_instructions
+    from core.state import GraphState # build_graph (langgraph, langchain, клиент LLM) импортируется при первом запросе
+    from core.docx_modifier import extract_text_from_doc, apply_instruction_plan
+    from core.batch_planner import plan_instructions, STATUS_APPLY
+    from core.doc_cache import ParsedDocumentCache
+    from core.docx_save import save_document_incremental
+    from core.blob_store import get_blob_store
+    from core.edit_history import EditHistory
+    from core.preview_engine import PreviewIndex
+    from core.async_runtime import iterate_async
+    from core import telemetry
     # find_paragraphs_with_text не используется напрямую в этом app.py, убрал для чистоты, если не нужен
 except ImportError as e:
     st.error(f"Критическая ошибка импорта: {e}. Убедитесь, что все файлы 'core' на месте и имена корректны.")
@@ -25,17 +34,27 @@ st.set_page_config(
 )
 
 # --- Инициализация и кэширование графа ---
+# Граф собирается при первом запросе, а не при первой отрисовке: импорт langgraph, langchain и SDK
+# модели занимает заметное время, а пустой странице (загрузка документа) он не нужен
 @st.cache_resource
 def get_graph_instance(): # Переименовал для ясности
     try:
+        from core.llm_handler import build_graph
         graph = build_graph() # build_graph из вашего llm_handler.py (или llm_graph_builder.py)
         return graph
     except Exception as e:
         st.error(f"Не удалось инициализировать LangGraph: {e}")
         return None
 
-if 'app_graph' not in st.session_state:
-    st.session_state.app_graph = get_graph_instance()
+# Метрики Prometheus и трассировки последних запросов на локальном порту (METRICS_PORT); запускается один раз на процесс
+telemetry.start_metrics_server()
+
+def set_current_doc_version(version):
+    """Делает версию документа текущей для сессии: ссылка в хранилище переносится со старой версии на новую."""
+    store = get_blob_store()
+    store.acquire(version)
+    store.release(st.session_state.get("current_doc_version"))
+    st.session_state.current_doc_version = version
 
 # NEW_FEATURE_START: Функция загрузки примера
 def load_example_document():
@@ -49,25 +68,21 @@ def load_example_document():
 # NEW_FEATURE_END
 
 def init_session_state(clear_all=False, load_example_on_first_ever_run=False): # Изменил имя параметра
-    graph_instance = st.session_state.get('app_graph')
-
     if clear_all:
-        keys_to_preserve = {'app_graph'} # Сохраняем только граф
-        preserved_values = {k: st.session_state[k] for k in keys_to_preserve if k in st.session_state}
-        
-        for key in list(st.session_state.keys()): # Очищаем все ключи
+        get_blob_store().release(st.session_state.get("current_doc_version")) # Версия больше не нужна этой сессии
+        for key in list(st.session_state.keys()): # Очищаем все ключи (граф общий для процесса и в сессии не хранится)
             del st.session_state[key]
-        
-        for k, v in preserved_values.items(): # Восстанавливаем сохраненные (граф)
-            st.session_state[k] = v
 
     defaults = {
-        "chat_messages": [], "current_doc_bytes": None, "original_file_name": None,
+        "chat_messages": [], "original_file_name": None,
+        "current_doc_version": None, # В сессии хранится только хэш версии, байты лежат в BlobStore
         "doc_loaded_flag": False, # Общий флаг, что какой-либо документ (пользовательский или пример) загружен
         "is_example_active": False, # Флаг, что активен именно пример
         "processing": False, "show_confirmation": False, 
         "proposed_instructions": None, "awaiting_clarification": False,
-        "user_made_first_query_on_current_doc": False # Флаг для инструкции "Как пользоваться" для текущего документа
+        "user_made_first_query_on_current_doc": False, # Флаг для инструкции "Как пользоваться" для текущего документа
+        "doc_cache": ParsedDocumentCache(), # Разобранные версии документа этой сессии (ключ - хэш версии)
+        "edit_history": EditHistory() # Дельты примененных правок для отмены/повтора
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -77,7 +92,7 @@ def init_session_state(clear_all=False, load_example_on_first_ever_run=False): #
     if load_example_on_first_ever_run and not st.session_state.doc_loaded_flag:
         example_bytes, example_name = load_example_document()
         if example_bytes:
-            st.session_state.current_doc_bytes = example_bytes
+            set_current_doc_version(get_blob_store().put(example_bytes))
             st.session_state.original_file_name = example_name
             st.session_state.doc_loaded_flag = True
             st.session_state.is_example_active = True
@@ -108,134 +123,134 @@ if not any(key in st.session_state for key in ["chat_messages", "doc_loaded_flag
 # handle_user_prompt, handle_user_confirmation ОСТАЮТСЯ ЗДЕСЬ БЕЗ ИЗМЕНЕНИЙ
 # Я их скопирую из вашего предоставленного кода.
 
-def get_diff_for_instruction(instruction: dict, doc: Document) -> dict:
+# Сколько найденных мест показывается в предпросмотре одной правки
+MAX_PREVIEW_OCCURRENCES = 20
+# Сколько предпросмотров инструкций хранится в сессии
+MAX_CACHED_DIFFS = 200
+CONTAINER_LABELS = {"table": "таблица", "header": "верхний колонтитул", "footer": "нижний колонтитул"}
+
+def get_cached_diff(instruction: dict, preview_index: PreviewIndex) -> dict:
+    """
+    get_diff_for_instruction с запоминанием по (версия документа, инструкция): предпросмотр,
+    построенный во время потоковой генерации, повторно используется на экране подтверждения.
+    """
+    key = (st.session_state.current_doc_version, json.dumps(instruction, sort_keys=True, ensure_ascii=False))
+    diffs = st.session_state.setdefault("instruction_diffs", {})
+    if key not in diffs:
+        if len(diffs) >= MAX_CACHED_DIFFS:
+            diffs.clear()
+        diffs[key] = get_diff_for_instruction(instruction, preview_index)
+    return diffs[key]
+
+def show_streamed_instructions(placeholder, instructions: list[dict]):
+    """Краткий предпросмотр инструкций, уже полученных из потока ответа LLM (пока генерация продолжается)."""
+    try:
+        preview_index = st.session_state.doc_cache.get_preview(st.session_state.current_doc_version)
+    except Exception: # без индекса показываем только типы операций
+        preview_index = None
+    lines = [f"Получено правок: {len(instructions)}"]
+    for i, instruction in enumerate(instructions):
+        if preview_index:
+            description = get_cached_diff(instruction, preview_index)["notes"]
+        else:
+            description = f"Операция: `{instruction.get('operation_type')}`."
+        lines.append(f"{i + 1}. {description}")
+    placeholder.markdown("\n".join(lines))
+
+def get_diff_for_instruction(instruction: dict, preview_index: PreviewIndex) -> dict:
     """
-    ФИНАЛЬНАЯ ВЕРСИЯ: Готовит "было/стало" с HTML-выделением изменений и тусклым контекстом из слов.
+    Готовит "было/стало" с HTML-выделением изменений и тусклым контекстом для всех мест,
+    где сработает правка (включая таблицы и колонтитулы). Поиск идет по индексу версии документа.
     """
     result = {'before': 'Ошибка', 'after': 'Ошибка', 'notes': 'Не удалось обработать правку.', 'found': False}
     
-    if not doc:
-        result['notes'] = 'Объект документа не был передан.'
+    if not preview_index:
+        result['notes'] = 'Индекс документа для предпросмотра не был передан.'
         return result
 
     try:
         op_type = instruction.get("operation_type")
-        target = instruction.get("target_description", {})
         params = instruction.get("parameters", {})
-        
-        search_text = target.get("text_to_find")
-        if not search_text:
-            if op_type == "REPLACE_TEXT":
-                search_text = params.get("old_text")
-            elif op_type == "APPLY_FORMATTING":
-                search_text = params.get("apply_to_text_segment")
-        
+        preview = preview_index.preview_instruction(instruction)
+        search_text = preview["search_text"]
+
         if not search_text:
             result['notes'] = 'LLM не предоставила достаточно данных для поиска.'
             return result
-
-        # --- НАЧАЛО ВАШЕЙ ЛОГИКИ get_diff_for_instruction ---
-        full_text_str = "\n".join([p.text for p in doc.paragraphs]) # Упрощенно, лучше через extract_text_from_doc
-        all_words = full_text_str.split()
-        search_words = search_text.split()
-        target_word_start_index = -1
-        for i in range(len(all_words) - len(search_words) + 1):
-            if all_words[i:i+len(search_words)] == search_words:
-                target_word_start_index = i
-                break
-
-        if target_word_start_index == -1:
-            result['notes'] = f'Текст «{html.escape(search_text)}» не был найден для предпросмотра.'
+        if not preview["found"]:
+            result['notes'] = f'Текст «{search_text}» не был найден для предпросмотра.'
             return result
-        
-        target_word_end_index = target_word_start_index + len(search_words)
-        context_words_count = 10 # Уменьшил для краткости в UI
-        start_idx = max(0, target_word_start_index - context_words_count)
-        end_idx = min(len(all_words), target_word_end_index + context_words_count)
-        
-        words_before_context = all_words[start_idx:target_word_start_index]
-        words_of_target = all_words[target_word_start_index:target_word_end_index]
-        words_after_context = all_words[target_word_end_index:end_idx]
-        
+
         style_context = "opacity: 0.6;"
         style_highlight_before = "background-color: #FFD2D2; color: #A62020; padding: 1px 3px; border-radius: 3px; font-weight: bold;"
         style_highlight_after = "background-color: #D2FFD2; color: #206620; padding: 1px 3px; border-radius: 3px; font-weight: bold;"
         style_highlight_format = "background-color: #D0E0FF; color: #103050; padding: 1px 3px; border-radius: 3px; font-style: italic;" # Добавил курсив для наглядности
-        
-        escaped_context_before = html.escape(" ".join(words_before_context))
-        escaped_target = html.escape(" ".join(words_of_target))
-        escaped_context_after = html.escape(" ".join(words_after_context))
-
-        result['before'] = (
-            f"<span style='{style_context}'>...{escaped_context_before}</span> "
-            f"<span style='{style_highlight_before}'>{escaped_target}</span> "
-            f"<span style='{style_context}'>{escaped_context_after}...</span>"
-        )
-        
-        notes = f"Операция: `{op_type}`. "
-        after_html = result['before'] # По умолчанию, если операция не меняет текст напрямую
+        style_deleted = "text-decoration: line-through; color: #FFAAAA; background-color: #502020;"
+        position = params.get("position", "after_paragraph")
+        escaped_new = html.escape(preview["new_text"] or "")
+
+        before_lines, after_lines = [], []
+        occurrences = preview["occurrences"]
+        for occ in occurrences[:MAX_PREVIEW_OCCURRENCES]:
+            label = CONTAINER_LABELS.get(occ.container)
+            prefix = f"<span style='{style_context}'>[{label}]</span> " if label else ""
+            context_before = f"{prefix}<span style='{style_context}'>...{html.escape(occ.context_before)}</span>"
+            context_after = f"<span style='{style_context}'>{html.escape(occ.context_after)}...</span>"
+            escaped_target = html.escape(occ.target)
+
+            before_lines.append(f"{context_before}<span style='{style_highlight_before}'>{escaped_target}</span>{context_after}")
+            if op_type == "REPLACE_TEXT":
+                changed = f"<span style='{style_highlight_after}'>{escaped_new}</span>"
+            elif op_type == "INSERT_TEXT" and "before" in position:
+                changed = f"<span style='{style_highlight_after}'>{escaped_new}</span> {escaped_target}"
+            elif op_type == "INSERT_TEXT" and position == "start_of_paragraph":
+                changed = f"<span style='{style_highlight_after}'>{escaped_new}</span> {escaped_target}"
+            elif op_type == "INSERT_TEXT":
+                changed = f"{escaped_target} <span style='{style_highlight_after}'>{escaped_new}</span>"
+            elif op_type == "DELETE_ELEMENT":
+                changed = f"<span style='{style_deleted}'> (удаленный элемент) </span>"
+            elif op_type in ("APPLY_TEXT_FORMATTING", "APPLY_PARAGRAPH_FORMATTING", "APPLY_FORMATTING"):
+                changed = f"<span style='{style_highlight_format}'>{escaped_target}</span>"
+            elif op_type == "TABLE_MODIFY_CELL" and preview["new_text"] is not None:
+                changed = f"<span style='{style_highlight_after}'>{escaped_new}</span>"
+            else:
+                changed = escaped_target
+            after_lines.append(f"{context_before}{changed}{context_after}")
 
+        hidden = len(occurrences) - len(before_lines)
+        if hidden > 0:
+            more = f"<br><span style='{style_context}'>... и еще {hidden} мест(а)</span>"
+            before_lines[-1] += more
+            after_lines[-1] += more
+
+        notes = f"Операция: `{op_type}`. Найдено мест: {len(occurrences)}. "
         if op_type == "REPLACE_TEXT":
-            old, new = params.get("old_text", search_text), params.get("new_text", "")
-            escaped_new = html.escape(new)
-            # Заменяем только целевую часть, оставляя контекст как был "до"
-            after_html = (
-                f"<span style='{style_context}'>...{escaped_context_before}</span> "
-                f"<span style='{style_highlight_after}'>{escaped_new}</span> " # Показываем новый текст вместо старого
-                f"<span style='{style_context}'>{escaped_context_after}...</span>"
-            )
-            notes += f"Замена «{html.escape(old)}» на «{html.escape(new)}»."
+            notes += f"Замена «{search_text}» на «{preview['new_text']}»."
         elif op_type == "INSERT_TEXT":
-            to_insert = params.get("text_to_insert", "")
-            position = params.get("position", "after_paragraph") # Уточнить позицию для отображения
-            escaped_insert = html.escape(to_insert)
-            if "after" in position: # Упрощенное отображение для вставки
-                after_html = (
-                    f"<span style='{style_context}'>...{escaped_context_before}</span> "
-                    f"{escaped_target} <span style='{style_highlight_after}'>{escaped_insert}</span> "
-                    f"<span style='{style_context}'>{escaped_context_after}...</span>"
-                )
-            elif "before" in position:
-                 after_html = (
-                    f"<span style='{style_context}'>...{escaped_context_before}</span> "
-                    f"<span style='{style_highlight_after}'>{escaped_insert}</span> {escaped_target} "
-                    f"<span style='{style_context}'>{escaped_context_after}...</span>"
-                )
-            else: # start_of_paragraph, end_of_paragraph - сложнее точно показать в этом diff
-                after_html = f"{result['before']} <span style='{style_highlight_after}'>(вставлено: {escaped_insert})</span>"
-
-            notes += f"Вставка текста: «{escaped_insert}» ({position})."
+            notes += f"Вставка текста: «{preview['new_text']}» ({position})."
         elif op_type == "DELETE_ELEMENT":
-            after_html = (
-                 f"<span style='{style_context}'>...{escaped_context_before}</span> "
-                 f"<span style='text-decoration: line-through; color: #FFAAAA; background-color: #502020;'> (удаленный элемент) </span> "
-                 f"<span style='{style_context}'>{escaped_context_after}...</span>"
-            )
-            notes += f"Удаление элемента, содержащего «{escaped_target}»."
-        elif op_type == "APPLY_FORMATTING":
-            # Для форматирования, "стало" будет выглядеть так же, но с примененным стилем
-            # Мы не можем показать это в HTML без реального применения и сравнения XML или сложного рендеринга.
-            # Поэтому просто опишем действие.
-            rules_str_list = []
-            for r_item in params.get("formatting_rules", []): # Переименовал переменную цикла
-                rules_str_list.append(f"`{r_item.get('style')}`: `{r_item.get('value')}`")
-            applied_formatting_desc = ", ".join(rules_str_list)
-            
-            after_html = ( # Показываем целевой текст с подсветкой форматирования
-                f"<span style='{style_context}'>...{escaped_context_before}</span> "
-                f"<span style='{style_highlight_format}'>{escaped_target}</span> " # Целевой текст выделен
-                f"<span style='{style_context}'>{escaped_context_after}...</span>"
-            )
-            notes += f"Будет применено форматирование к «{escaped_target}»: {applied_formatting_desc}."
-        
-        result['after'] = after_html
+            notes += f"Удаление абзаца «{search_text}»."
+        elif op_type in ("APPLY_TEXT_FORMATTING", "APPLY_PARAGRAPH_FORMATTING", "APPLY_FORMATTING"):
+            # Форматирование нельзя показать в HTML без реального применения, поэтому просто опишем действие
+            rules = ", ".join(f"`{r.get('style')}`: `{r.get('value')}`" for r in params.get("formatting_rules", []))
+            notes += f"Будет применено форматирование к «{search_text}»: {rules}."
+
+        result['before'] = "<br>".join(before_lines)
+        result['after'] = "<br>".join(after_lines)
         result['notes'] = notes
         result['found'] = True
-        # --- КОНЕЦ ВАШЕЙ ЛОГИКИ get_diff_for_instruction ---
     except Exception as e:
         result['notes'] = f"Ошибка при генерации предпросмотра: {e}"
     return result
 
+# Пояснения к инструкциям, которые план выполнения пропустит
+PLAN_STATUS_LABELS = {
+    "duplicate": "повтор другой правки, будет пропущена",
+    "noop": "ничего не меняет, будет пропущена",
+    "unresolved": "цель не найдена, будет пропущена",
+    "superseded": "затрагивает только удаляемый текст, будет пропущена",
+}
+
 def show_confirmation_ui(instructions: list[dict]):
     if "selected_instructions" not in st.session_state:
         st.session_state.selected_instructions = {i: True for i in range(len(instructions))}
@@ -245,13 +260,30 @@ def show_confirmation_ui(instructions: list[dict]):
     st.markdown("---")
     
     doc_object_for_diff = None # Инициализируем
-    if st.session_state.current_doc_bytes:
+    preview_index = None
+    if st.session_state.current_doc_version:
         try:
-            doc_object_for_diff = Document(BytesIO(st.session_state.current_doc_bytes))
+            # Документ и его индекс предпросмотра из кэша только читаются, поэтому перезапуски
+            # из-за галочек не разбирают документ и не строят индекс заново
+            doc_object_for_diff = st.session_state.doc_cache.get(st.session_state.current_doc_version)
+            preview_index = st.session_state.doc_cache.get_preview(st.session_state.current_doc_version)
         except Exception as e:
             st.warning(f"Не удалось загрузить документ для предпросмотра diff: {e}")
             doc_object_for_diff = None # Убедимся, что None, если ошибка
 
+    plan_preview = None
+    if doc_object_for_diff and preview_index:
+        try:
+            # План только читает документ: показываем, какие правки будут пропущены или конфликтуют
+            # и кэшируем его: перезапуски из-за галочек не меняют ни версию, ни список правок
+            plan_key = (st.session_state.current_doc_version, json.dumps(instructions, sort_keys=True, ensure_ascii=False))
+            if st.session_state.get("plan_preview_key") != plan_key:
+                st.session_state.plan_preview = plan_instructions(doc_object_for_diff, instructions, index=preview_index.index).preview()
+                st.session_state.plan_preview_key = plan_key
+            plan_preview = st.session_state.plan_preview
+        except Exception as e:
+            st.warning(f"Не удалось построить план выполнения: {e}")
+
     container_style = "padding: 0.5rem; border: 1px solid #4A4A4A; border-radius: 0.3rem; margin-bottom: 0.5rem; background-color: #262730; color: #FAFAFA;"
     notes_style = "font-size: 0.9em; color: #A0A0A0;"
 
@@ -267,8 +299,8 @@ def show_confirmation_ui(instructions: list[dict]):
             with cols_header[1]:
                 st.markdown(f"##### Правка {i+1}: `{op_type}`")
 
-            if doc_object_for_diff: # Только если документ успешно загружен для diff
-                diff = get_diff_for_instruction(instruction, doc_object_for_diff)
+            if preview_index: # Только если документ успешно загружен для diff
+                diff = get_cached_diff(instruction, preview_index)
                 
                 if diff['found']:
                     st.markdown("**Было (контекст):**")
@@ -282,10 +314,17 @@ def show_confirmation_ui(instructions: list[dict]):
 
                 if diff['notes']:
                     st.markdown(f"<div style='{notes_style}'>ℹ️ {html.escape(diff['notes'])}</div>", unsafe_allow_html=True)
-            else: # Если doc_object_for_diff is None
+            else: # Если документ не загружен
                 st.markdown(f"**Описание действия:** {format_instruction_for_display(instruction)}")
                 st.caption("Предпросмотр изменений недоступен, так как не удалось обработать текущий документ.")
 
+            if plan_preview:
+                planned = plan_preview[i]
+                if planned["status"] != STATUS_APPLY:
+                    st.caption(f"⚠️ План: {PLAN_STATUS_LABELS.get(planned['status'], planned['status'])}. {' '.join(planned['notes'])}")
+                elif planned["notes"]:
+                    st.caption(f"ℹ️ План: {' '.join(planned['notes'])}")
+
         st.markdown("<br>", unsafe_allow_html=True) 
 
     st.markdown("---")
@@ -299,31 +338,51 @@ def handle_user_prompt(user_input: str):
     st.session_state.processing = True
     st.session_state.chat_messages.append({"role": "user", "content": user_input})
     try:
-        if not st.session_state.current_doc_bytes:
+        if not st.session_state.current_doc_version:
             st.error("Документ не загружен. Пожалуйста, загрузите документ перед отправкой запроса.")
             st.session_state.chat_messages.append({"role": "assistant", "content": "Ошибка: Документ не загружен."})
             st.session_state.processing = False # Сбрасываем флаг
             st.rerun() # Перерисовываем, чтобы показать ошибку
             return # Выходим из функции
 
-        doc_content = extract_text_from_doc(Document(BytesIO(st.session_state.current_doc_bytes)))
-        initial_state = GraphState(
-            original_user_query=user_input, current_user_query=user_input,
-            document_content_text=doc_content, document_bytes=st.session_state.current_doc_bytes,
-            extracted_instructions=None, clarification_question=None, system_message=None, next_node_to_call=None
-        )
-        with st.spinner("🤖 Агент анализирует ваш запрос..."):
-            if not st.session_state.app_graph: # Дополнительная проверка
-                st.error("Критическая ошибка: Граф обработки не инициализирован.")
-                st.session_state.chat_messages.append({"role": "assistant", "content": "Ошибка конфигурации агента. Попробуйте перезагрузить страницу."})
-                st.session_state.processing = False
-                st.rerun()
-                return
-
-            final_state = st.session_state.app_graph.invoke(initial_state, {"recursion_limit": 15})
+        # Трассировка запроса: время узлов графа, вызовы LLM и токены (показывается на боковой панели)
+        with telemetry.trace_request("query", query=user_input) as trace:
+            doc_content = st.session_state.doc_cache.get_text(st.session_state.current_doc_version)
+            initial_state = GraphState(
+                original_user_query=user_input, current_user_query=user_input,
+                document_content_text=doc_content, document_version=st.session_state.current_doc_version,
+                extracted_instructions=None, clarification_question=None, system_message=None, next_node_to_call=None
+            )
+            with st.spinner("🤖 Агент анализирует ваш запрос..."):
+                app_graph = get_graph_instance() # При первом запросе в процессе граф собирается здесь
+                if not app_graph: # Дополнительная проверка
+                    st.error("Критическая ошибка: Граф обработки не инициализирован.")
+                    st.session_state.chat_messages.append({"role": "assistant", "content": "Ошибка конфигурации агента. Попробуйте перезагрузить страницу."})
+                    st.session_state.processing = False
+                    st.rerun()
+                    return
+
+                # Граф выполняется в общем цикле событий: вызовы LLM всех сессий идут через один клиент
+                # с общим ограничением параллельности. Инструкции приходят по мере генерации ответа
+                # и сразу показываются с предпросмотром, не дожидаясь конца извлечения
+                final_state = None
+                streamed = []
+                live_preview = st.empty()
+                events = app_graph.astream(initial_state, {"recursion_limit": 15}, stream_mode=["custom", "values"])
+                for mode, chunk in iterate_async(events):
+                    if mode == "values":
+                        final_state = chunk
+                    elif isinstance(chunk, dict) and "instruction" in chunk:
+                        streamed.append(chunk["instruction"])
+                        show_streamed_instructions(live_preview, streamed)
+                live_preview.empty()
+
+        st.session_state.last_trace = trace.to_dict()
 
         st.session_state.awaiting_clarification = bool(final_state.get("clarification_question"))
         if final_state.get("extracted_instructions"):
+            if final_state.get("system_message"): # часть составного запроса не обработана
+                st.session_state.chat_messages.append({"role": "assistant", "content": final_state["system_message"]})
             st.session_state.proposed_instructions = final_state["extracted_instructions"]
             st.session_state.show_confirmation = True
         elif final_state.get("clarification_question"):
@@ -339,6 +398,26 @@ def handle_user_prompt(user_input: str):
         st.session_state.processing = False
         st.rerun()
 
+def handle_history_step(undo: bool):
+    """Отменяет или повторяет шаг истории правок и делает результат текущей версией документа."""
+    store = get_blob_store()
+    source_version = st.session_state.current_doc_version
+    history = st.session_state.edit_history
+    try:
+        doc = st.session_state.doc_cache.checkout(source_version) # Забираем из кэша: объект будет изменен
+        step = history.undo(doc) if undo else history.redo(doc)
+        if step is None:
+            return
+        new_version = store.put(save_document_incremental(doc, store.path(source_version)))
+        set_current_doc_version(new_version)
+        st.session_state.doc_cache.put(new_version, doc)
+        action = "Отменено" if undo else "Повторено"
+        st.session_state.chat_messages.append({"role": "assistant", "content": f"{action}: {step['description']}."})
+    except Exception as e:
+        st.error(f"Не удалось {'отменить' if undo else 'повторить'} правку: {e}")
+        history.clear() # История больше не соответствует документу
+    st.rerun()
+
 def handle_user_confirmation(approved: bool):
     if not approved:
         st.session_state.chat_messages.append({"role": "assistant", "content": "Предложенные действия были отклонены."})
@@ -361,17 +440,27 @@ def handle_user_confirmation(approved: bool):
             st.session_state.processing = True
             st.session_state.chat_messages.append({"role": "assistant", "content": f"Применяю {len(instructions_to_apply)} подтвержденных изменений..."})
             try:
-                if not st.session_state.current_doc_bytes: # Проверка
+                if not st.session_state.current_doc_version: # Проверка
                     st.error("Документ не загружен. Невозможно применить изменения.")
                     st.session_state.chat_messages.append({"role": "assistant", "content": "Ошибка: Документ для применения правок не найден."})
                     return # Выходим из функции
 
-                doc = Document(BytesIO(st.session_state.current_doc_bytes))
-                success = modify_document_with_structured_instructions(doc, instructions_to_apply)
+                store = get_blob_store()
+                source_version = st.session_state.current_doc_version
+                with telemetry.trace_request("apply", instructions=len(instructions_to_apply)) as trace:
+                    doc = st.session_state.doc_cache.checkout(source_version) # Забираем из кэша: объект будет изменен
+                    with telemetry.span("plan"):
+                        plan = plan_instructions(doc, instructions_to_apply)
+                    success = apply_instruction_plan(doc, plan, history=st.session_state.edit_history)
+                    # Переписываются только измененные части пакета, остальные копируются из файла исходной версии
+                    new_source = save_document_incremental(doc, store.path(source_version)) if success else None
+                st.session_state.last_trace = trace.to_dict()
+                if plan.dropped:
+                    st.session_state.chat_messages.append({"role": "assistant", "content": f"Пропущено правок без эффекта, повторов и ненайденных целей: {len(plan.dropped)}."})
                 if success:
-                    bio = BytesIO()
-                    doc.save(bio)
-                    st.session_state.current_doc_bytes = bio.getvalue()
+                    new_version = store.put(new_source)
+                    set_current_doc_version(new_version)
+                    st.session_state.doc_cache.put(new_version, doc) # Новая версия уже разобрана
                     st.session_state.chat_messages.append({"role": "assistant", "content": "Изменения успешно применены."})
                 else:
                     st.session_state.chat_messages.append({"role": "assistant", "content": "Не удалось применить некоторые или все изменения (возможно, текст не найден или произошла ошибка в обработчике)."})
@@ -394,6 +483,19 @@ def handle_user_confirmation(approved: bool):
         st.rerun()
 
 
+def show_trace(trace: dict):
+    """Время последнего запроса по узлам графа, обработчикам и этапам, вызовы LLM и токены."""
+    summary = trace["summary"]
+    with st.expander(f"⏱ Последний запрос: {summary['ms']} мс", expanded=False):
+        st.caption(f"Вызовов LLM: {summary.get('llm_calls', 0)}, символов в промптах: {summary.get('prompt_chars', 0)}, "
+                   f"токенов: {summary.get('prompt_tokens', 0)} + {summary.get('completion_tokens', 0)}, "
+                   f"абзацев просмотрено/изменено: {summary.get('paragraphs_scanned', 0)}/{summary.get('paragraphs_modified', 0)}")
+        columns = ["kind", "name", "parent", "offset_ms", "ms", "outcome", "prompt_chars", "prompt_tokens",
+                   "completion_tokens", "paragraphs_scanned", "paragraphs_modified"]
+        st.dataframe([{column: span.get(column) for column in columns} for span in trace["spans"]],
+                     hide_index=True, use_container_width=True)
+
+
 def format_instruction_for_display(instruction: dict) -> str:
     op_type = instruction.get("operation_type", "Неизвестная операция")
     params = instruction.get("parameters", {})
@@ -459,7 +561,7 @@ with st.sidebar:
     if uploaded_file_widget and \
        (uploaded_file_widget.name != st.session_state.original_file_name or not st.session_state.doc_loaded_flag): # Если загружен новый файл или до этого ничего не было
         init_session_state(clear_all=True) # Сбрасываем все, включая флаги примера
-        st.session_state.current_doc_bytes = uploaded_file_widget.getvalue()
+        set_current_doc_version(get_blob_store().put(uploaded_file_widget.getvalue()))
         st.session_state.original_file_name = uploaded_file_widget.name
         st.session_state.doc_loaded_flag = True
         st.session_state.is_example_active = False # Явно указываем, что это не пример
@@ -483,15 +585,29 @@ with st.sidebar:
             st.rerun()
         # NEW_FEATURE_END
         
-        if st.session_state.current_doc_bytes:
+        undo_col, redo_col = st.columns(2)
+        if undo_col.button("↩️ Отменить", use_container_width=True, key="undo_sidebar_btn",
+                           disabled=st.session_state.processing or not st.session_state.edit_history.can_undo):
+            handle_history_step(undo=True)
+        if redo_col.button("↪️ Повторить", use_container_width=True, key="redo_sidebar_btn",
+                           disabled=st.session_state.processing or not st.session_state.edit_history.can_redo):
+            handle_history_step(undo=False)
+
+        if st.session_state.current_doc_version:
             download_file_name = f"{'example_modified' if st.session_state.is_example_active else 'modified'}_{st.session_state.original_file_name or 'document.docx'}"
-            st.download_button("⬇️ Скачать текущий документ", st.session_state.current_doc_bytes,
+            store = get_blob_store()
+            store.touch(st.session_state.current_doc_version) # Продлевает ссылку сессии на версию (см. BlobStore)
+            # Байты читаются только по нажатию, а не при каждой отрисовке
+            st.download_button("⬇️ Скачать текущий документ", functools.partial(store.read_bytes, st.session_state.current_doc_version),
                 download_file_name, "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                 use_container_width=True, disabled=st.session_state.processing, key="final_download_main_btn"
             )
     else: 
         st.caption("Загрузите свой .docx или попробуйте с примером.")
 
+    if st.session_state.get("last_trace"):
+        show_trace(st.session_state.last_trace)
+
     st.divider()
     st.caption("**Proof of Concept (v0.1)**") # Используем st.caption для заголовка
     st.caption("""
@@ -504,8 +620,6 @@ with st.sidebar:
 
 if not st.session_state.doc_loaded_flag: # Если никакой документ не загружен
     st.info("👈 Пожалуйста, загрузите .docx документ или **попробуйте с примером** на панели слева, чтобы начать.")
-elif not st.session_state.app_graph:
-    st.error("Ошибка инициализации агента (LangGraph). Функционал недоступен.")
 else:
     # NEW_FEATURE_START: Условие для инструкции "Как пользоваться"
     # Показываем, если загружен НЕ пример И пользователь еще не делал запросов к ЭТОМУ документу
@@ -0,0 +1,208 @@
+# batch_apply.py
+"""
+Пакетное применение готовых инструкций к множеству документов без LLM и без Streamlit.
+
+Запуск из корня проекта:
+    python batch_apply.py instructions.json docs/ --output out/ [--jobs 8]
+    python batch_apply.py instructions.json "contracts/**/*.docx" --output out/
+
+Файл инструкций - JSON-список инструкций в формате modify_document_with_structured_instructions
+(или объект с ключом "instructions", как в ответе LLM). Документы обрабатываются пулом процессов,
+по умолчанию по одному на доступное ядро. Каждый измененный документ записывается в --output с
+сохранением относительного пути, а по каждому файлу в report.jsonl добавляется строка: успех,
+результат каждой инструкции (успех и число замен) и время загрузки, применения и сохранения.
+
+Подряд идущие REPLACE_TEXT выполняются одним проходом по документу. От применения по одной
+(--no-batch-replace) это отличается только для пересекающихся old_text (выбирается самое левое,
+затем самое длинное совпадение, а не первая инструкция) и для текста, который образует замена
+вместе с соседним текстом абзаца (он повторно не ищется); цепочки A->B, B->C выполняются по очереди.
+
+Строки отчета пишутся по мере готовности файлов, поэтому прерванный запуск можно продолжить той же
+командой: файлы, уже записанные в отчет без ошибки, пропускаются (--no-resume - начать заново).
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from docx import Document
+from loguru import logger
+
+from core.async_runtime import available_cpus
+from core.docx_modifier import modify_document_with_structured_instructions
+from core.docx_save import save_document_incremental
+
+REPORT_NAME = "report.jsonl"
+DOCX_SUFFIX = ".docx"
+
+
+def load_instructions(path: str) -> List[dict]:
+    """Читает список инструкций: JSON-массив или объект с ключом "instructions"."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("instructions")
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        raise ValueError(f"{path}: ожидается список инструкций или объект с ключом 'instructions'")
+    return data
+
+
+def collect_documents(source: str) -> Tuple[str, List[str]]:
+    """
+    Документы для обработки: все .docx в каталоге (рекурсивно) или файлы по glob-шаблону.
+    Возвращает корень, относительно которого строятся пути в каталоге результатов, и отсортированный
+    список путей. Временные файлы Word (~$*.docx) пропускаются.
+    """
+    if os.path.isdir(source):
+        root = source
+        paths = glob.glob(os.path.join(glob.escape(source), "**", "*" + DOCX_SUFFIX), recursive=True)
+    else:
+        paths = [path for path in glob.glob(source, recursive=True) if os.path.isfile(path)]
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths]) if paths else "."
+    paths = sorted(os.path.abspath(p) for p in paths if not os.path.basename(p).startswith("~$"))
+    return os.path.abspath(root), paths
+
+
+def read_report(report_path: str) -> Dict[str, dict]:
+    """Последняя запись отчета по каждому исходному файлу. Оборванная последняя строка пропускается."""
+    records = {}
+    if not os.path.exists(report_path):
+        return records
+    with open(report_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record.get("source")] = record
+    return records
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Запись через временный файл: после прерывания в каталоге не остается недописанных .docx."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def apply_file(source: str, output: str, instructions: List[dict], batch_replace: bool = True) -> dict:
+    """
+    Применяет инструкции к одному файлу и записывает результат в output.
+    Возвращает запись отчета; исключение не выбрасывается, а попадает в поле "error".
+    """
+    record = {"source": source, "output": None, "success": False, "instructions": [], "hits": 0,
+              "timings_ms": {}, "error": None}
+    timings = record["timings_ms"]
+    started = time.perf_counter()
+    try:
+        doc = Document(source)
+        loaded = time.perf_counter()
+        timings["load"] = round((loaded - started) * 1000, 2)
+
+        report = []
+        success = modify_document_with_structured_instructions(doc, instructions, batch_replace=batch_replace, report=report)
+        applied = time.perf_counter()
+        timings["apply"] = round((applied - loaded) * 1000, 2)
+        record["instructions"] = report
+        record["hits"] = sum(item["hits"] for item in report)
+        record["success"] = success
+
+        # Документ без изменений не сохраняется: копировать исходный файл незачем
+        if success:
+            _write_atomic(output, save_document_incremental(doc, source))
+            record["output"] = output
+            timings["save"] = round((time.perf_counter() - applied) * 1000, 2)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    timings["total"] = round((time.perf_counter() - started) * 1000, 2)
+    return record
+
+
+# Инструкции передаются каждому процессу пула один раз, при его запуске, а не с каждой задачей
+_worker_instructions: List[dict] = []
+_worker_batch_replace = True
+
+
+def _init_worker(instructions: List[dict], batch_replace: bool, log_level: str) -> None:
+    global _worker_instructions, _worker_batch_replace
+    _worker_instructions = instructions
+    _worker_batch_replace = batch_replace
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+
+
+def _apply_task(task: Tuple[str, str]) -> dict:
+    source, output = task
+    return apply_file(source, output, _worker_instructions, _worker_batch_replace)
+
+
+def run_batch(instructions: List[dict], root: str, sources: List[str], output_dir: str,
+              jobs: Optional[int] = None, resume: bool = True, batch_replace: bool = True,
+              log_level: str = "ERROR") -> Iterable[dict]:
+    """
+    Применяет инструкции ко всем sources пулом из jobs процессов, записывает результаты в output_dir
+    и по мере готовности добавляет записи в output_dir/report.jsonl. Записи отдаются вызывающему.
+    При resume файлы, уже обработанные без ошибки по отчету, пропускаются.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    report_path = os.path.join(output_dir, REPORT_NAME)
+    done = {source for source, record in read_report(report_path).items() if not record.get("error")} if resume else set()
+    tasks = [(source, os.path.join(os.path.abspath(output_dir), os.path.relpath(source, root)))
+             for source in sources if source not in done]
+    logger.info(f"batch_apply: к обработке {len(tasks)} из {len(sources)} документов, пропущено по отчету: {len(sources) - len(tasks)}")
+    if not tasks:
+        return
+
+    jobs = max(1, min(jobs or available_cpus(), len(tasks)))
+    with open(report_path, "a" if resume else "w", encoding="utf-8") as report_file, \
+            multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(instructions, batch_replace, log_level)) as pool:
+        # Документы сильно различаются по размеру, поэтому задачи раздаются по одной
+        for record in pool.imap_unordered(_apply_task, tasks, chunksize=1):
+            report_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            report_file.flush()
+            yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("instructions", help="JSON-файл с инструкциями")
+    parser.add_argument("documents", help="Каталог с .docx или glob-шаблон (в кавычках)")
+    parser.add_argument("--output", "-o", required=True, help="Каталог для измененных документов и report.jsonl")
+    parser.add_argument("--jobs", "-j", type=int, help="Число процессов (по умолчанию - доступные ядра)")
+    parser.add_argument("--no-resume", action="store_true", help="Обработать все файлы заново и перезаписать отчет")
+    parser.add_argument("--no-batch-replace", action="store_true", help="Выполнять REPLACE_TEXT по одной инструкции, в порядке списка (см. выше)")
+    parser.add_argument("--log-level", default="ERROR", help="Уровень логов обработчиков в процессах пула")
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    instructions = load_instructions(args.instructions)
+    root, sources = collect_documents(args.documents)
+    if not sources:
+        print(f"Документы не найдены: {args.documents}")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    counts = {"success": 0, "unchanged": 0, "error": 0}
+    for record in run_batch(instructions, root, sources, args.output, jobs=args.jobs, resume=not args.no_resume,
+                            batch_replace=not args.no_batch_replace, log_level=args.log_level):
+        status = "error" if record["error"] else "success" if record["success"] else "unchanged"
+        counts[status] += 1
+        print(f"[{status}] {os.path.relpath(record['source'], root)} ({record['timings_ms']['total']:.0f} мс)"
+              + (f": {record['error']}" if record["error"] else ""))
+    processed = sum(counts.values())
+    print(f"Обработано {processed} из {len(sources)} за {time.perf_counter() - started:.1f} с: "
+          f"изменено {counts['success']}, без изменений {counts['unchanged']}, ошибок {counts['error']}. "
+          f"Отчет: {os.path.join(args.output, REPORT_NAME)}")
+    if counts["error"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# benchmarks/bench_extract_text.py
+"""
+Сравнение скорости extract_text_from_doc (обход XML) с прежней реализацией
+на обертках python-docx.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_extract_text [--sizes 1000 10000 100000] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger
+
+from benchmarks.docgen import DocSpec, generate_document
+from core.docx_utils import extract_text_from_doc
+
+
+def legacy_extract_text_from_doc(doc_object) -> str:
+    """Прежняя реализация: обертки Paragraph/Table/_Row/_Cell и row.cells для каждой строки."""
+    full_text_parts = []
+    for p in doc_object.paragraphs:
+        full_text_parts.append(p.text)
+    for table in doc_object.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for p_in_cell in cell.paragraphs:
+                    full_text_parts.append(p_in_cell.text)
+    for section in doc_object.sections:
+        for p_in_header in section.header.paragraphs:
+            full_text_parts.append(p_in_header.text)
+        for table_in_header in section.header.tables:
+            for row in table_in_header.rows:
+                for cell in row.cells:
+                    for p_in_cell in cell.paragraphs:
+                        full_text_parts.append(p_in_cell.text)
+        for p_in_footer in section.footer.paragraphs:
+            full_text_parts.append(p_in_footer.text)
+        for table_in_footer in section.footer.tables:
+            for row in table_in_footer.rows:
+                for cell in row.cells:
+                    for p_in_cell in cell.paragraphs:
+                        full_text_parts.append(p_in_cell.text)
+    return "\n".join(full_text_parts)
+
+
+def build_document(paragraph_count: int, table_every: int = 100):
+    """Документ с paragraph_count абзацами (по 3 run'а) и таблицей 5x4 с объединенными ячейками через каждые table_every абзацев."""
+    return generate_document(DocSpec(paragraphs=paragraph_count, table_every=table_every))
+
+
+def _best_time(func, doc, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(doc)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logger.remove()
+
+    print(f"{'абзацев':>10} | {'python-docx, с':>15} | {'lxml, с':>10} | {'ускорение':>9}")
+    for size in args.sizes:
+        doc = build_document(size)
+        legacy = _best_time(legacy_extract_text_from_doc, doc, args.repeat)
+        fast = _best_time(extract_text_from_doc, doc, args.repeat)
+        print(f"{size:>10} | {legacy:>15.4f} | {fast:>10.4f} | {legacy / fast:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# benchmarks/bench_suite.py
+"""
+Бенчмарк обработчиков правок: время и пиковая память каждого обработчика из OPERATION_HANDLERS,
+extract_text_from_doc и цикла загрузка/сохранение Document на синтетических документах
+(benchmarks/docgen.py) разного размера. Результаты пишутся в JSON; при заданном --baseline
+сравниваются с ним, регрессии печатаются, а код возврата становится 1.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_suite [--sizes 10 100 1000 10000 100000] [--repeat 3]
+        [--output bench_results.json] [--baseline benchmarks/baseline.json] [--threshold 0.25]
+        [--cases REPLACE_TEXT extract_text ...] [--runs-per-paragraph 3] [--sections 1] ...
+
+Каждый замер выполняется на свежем документе, загруженном из байтов (загрузка не входит в замер).
+Время - лучший и медианный из --repeat прогонов; память измеряется отдельным прогоном в новом
+процессе: пик Python-объектов (tracemalloc) и прирост RSS, включающий деревья lxml (только Linux).
+"""
+import argparse
+import gc
+from io import BytesIO
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import docx
+from docx import Document
+from loguru import logger
+
+from benchmarks.docgen import DocSpec, FIELD_COUNT, generate_docx_bytes, paragraph_text
+from core.docx_modifier import OPERATION_HANDLERS
+from core.docx_utils import extract_text_from_doc
+
+DEFAULT_SIZES = [10, 100, 1_000, 10_000, 100_000]
+# Разница меньше этого не считается регрессией: на малых документах это шум измерения
+MIN_SECONDS_DELTA = 0.002
+MIN_BYTES_DELTA = 256 * 1024
+RSS_SAMPLE_INTERVAL = 0.002
+MEMORY_TIMEOUT_SECONDS = 600
+
+
+def _instruction_cases(spec: DocSpec) -> Dict[str, Tuple[dict, dict]]:
+    """(target_description, parameters) для каждого обработчика; цель - абзац из середины документа."""
+    middle = spec.paragraphs // 2
+    middle_text = paragraph_text(middle, spec.runs_per_paragraph)
+    middle_label = f"Пункт {middle}."
+    field = "{{FIELD_%d}}" % (middle % FIELD_COUNT)
+    return {
+        "REPLACE_TEXT": ({"text_to_find": None}, {"old_text": field, "new_text": "42"}),
+        "INSERT_TEXT": ({"text_to_find": middle_text}, {"text_to_insert": "Новый пункт.", "position": "after_paragraph"}),
+        "APPLY_TEXT_FORMATTING": ({"text_to_find": middle_label},
+                                  {"apply_to_text_segment": middle_label,
+                                   "formatting_rules": [{"style": "bold", "value": True}]}),
+        "DELETE_ELEMENT": ({"element_type": "paragraph", "text_to_find": middle_text}, {}),
+        "APPLY_PARAGRAPH_FORMATTING": ({"text_to_find": middle_label},
+                                       {"formatting_rules": [{"style": "alignment", "value": "center"}]}),
+        "TABLE_MODIFY_CELL": ({"table_index": 0, "table_coords": {"row": spec.table_rows - 1, "col": spec.table_cols - 1}}, {"new_cell_text": "Изменено"}),
+        "TABLE_ADD_ROW": ({"table_index": 0},
+                          {"row_data": [f"Новая {c}" for c in range(spec.table_cols)]}),
+    }
+
+
+def build_cases(spec: DocSpec) -> Dict[str, Callable[[bytes], Tuple[Callable[[], object], Callable[[object], bool]]]]:
+    """
+    Замеры по имени. Каждый получает байты документа и возвращает (замеряемая функция, проверка
+    результата): подготовка (загрузка документа) выполняется до замера.
+    """
+    cases = {}
+
+    def handler_case(handler, target, params):
+        def prepare(data: bytes):
+            doc = Document(BytesIO(data))
+            return (lambda: handler(doc, dict(target), dict(params), index=None)), (lambda result: bool(result))
+        return prepare
+
+    for op_type, (target, params) in _instruction_cases(spec).items():
+        if op_type.startswith("TABLE_") and not spec.table_every:
+            continue
+        cases[op_type] = handler_case(OPERATION_HANDLERS[op_type], target, params)
+
+    def extract_text(data: bytes):
+        doc = Document(BytesIO(data))
+        return (lambda: extract_text_from_doc(doc)), (lambda text: bool(text))
+    cases["extract_text"] = extract_text
+
+    def load_save(data: bytes):
+        def round_trip():
+            buffer = BytesIO()
+            Document(BytesIO(data)).save(buffer)
+            return buffer.getvalue()
+        return round_trip, (lambda result: len(result) > 0)
+    cases["load_save"] = load_save
+    # Все обработчики должны быть покрыты: новый тип операции без замера - ошибка бенчмарка
+    missing = set(OPERATION_HANDLERS) - set(cases)
+    if missing and spec.table_every:
+        raise KeyError(f"Нет замера для обработчиков: {sorted(missing)}")
+    return cases
+
+
+def _current_rss() -> Optional[int]:
+    """Текущий RSS процесса в байтах (Linux, /proc); None, если недоступен."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RSSSampler:
+    """Фоновый опрос RSS во время замера: пиковый прирост относительно начала."""
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = _current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = _current_rss()
+        if rss is not None and self.peak is not None:
+            self.peak = max(self.peak, rss)
+
+    def __enter__(self):
+        if self.start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._sample()
+
+    @property
+    def delta(self) -> Optional[int]:
+        return None if self.start is None else self.peak - self.start
+
+
+def _measure_memory(name: str, spec_fields: dict, data: bytes, results) -> None:
+    """Пиковая память одного замера; выполняется в отдельном процессе (см. measure)."""
+    logger.remove()
+    func, _ = build_cases(DocSpec(**spec_fields))[name](data)
+    gc.collect()
+    tracemalloc.start()
+    with RSSSampler() as sampler:
+        func()
+    _, peak_python = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.put({"peak_python_bytes": peak_python, "peak_rss_delta_bytes": sampler.delta})
+
+
+def measure(name: str, spec: DocSpec, data: bytes, repeat: int) -> dict:
+    """
+    Время - в текущем процессе на свежем документе для каждого прогона. Память - в новом процессе:
+    в текущем освобожденная предыдущими прогонами память переиспользуется, и прирост RSS занижен.
+    """
+    prepare = build_cases(spec)[name]
+    timings = []
+    ok = True
+    for _ in range(repeat):
+        func, check = prepare(data)
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+        ok = ok and check(result)
+        del func, result
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_measure_memory, args=(name, spec.as_dict(), data, results))
+    process.start()
+    try:
+        memory = results.get(timeout=MEMORY_TIMEOUT_SECONDS)
+    except queue.Empty:
+        memory = {"peak_python_bytes": None, "peak_rss_delta_bytes": None}
+    process.join()
+    return {"best_seconds": min(timings), "median_seconds": statistics.median(timings), **memory, "ok": ok}
+
+
+def _megabytes(value: Optional[int]) -> str:
+    return "-" if value is None else f"{value / 2**20:.1f}"
+
+
+def run_suite(sizes: List[int], repeat: int, base_spec: DocSpec, only: Optional[List[str]] = None) -> dict:
+    results = []
+    for size in sizes:
+        spec = DocSpec(**{**base_spec.as_dict(), "paragraphs": size})
+        data = generate_docx_bytes(spec)
+        # Больших документов - меньше повторов: один прогон на 100k абзацев длится секунды
+        size_repeat = max(1, repeat if size <= 10_000 else repeat // 2)
+        for name in build_cases(spec):
+            if only and name not in only:
+                continue
+            measured = measure(name, spec, data, size_repeat)
+            results.append({"case": name, "paragraphs": size, "docx_bytes": len(data), **measured})
+            print(f"{name:>27} | {size:>7} | {measured['best_seconds']:>9.4f} с | "
+                  f"{measured['best_seconds'] / size * 1e6:>8.2f} мкс/абз | "
+                  f"{_megabytes(measured['peak_python_bytes']):>7} МБ py | "
+                  f"{_megabytes(measured['peak_rss_delta_bytes']):>7} МБ rss"
+                  f"{'' if measured['ok'] else ' | НЕ ВЫПОЛНЕНО'}", flush=True)
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "python_docx": getattr(docx, "__version__", None),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "spec": base_spec.as_dict(),
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """Регрессии относительно базовых результатов: рост времени или памяти больше чем на threshold."""
+    known = {(r["case"], r["paragraphs"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in current["results"]:
+        base = known.get((result["case"], result["paragraphs"]))
+        if base is None:
+            continue
+        label = f"{result['case']} @ {result['paragraphs']}"
+        for metric, min_delta in (("best_seconds", MIN_SECONDS_DELTA), ("peak_python_bytes", MIN_BYTES_DELTA),
+                                  ("peak_rss_delta_bytes", MIN_BYTES_DELTA)):
+            old, new = base.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if new - old > min_delta and new > old * (1 + threshold):
+                ratio = new / old if old else float("inf")
+                regressions.append(f"{label}: {metric} {old:.4g} -> {new:.4g} (x{ratio:.2f})")
+        if base.get("ok") and not result["ok"]:
+            regressions.append(f"{label}: операция больше не выполняется")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="+", help="Только эти замеры (имена операций, extract_text, load_save)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="JSON с базовыми результатами для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Допустимый относительный рост (0.25 = 25%%)")
+    defaults = DocSpec()
+    parser.add_argument("--runs-per-paragraph", type=int, default=defaults.runs_per_paragraph)
+    parser.add_argument("--table-every", type=int, default=defaults.table_every)
+    parser.add_argument("--table-rows", type=int, default=defaults.table_rows)
+    parser.add_argument("--table-cols", type=int, default=defaults.table_cols)
+    parser.add_argument("--no-merged-cells", action="store_true")
+    parser.add_argument("--sections", type=int, default=defaults.sections)
+    parser.add_argument("--no-header-footer", action="store_true")
+    args = parser.parse_args()
+    logger.remove()
+
+    spec = DocSpec(runs_per_paragraph=args.runs_per_paragraph, table_every=args.table_every,
+                   table_rows=args.table_rows, table_cols=args.table_cols, merged_cells=not args.no_merged_cells,
+                   sections=args.sections, header_footer=not args.no_header_footer)
+    current = run_suite(args.sizes, args.repeat, spec, args.cases)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"Регрессии относительно {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"Регрессий относительно {args.baseline} нет.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# benchmarks/docgen.py
+"""
+Генератор синтетических .docx для бенчмарков: число абзацев, run'ов в абзаце, размер и частота
+таблиц, объединенные ячейки, число разделов со своими колонтитулами.
+
+Абзацы и таблицы клонируются из прототипов на уровне XML и вставляются перед известным
+элементом (w:sectPr или абзацем-разрывом раздела): doc.add_paragraph ищет w:sectPr среди всех
+детей w:body, и на 100k абзацев построение через него квадратично.
+"""
+from copy import deepcopy
+from dataclasses import dataclass, asdict
+from io import BytesIO
+from typing import List
+
+from docx import Document
+from docx.oxml.ns import qn
+
+# Сколько разных полей {{FIELD_n}} встречается в тексте абзацев
+FIELD_COUNT = 50
+
+
+@dataclass(frozen=True)
+class DocSpec:
+    paragraphs: int = 1_000
+    runs_per_paragraph: int = 3
+    table_every: int = 100      # таблица после каждых table_every абзацев, минимум одна (0 - без таблиц)
+    table_rows: int = 5
+    table_cols: int = 4
+    merged_cells: bool = True   # объединение ячеек по горизонтали и по вертикали в каждой таблице
+    sections: int = 1           # абзацы делятся между разделами поровну
+    header_footer: bool = True  # у каждого раздела свои верхний и нижний колонтитулы
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def paragraph_runs(i: int, runs_per_paragraph: int) -> List[str]:
+    """Тексты run'ов i-го абзаца: номер пункта, условия и поле {{FIELD_n}} в последнем run'е."""
+    texts = [f"Пункт {i}. "] + [f"условие {j} " for j in range(1, runs_per_paragraph - 1)]
+    texts.append(f"значении {{{{FIELD_{i % FIELD_COUNT}}}}}.")
+    return texts if runs_per_paragraph > 1 else ["".join(texts)]
+
+
+def paragraph_text(i: int, runs_per_paragraph: int) -> str:
+    return "".join(paragraph_runs(i, runs_per_paragraph))
+
+
+def _set_texts(element, texts: List[str]) -> None:
+    for t_el, text in zip(element.iter(qn("w:t")), texts):
+        t_el.text = text
+
+
+def _table_prototype(doc: Document, spec: DocSpec):
+    table = doc.add_table(rows=spec.table_rows, cols=spec.table_cols)
+    table.style = doc.styles["Table Grid"]
+    for r, row in enumerate(table.rows):
+        for c, cell in enumerate(row.cells):
+            cell.text = f"r{r}c{c}"
+    if spec.merged_cells and spec.table_cols > 1:
+        table.cell(0, 0).merge(table.cell(0, 1))
+    if spec.merged_cells and spec.table_rows > 2:
+        table.cell(1, spec.table_cols - 1).merge(table.cell(2, spec.table_cols - 1))
+    tbl = table._tbl
+    tbl.getparent().remove(tbl)
+    return tbl
+
+
+def generate_document(spec: DocSpec) -> Document:
+    doc = Document()
+    for _ in range(spec.sections - 1):
+        doc.add_section()
+    for s, section in enumerate(doc.sections):
+        if spec.header_footer:
+            section.header.is_linked_to_previous = False
+            section.footer.is_linked_to_previous = False
+            section.header.paragraphs[0].text = f"Колонтитул раздела {s} {{{{DATE}}}}"
+            section.footer.paragraphs[0].text = f"Нижний колонтитул раздела {s}"
+
+    proto_p = doc.add_paragraph()
+    for j, text in enumerate(paragraph_runs(0, spec.runs_per_paragraph)):
+        proto_p.add_run(text).bold = j % 2 == 1
+    proto_p = proto_p._p
+    proto_p.getparent().remove(proto_p)
+    proto_tbl = _table_prototype(doc, spec) if spec.table_every else None
+
+    # Содержимое раздела вставляется перед его концом: абзацем с w:sectPr (разрыв раздела)
+    # или последним w:sectPr тела документа
+    body = doc.element.body
+    anchors = [p for p in body.iterchildren(qn("w:p")) if p.find(qn("w:pPr") + "/" + qn("w:sectPr")) is not None]
+    anchors.append(body[-1])
+    per_section = -(-spec.paragraphs // len(anchors))
+    tables = 0
+    for i in range(spec.paragraphs):
+        anchor = anchors[min(i // per_section, len(anchors) - 1)] if per_section else anchors[-1]
+        p_el = deepcopy(proto_p)
+        _set_texts(p_el, paragraph_runs(i, spec.runs_per_paragraph))
+        anchor.addprevious(p_el)
+        # Таблица после каждых table_every абзацев, а в документе короче table_every - после последнего
+        if proto_tbl is not None and (i % spec.table_every == spec.table_every - 1 or (tables == 0 and i == spec.paragraphs - 1)):
+            tbl = deepcopy(proto_tbl)
+            _set_texts(tbl, [f"Таблица {tables}"])
+            anchor.addprevious(tbl)
+            tables += 1
+    return doc
+
+
+def generate_docx_bytes(spec: DocSpec) -> bytes:
+    buffer = BytesIO()
+    generate_document(spec).save(buffer)
+    return buffer.getvalue()
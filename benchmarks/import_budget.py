@@ -0,0 +1,116 @@
+# benchmarks/import_budget.py
+"""
+Отчет о времени импорта: import core и первая отрисовка пустого приложения (app.py через
+streamlit.testing AppTest, без запросов к LLM) не должны импортировать langgraph, langchain и SDK
+Gemini, а суммарное время импортов (python -X importtime) не должно превышать порогов.
+Сам бюджет проверяет tests/test_import_budget.py; скрипт печатает замеры и самые дорогие импорты
+(при нарушении завершается с кодом 1).
+
+Запуск из корня проекта:
+    python -m benchmarks.import_budget [--core-ms 50] [--app-ms 600] [--repeat 3]
+
+Каждый замер выполняется в новом процессе; берется лучший из --repeat. Импорты самого streamlit
+и AppTest в замер приложения не входят - только то, что импортирует app.py.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули, которые нужны только для обработки запроса и должны импортироваться при первом запросе
+HEAVY_MODULES = ("langgraph", "langchain", "langchain_core", "langchain_google_genai", "google.ai.generativelanguage", "grpc")
+# Пороги суммарного времени импортов, мс
+CORE_BUDGET_MS = 50
+APP_BUDGET_MS = 600
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+_MARKER = "import-budget: start"
+
+# Тяжелые модули, импортированные после метки: HEAVY_MODULES и их подмодули
+_HEAVY_EXPR = f"sorted(m for m in set(sys.modules) - before if any(m == h or m.startswith(h + '.') for h in {HEAVY_MODULES!r}))"
+
+CORE_PROBE = f"""
+import json, sys
+before = set(sys.modules)
+sys.stderr.write({_MARKER!r} + "\\n")
+import core
+print(json.dumps({_HEAVY_EXPR}))
+"""
+
+APP_PROBE = f"""
+import json, sys
+from streamlit.testing.v1 import AppTest
+before = set(sys.modules)
+sys.stderr.write({_MARKER!r} + "\\n")
+at = AppTest.from_file("app.py", default_timeout=120).run()
+errors = [str(e.value) for e in at.exception] + [str(e.value) for e in at.error]
+print(json.dumps({_HEAVY_EXPR}))
+print(json.dumps(errors, ensure_ascii=False))
+"""
+
+
+def run_probe(code: str) -> Tuple[float, List[Tuple[float, str]], List[str], list]:
+    """
+    Выполняет код в новом процессе с -X importtime. Возвращает суммарное время импортов после
+    метки (мс), импорты верхнего уровня по убыванию времени, импортированные тяжелые модули и
+    дополнительные строки вывода пробы.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, METRICS_PORT="0", PYTHONWARNINGS="ignore",
+               DOC_BLOB_DIR=os.path.join(tempfile.gettempdir(), "import_budget_blobs"))
+    env.pop("LLM_BACKEND", None)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=300)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Проба завершилась с кодом {proc.returncode}:\n{proc.stderr[-3000:]}")
+    lines = proc.stderr.splitlines()
+    top_level: List[Tuple[float, str]] = []
+    for line in lines[lines.index(_MARKER) + 1:]:
+        match = _IMPORTTIME_RE.match(line)
+        # Импорт верхнего уровня (без отступа) включает время всех вложенных
+        if match and not match.group(3):
+            top_level.append((int(match.group(2)) / 1000, match.group(4)))
+    output = [json.loads(line) for line in proc.stdout.splitlines() if line.startswith("[")]
+    return sum(ms for ms, _ in top_level), sorted(top_level, reverse=True), output[0], output[1:]
+
+
+def check(name: str, code: str, budget_ms: float, repeat: int) -> List[str]:
+    runs = [run_probe(code) for _ in range(repeat)]
+    total_ms, top, heavy, extra = min(runs, key=lambda run: run[0])
+    print(f"{name}: импорты {total_ms:.1f} мс (порог {budget_ms:.0f} мс)")
+    problems = []
+    if total_ms > budget_ms:
+        problems.append(f"{name}: импорты занимают {total_ms:.1f} мс при пороге {budget_ms:.0f} мс")
+    if heavy:
+        problems.append(f"{name}: импортированы модули, нужные только для запросов: {', '.join(heavy[:10])}"
+                        + (f" и еще {len(heavy) - 10}" if len(heavy) > 10 else ""))
+    if extra and extra[0]:
+        problems.append(f"{name}: ошибки при отрисовке: {extra[0]}")
+    if problems:
+        for ms, module in top[:10]:
+            print(f"  {ms:9.1f} мс  {module}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--core-ms", type=float, default=CORE_BUDGET_MS, help="Порог для import core")
+    parser.add_argument("--app-ms", type=float, default=APP_BUDGET_MS, help="Порог для импортов первой отрисовки app.py")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    problems = check("import core", CORE_PROBE, args.core_ms, args.repeat)
+    problems += check("app.py", APP_PROBE, args.app_ms, args.repeat)
+    if problems:
+        print("Превышен бюджет импорта:")
+        for line in problems:
+            print(f"  {line}")
+        sys.exit(1)
+    print("Бюджет импорта соблюден.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 # core/__init__.py
 
-# Делаем функцию build_graph доступной для импорта напрямую из 'core'
-# Например, в app.py можно будет написать: from core import build_graph
-from .llm_handler import build_graph
+# build_graph доступен как from core import build_graph, но модуль графа (langgraph, langchain,
+# клиент LLM) импортируется только при первом обращении: import core и модулей правки документа
+# не тянет эти зависимости
+from .state import GraphState
 
-# Также можно экспортировать состояние, если оно нужно в других частях приложения
-from .state import GraphState
\ No newline at end of file
+
+def __getattr__(name):
+    if name == "build_graph":
+        from .llm_handler import build_graph
+        return build_graph
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
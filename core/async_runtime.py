@@ -0,0 +1,122 @@
+# core/async_runtime.py
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Awaitable, Iterator, Optional
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+
+from loguru import logger
+
+# Сколько вызовов LLM может выполняться одновременно во всем процессе
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def available_cpus() -> int:
+    """Число ядер, доступных процессу (с учетом привязки к ядрам, если она задана)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Общий для процесса цикл событий в фоновом потоке. На нем выполняются все асинхронные
+    вызовы LLM: асинхронный gRPC-клиент привязан к циклу, в котором создан, поэтому один
+    долгоживущий цикл позволяет всем сессиям использовать один клиент и его соединения.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+            _loop = loop
+            logger.debug("async_runtime: запущен общий цикл событий.")
+        return _loop
+
+
+def submit(coro: Awaitable[Any]) -> Future:
+    """
+    Запускает корутину в общем цикле; результат - concurrent.futures.Future.
+    Корутина выполняется в копии контекста вызывающего (contextvars), поэтому трассировка
+    запроса (core.telemetry) продолжается и в общем цикле.
+    """
+    loop = get_event_loop()
+    context = contextvars.copy_context()
+
+    async def in_caller_context():
+        return await loop.create_task(coro, context=context)
+
+    return asyncio.run_coroutine_threadsafe(in_caller_context(), loop)
+
+
+def run_coroutine(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """
+    Выполняет корутину в общем цикле и ждет результата в вызывающем потоке
+    (например, в потоке скрипта Streamlit). Нельзя вызывать из самого общего цикла.
+    """
+    loop = get_event_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_coroutine нельзя вызывать из общего цикла событий: используйте await.")
+    return submit(coro).result(timeout)
+
+
+async def on_shared_loop(coro: Awaitable[Any]) -> Any:
+    """await корутины в общем цикле из любого цикла событий (отмена передается в общий цикл)."""
+    loop = get_event_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(submit(coro))
+
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """Ограничитель одновременных вызовов LLM. Используется только внутри общего цикла."""
+    global _llm_semaphore
+    if asyncio.get_running_loop() is not get_event_loop():
+        raise RuntimeError("Ограничитель вызовов LLM доступен только в общем цикле событий.")
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _llm_semaphore
+
+
+_END = object()
+
+
+def iterate_async(agen: AsyncIterator[Any]) -> Iterator[Any]:
+    """
+    Синхронный итератор по асинхронному генератору, выполняемому в общем цикле: элементы
+    передаются в вызывающий поток по мере появления. Если перебор прерван, генератор отменяется.
+    """
+    results: "queue.Queue" = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in agen:
+                results.put((item, None))
+        except BaseException as e:  # включая отмену: вызывающий поток не должен ждать вечно
+            results.put((_END, e))
+            if not isinstance(e, Exception):
+                raise
+            return
+        results.put((_END, None))
+
+    future = submit(pump())
+    try:
+        while True:
+            item, error = results.get()
+            if item is _END:
+                if error is not None and isinstance(error, Exception):
+                    raise error
+                return
+            yield item
+    finally:
+        future.cancel()
@@ -0,0 +1,495 @@
+# core/batch_planner.py
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import heapq
+import json
+
+from docx import Document
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from loguru import logger
+
+from .docx_index import DocumentIndex, IndexedParagraph, CONTAINER_BODY
+from .docx_utils import get_table_by_description
+
+# Статусы инструкций в плане. Выполняются только STATUS_APPLY, остальные отбрасываются с пояснением
+STATUS_APPLY = "apply"
+STATUS_DUPLICATE = "duplicate"      # повтор другой инструкции (или покрыт ею)
+STATUS_NOOP = "noop"                # ничего не меняет
+STATUS_UNRESOLVED = "unresolved"    # цель не найдена или параметры неполны - обработчик все равно не сработает
+STATUS_SUPERSEDED = "superseded"    # все цели лежат в абзацах, которые удаляет другая инструкция
+
+# Интервал в сквозном тексте индекса: полуинтервал [начало, конец); пустой интервал - точка
+Interval = Tuple[int, int]
+
+_INSERT_POSITIONS = ("after_paragraph", "before_paragraph", "start_of_paragraph", "end_of_paragraph")
+
+
+@dataclass
+class PlannedInstruction:
+    """
+    Инструкция в плане. reads - фрагменты текста, по которым обработчик находит цель
+    (если их изменить раньше, он цель не найдет); writes - фрагменты, текст которых инструкция меняет.
+    """
+    position: int
+    instruction: dict
+    status: str = STATUS_APPLY
+    reads: List[Interval] = field(default_factory=list)
+    writes: List[Interval] = field(default_factory=list)
+    deletes: List[Interval] = field(default_factory=list)
+    search_text: Optional[str] = None    # текст, по которому ищется цель
+    produced_text: Optional[str] = None  # текст, который инструкция добавляет в документ
+    target_missing: bool = False
+    depends_on: List[int] = field(default_factory=list)
+    conflicts_with: List[int] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def operation_type(self) -> Optional[str]:
+        return self.instruction.get("operation_type")
+
+
+class InstructionPlan:
+    """
+    План выполнения пакета инструкций: какие инструкции выполняются и в каком порядке,
+    какие отброшены и почему, какие пары конфликтуют. План строится по документу до правок
+    и выполняется за один проход (см. docx_modifier.apply_instruction_plan).
+    steps - группы позиций исходного списка; группа из нескольких REPLACE_TEXT выполняется одним пакетом.
+    """
+
+    def __init__(self, items: List[PlannedInstruction], order: List[int], steps: List[List[int]],
+                 conflicts: List[Tuple[int, int]]):
+        self.items = items
+        self.order = order
+        self.steps = steps
+        self.conflicts = conflicts
+
+    def instructions(self) -> List[dict]:
+        """Инструкции к выполнению в порядке плана."""
+        return [self.items[pos].instruction for pos in self.order]
+
+    @property
+    def dropped(self) -> List[PlannedInstruction]:
+        return [item for item in self.items if item.status != STATUS_APPLY]
+
+    def preview(self) -> List[dict]:
+        """Описание плана для показа пользователю: по записи на инструкцию в исходном порядке."""
+        step_of = {pos: n for n, pos in enumerate(self.order)}
+        return [{
+            "position": item.position,
+            "operation_type": item.operation_type,
+            "status": item.status,
+            "order": step_of.get(item.position),
+            "targets": len(item.writes) or len(item.reads),
+            "depends_on": list(item.depends_on),
+            "conflicts_with": list(item.conflicts_with),
+            "notes": list(item.notes),
+        } for item in self.items]
+
+
+def _intervals_overlap(a: Interval, b: Interval) -> bool:
+    """Пересечение полуинтервалов; точка пересекается с интервалом, если лежит в нем (включая границы)."""
+    (s1, e1), (s2, e2) = a, b
+    if s1 == e1:
+        return s2 <= s1 <= e2
+    if s2 == e2:
+        return s1 <= s2 <= e1
+    return s1 < e2 and s2 < e1
+
+
+def find_overlapping_pairs(intervals: Iterable[Tuple[int, int, object]]) -> Iterator[Tuple[object, object]]:
+    """
+    Все пары пересекающихся интервалов (начало, конец, владелец) заметающей прямой:
+    интервалы перебираются по началу, активные хранятся в куче по концу.
+    Стоимость O(n log n + k), где k - число пар-кандидатов.
+    """
+    active: list = []  # (конец, номер, начало, владелец)
+    for seq, (start, end, owner) in enumerate(sorted(intervals, key=lambda item: (item[0], item[1]))):
+        while active and active[0][0] < start:
+            heapq.heappop(active)
+        for a_end, _, a_start, a_owner in active:
+            if _intervals_overlap((a_start, a_end), (start, end)):
+                yield a_owner, owner
+        heapq.heappush(active, (end, seq, start, owner))
+
+
+class _Resolver:
+    """Находит цели инструкций по индексу так же, как их находят обработчики."""
+
+    def __init__(self, doc: Document, index: DocumentIndex):
+        self.doc = doc
+        self.index = index
+        self.entries = list(index)  # обход индекса пересчитывает смещения записей
+        self.full_text = index.full_text
+
+    def _entries_of(self, paragraphs: List[Paragraph]) -> List[IndexedParagraph]:
+        entries = (self.index.entry_for(p) for p in paragraphs)
+        return [entry for entry in entries if entry is not None]
+
+    def occurrences(self, needle: str, entries: Optional[List[IndexedParagraph]] = None) -> List[Interval]:
+        """Непересекающиеся вхождения needle внутри абзацев (по всему документу или в entries)."""
+        if not needle:
+            return []
+        found = []
+        if entries is None:
+            # Поиск по сквозному тексту быстрее перебора абзацев; совпадения через границу абзаца отбрасываются
+            pos = self.full_text.find(needle)
+            while pos != -1:
+                entry = self.index.entry_at_offset(pos)
+                if entry is not None and pos + len(needle) <= entry.end:
+                    found.append((pos, pos + len(needle)))
+                    pos = self.full_text.find(needle, pos + len(needle))
+                else:
+                    pos = self.full_text.find(needle, pos + 1)
+            return found
+        for entry in entries:
+            pos = entry.text.find(needle)
+            while pos != -1:
+                found.append((entry.start + pos, entry.start + pos + len(needle)))
+                pos = entry.text.find(needle, pos + len(needle))
+        return found
+
+    @staticmethod
+    def whole(entries: List[IndexedParagraph]) -> List[Interval]:
+        return [(entry.start, entry.end) for entry in entries]
+
+    def table_entries(self, table) -> List[IndexedParagraph]:
+        return self._entries_of([Paragraph(p_el, table) for p_el in table._tbl.iter(qn("w:p"))])
+
+    def resolve(self, item: PlannedInstruction) -> None:
+        target = item.instruction.get("target_description", {}) or {}
+        params = item.instruction.get("parameters", {}) or {}
+        resolver = getattr(self, f"_resolve_{str(item.operation_type).lower()}", None)
+        if resolver is None:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append(f"Неизвестный тип операции '{item.operation_type}'.")
+            return
+        resolver(item, target, params)
+
+    def _resolve_replace_text(self, item, target, params):
+        old_text = params.get("old_text") or target.get("placeholder")
+        new_text = params.get("new_text", "") or ""
+        if not old_text:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append("Не указан old_text.")
+            return
+        if old_text == new_text:
+            item.status = STATUS_NOOP
+            item.notes.append("Текст заменяется на такой же.")
+            return
+        item.search_text, item.produced_text = old_text, new_text
+        context = self._entries_of(self.index.find(target.get("text_to_find"))) if target.get("text_to_find") else []
+        item.writes = self.occurrences(old_text, context or None)
+        # Абзац-контекст ищется по полному совпадению текста: его изменение меняет область замены
+        item.reads = item.writes + self.whole(context)
+        item.target_missing = not item.writes
+
+    def _resolve_insert_text(self, item, target, params):
+        text, position, anchor_text = params.get("text_to_insert"), params.get("position"), target.get("text_to_find")
+        if not all([text, position, anchor_text]) or position not in _INSERT_POSITIONS:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append("Не все параметры вставки указаны или позиция неизвестна.")
+            return
+        item.search_text, item.produced_text = anchor_text, text
+        anchor = self._entries_of(self.index.find(anchor_text, containers=(CONTAINER_BODY,))[:1])
+        item.reads = self.whole(anchor)
+        if position in ("start_of_paragraph", "end_of_paragraph"):
+            item.writes = list(item.reads)
+        item.target_missing = not anchor
+
+    def _resolve_apply_text_formatting(self, item, target, params):
+        segment = params.get("apply_to_text_segment")
+        if not params.get("formatting_rules") or not segment:
+            item.status = STATUS_NOOP
+            item.notes.append("Не указаны правила форматирования или сегмент.")
+            return
+        item.search_text = segment
+        item.reads = self.occurrences(segment, self._entries_of(
+            self.index.find(segment, partial_match=True, containers=(CONTAINER_BODY,))))
+        item.target_missing = not item.reads
+
+    def _resolve_apply_paragraph_formatting(self, item, target, params):
+        context = target.get("text_to_find")
+        if not params.get("formatting_rules") or not context:
+            item.status = STATUS_NOOP
+            item.notes.append("Не указаны правила форматирования или текст абзаца.")
+            return
+        item.search_text = context
+        item.reads = self.occurrences(context, self._entries_of(
+            self.index.find(context, partial_match=True, containers=(CONTAINER_BODY,))))
+        item.target_missing = not item.reads
+
+    def _resolve_delete_element(self, item, target, params):
+        text = target.get("text_to_find")
+        if target.get("element_type") != "paragraph" or not text:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append("Поддерживается только удаление абзацев по тексту.")
+            return
+        item.search_text = text
+        found = self.index.find(text)
+        if not found:
+            found = self.index.find(text, partial_match=True)
+            if len(found) > 1:
+                item.status = STATUS_UNRESOLVED
+                item.notes.append(f"Частичному совпадению соответствует {len(found)} абзацев - удаление неоднозначно.")
+                return
+        item.reads = item.writes = item.deletes = self.whole(self._entries_of(found))
+        item.target_missing = not found
+
+    def _table_lookup_reads(self, table, target) -> List[Interval]:
+        # Таблица по индексу не зависит от текста; по тексту - зависит от ячеек, где он найден
+        if target.get("table_index") is not None or not target.get("text_to_find"):
+            return []
+        return self.occurrences(target["text_to_find"], self.table_entries(table))
+
+    def _resolve_table_modify_cell(self, item, target, params):
+        coords, new_text = target.get("table_coords") or {}, params.get("new_cell_text")
+        if new_text is None or coords.get("row") is None or coords.get("col") is None:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append("Не указаны координаты ячейки или новый текст.")
+            return
+        item.search_text, item.produced_text = target.get("text_to_find"), new_text
+        table = get_table_by_description(self.doc, target)
+        if table is None:
+            item.target_missing = True
+            return
+        try:
+            cell = table.cell(coords["row"], coords["col"])
+        except IndexError:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append(f"Ячейка ({coords['row']},{coords['col']}) вне таблицы.")
+            return
+        if len(cell.paragraphs) == 1 and cell.paragraphs[0].text == new_text:
+            item.status = STATUS_NOOP
+            item.notes.append("Ячейка уже содержит этот текст.")
+            return
+        item.writes = self.whole(self._entries_of(cell.paragraphs))
+        item.reads = item.writes + self._table_lookup_reads(table, target)
+
+    def _resolve_table_add_row(self, item, target, params):
+        row_data = params.get("row_data")
+        if not isinstance(row_data, list):
+            item.status = STATUS_UNRESOLVED
+            item.notes.append("row_data не является списком.")
+            return
+        item.search_text, item.produced_text = target.get("text_to_find"), " ".join(map(str, row_data))
+        table = get_table_by_description(self.doc, target)
+        if table is None:
+            item.target_missing = True
+            return
+        if len(row_data) != len(table.columns):
+            item.status = STATUS_UNRESOLVED
+            item.notes.append("Число значений не совпадает с числом колонок.")
+            return
+        item.reads = self._table_lookup_reads(table, target)
+
+
+def _instruction_key(instruction: dict) -> str:
+    return json.dumps(instruction, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _merge_duplicates(items: List[PlannedInstruction]) -> None:
+    """
+    Отмечает повторы: одинаковые инструкции и REPLACE_TEXT с контекстом, покрытые такой же
+    заменой по всему документу. Остается первая из одинаковых инструкций.
+    """
+    seen: Dict[str, int] = {}
+    global_replaces: Dict[Tuple[str, str], int] = {}
+    for item in items:
+        params = item.instruction.get("parameters", {}) or {}
+        target = item.instruction.get("target_description", {}) or {}
+        if item.operation_type == "REPLACE_TEXT" and not target.get("text_to_find"):
+            key = (params.get("old_text") or target.get("placeholder"), params.get("new_text", "") or "")
+            global_replaces.setdefault(key, item.position)
+    for item in items:
+        key = _instruction_key(item.instruction)
+        if key in seen:
+            item.status = STATUS_DUPLICATE
+            item.notes.append(f"Повтор инструкции {seen[key]}.")
+            continue
+        seen[key] = item.position
+        if item.operation_type == "REPLACE_TEXT":
+            params = item.instruction.get("parameters", {}) or {}
+            target = item.instruction.get("target_description", {}) or {}
+            covering = global_replaces.get((params.get("old_text") or target.get("placeholder"), params.get("new_text", "") or ""))
+            if target.get("text_to_find") and covering is not None:
+                item.status = STATUS_DUPLICATE
+                item.notes.append(f"Покрывается заменой по всему документу (инструкция {covering}).")
+
+
+def reads_replaced_text(later: dict, earlier: dict) -> bool:
+    """
+    later ищет текст, который появляется после замены earlier (цепочка A->B, B->C): вложенность
+    строк поиска later и new_text earlier. Пакетная замена ищет все old_text в исходном тексте,
+    поэтому такие замены не попадают в один пакет.
+    """
+    produced = (earlier.get("parameters", {}) or {}).get("new_text")
+    if not produced:
+        return False
+    searched = [(later.get("parameters", {}) or {}).get("old_text"),
+                (later.get("target_description", {}) or {}).get("text_to_find")]
+    return any(text and (text in produced or produced in text) for text in searched)
+
+
+def _link_producers(items: List[PlannedInstruction]) -> None:
+    """
+    Цель, которой нет в исходном документе, может появиться после более ранней инструкции
+    (например, формат применяется к только что вставленному тексту). Такая инструкция
+    не отбрасывается, а выполняется после инструкций, добавляющих ее текст.
+    """
+    for item in items:
+        if item.status != STATUS_APPLY or not item.target_missing:
+            continue
+        if item.search_text:
+            item.depends_on = [
+                other.position for other in items[:item.position]
+                if other.status == STATUS_APPLY and other.produced_text
+                and (item.search_text in other.produced_text or other.produced_text in item.search_text)
+            ]
+        if item.depends_on:
+            item.notes.append(f"Цель появится после инструкций {item.depends_on}.")
+        else:
+            item.status = STATUS_UNRESOLVED
+            item.notes.append(f"Цель '{item.search_text}' не найдена в документе.")
+
+
+def _mark_superseded(items: List[PlannedInstruction]) -> None:
+    """Отбрасывает правки, все цели которых лежат в удаляемых абзацах (кроме вставки соседних абзацев)."""
+    deleted = sorted({iv for item in items if item.status == STATUS_APPLY for iv in item.deletes})
+    if not deleted:
+        return
+    owners = {iv: item.position for item in items if item.status == STATUS_APPLY for iv in item.deletes}
+    intervals = [(s, e, ("deleted", (s, e))) for s, e in deleted]
+    for item in items:
+        if item.status != STATUS_APPLY or item.deletes or item.depends_on or not (item.reads or item.writes):
+            continue
+        if item.operation_type == "INSERT_TEXT" and not item.writes:
+            continue  # новый абзац рядом с удаляемым остается в документе
+        intervals.extend((s, e, ("edit", item.position, (s, e))) for s, e in set(item.reads + item.writes))
+    covered: Dict[int, set] = {}
+    for a, b in find_overlapping_pairs(intervals):
+        deleted_iv, edit = (a, b) if a[0] == "deleted" else (b, a)
+        if deleted_iv[0] != "deleted" or edit[0] != "edit":
+            continue
+        (ds, de), (es, ee) = deleted_iv[1], edit[2]
+        if ds <= es and ee <= de:
+            covered.setdefault(edit[1], set()).add((es, ee))
+    for pos, intervals_inside in covered.items():
+        item = items[pos]
+        if intervals_inside >= set(item.reads + item.writes):
+            item.status = STATUS_SUPERSEDED
+            deleters = sorted({owners[iv] for iv in deleted if any(iv[0] <= s and e <= iv[1] for s, e in intervals_inside)})
+            item.notes.append(f"Все цели удаляются инструкциями {deleters}.")
+
+
+def _order(items: List[PlannedInstruction]) -> Tuple[List[int], List[Tuple[int, int]]]:
+    """
+    Порядок выполнения. Обработчики находят цели по тексту, поэтому инструкция, читающая фрагмент,
+    выполняется раньше инструкции, которая его меняет; инструкция, зависящая от текста другой, - после нее.
+    Взаимные ограничения (обе меняют то, что ищет другая) - конфликт: для пары сохраняется исходный порядок.
+    При прочих равных сохраняется исходный порядок, но готовые замены ставятся подряд, чтобы попасть в один пакет.
+    """
+    active = [item for item in items if item.status == STATUS_APPLY]
+    edges: Dict[int, set] = {item.position: set() for item in active}  # a -> {b}: a выполняется раньше b
+    for item in active:
+        for producer in item.depends_on:
+            edges[producer].add(item.position)
+
+    intervals = []
+    for item in active:
+        intervals.extend((s, e, (item.position, "r")) for s, e in item.reads)
+        intervals.extend((s, e, (item.position, "w")) for s, e in item.writes)
+    for (pos_a, kind_a), (pos_b, kind_b) in find_overlapping_pairs(intervals):
+        if pos_a == pos_b or kind_a == kind_b:
+            continue
+        reader, writer = (pos_a, pos_b) if kind_a == "r" else (pos_b, pos_a)
+        if items[writer].deletes and not (items[reader].operation_type == "INSERT_TEXT" and not items[reader].writes):
+            # Правка внутри удаляемого абзаца теряет смысл: удаление выполняется первым, пока абзац
+            # еще находится по исходному тексту. Вставка соседнего абзаца - наоборот, до удаления якоря
+            continue
+        edges[reader].add(writer)
+
+    conflicts = []
+    for a in list(edges):
+        for b in list(edges[a]):
+            if a < b and a in edges[b]:
+                # Каждая меняет текст, по которому ищет цель другая: результат зависит от порядка
+                edges[b].discard(a)
+                conflicts.append((a, b))
+                items[a].conflicts_with.append(b)
+                items[b].conflicts_with.append(a)
+                items[b].notes.append(f"Конфликтует с инструкцией {a}: сохранен исходный порядок.")
+
+    indegree = {pos: 0 for pos in edges}
+    for targets in edges.values():
+        for b in targets:
+            indegree[b] += 1
+    ready = [pos for pos, degree in indegree.items() if degree == 0]
+    heapq.heapify(ready)
+    order, remaining = [], set(edges)
+    while remaining:
+        if not ready:
+            # Цикл из трех и более инструкций: первая по исходному порядку выполняется принудительно
+            forced = min(remaining)
+            items[forced].notes.append("Циклическая зависимость с другими инструкциями.")
+            indegree[forced] = 0
+            ready = [forced]
+        pos = heapq.heappop(ready)
+        if order and items[order[-1]].operation_type == "REPLACE_TEXT" and items[pos].operation_type != "REPLACE_TEXT":
+            # Продолжаем цепочку замен, если есть готовая: подряд идущие замены выполняются одним пакетом
+            replace = min((p for p in ready if items[p].operation_type == "REPLACE_TEXT"), default=None)
+            if replace is not None:
+                ready.remove(replace)
+                ready.append(pos)
+                heapq.heapify(ready)
+                pos = replace
+        if pos not in remaining:
+            continue
+        remaining.discard(pos)
+        order.append(pos)
+        for b in edges[pos]:
+            indegree[b] -= 1
+            if indegree[b] == 0 and b in remaining:
+                heapq.heappush(ready, b)
+    return order, conflicts
+
+
+def _group_steps(items: List[PlannedInstruction], order: List[int]) -> List[List[int]]:
+    """
+    Подряд идущие REPLACE_TEXT объединяются в пакет. Пакет заменяет по исходному тексту,
+    поэтому замена, зависящая от результата другой замены того же пакета (по depends_on или
+    по reads_replaced_text, если искомый текст есть и в исходном документе), начинает новый пакет.
+    """
+    steps: List[List[int]] = []
+    for pos in order:
+        item = items[pos]
+        last = steps[-1] if steps else None
+        if (item.operation_type == "REPLACE_TEXT" and last and items[last[0]].operation_type == "REPLACE_TEXT"
+                and not set(item.depends_on) & set(last)
+                and not any(reads_replaced_text(item.instruction, items[p].instruction) for p in last)):
+            last.append(pos)
+        else:
+            steps.append([pos])
+    return steps
+
+
+def plan_instructions(doc: Document, instructions: List[dict], index: Optional[DocumentIndex] = None) -> InstructionPlan:
+    """
+    Строит план выполнения пакета инструкций по документу до правок; документ не меняется.
+    Цели разрешаются по индексу так же, как в обработчиках; повторы объединяются, инструкции
+    без эффекта и с ненайденными целями отбрасываются, пересечения целей определяют порядок.
+    """
+    if index is None: index = DocumentIndex(doc)
+    resolver = _Resolver(doc, index)
+    items = [PlannedInstruction(pos, instruction) for pos, instruction in enumerate(instructions)]
+    _merge_duplicates(items)
+    for item in items:
+        if item.status == STATUS_APPLY:
+            resolver.resolve(item)
+    _link_producers(items)
+    _mark_superseded(items)
+    order, conflicts = _order(items)
+    plan = InstructionPlan(items, order, _group_steps(items, order), conflicts)
+    logger.info(f"plan_instructions: к выполнению {len(order)} из {len(items)} инструкций, "
+                f"отброшено {len(plan.dropped)}, конфликтов {len(conflicts)}, шагов {len(plan.steps)}.")
+    return plan
@@ -0,0 +1,178 @@
+# core/blob_store.py
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Union
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from loguru import logger
+
+DEFAULT_BLOB_DIR = os.getenv("DOC_BLOB_DIR", os.path.join(tempfile.gettempdir(), "docx_agent_blobs"))
+# Сколько секунд неиспользуемая (без ссылок) версия документа хранится на диске
+DEFAULT_TTL_SECONDS = int(os.getenv("DOC_BLOB_TTL_SECONDS", "3600"))
+# Ссылка на версию, к которой не обращались дольше стольких секунд, считается брошенной
+# (сессия закрыта без release) и больше не защищает версию от удаления
+DEFAULT_REF_TTL_SECONDS = int(os.getenv("DOC_BLOB_REF_TTL_SECONDS", "86400"))
+# Каталог просматривается при сохранении не чаще, чем раз в столько секунд
+GC_INTERVAL_SECONDS = 60
+
+
+def content_hash(data: bytes) -> str:
+    """Хэш содержимого документа, идентифицирующий его версию."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """
+    Контентно-адресуемое хранилище версий документа на диске: хэш -> файл.
+    В состоянии графа и сессии Streamlit хранится только хэш версии, байты читаются
+    по требованию (для разбора или скачивания) через отображение файла в память.
+
+    Версии, на которые держат ссылки (acquire/release), не удаляются. Версия без ссылок
+    удаляется при сборке мусора, если к ней не обращались дольше ttl секунд. Время последнего
+    обращения - mtime файла, поэтому после перезапуска процесса старые версии тоже вычищаются.
+    Счетчики ссылок живут в памяти процесса: все сессии Streamlit работают в одном процессе.
+    Закрытая вкладка не вызывает release, поэтому ссылки истекают: если к версии не обращались
+    дольше ref_ttl секунд, сборка мусора снимает ее ссылки (активная сессия вызывает touch для
+    своей версии при каждой отрисовке и продлевает их).
+    """
+
+    def __init__(self, root: str = DEFAULT_BLOB_DIR, ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 ref_ttl_seconds: int = DEFAULT_REF_TTL_SECONDS):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.ref_ttl_seconds = ref_ttl_seconds
+        self._refs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._last_gc = 0.0
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, version: str) -> str:
+        """Путь к файлу версии (файлы разложены по подкаталогам по первым двум символам хэша)."""
+        return os.path.join(self.root, version[:2], version)
+
+    def exists(self, version: Optional[str]) -> bool:
+        return bool(version) and os.path.exists(self.path(version))
+
+    def size(self, version: str) -> int:
+        return os.path.getsize(self.path(version))
+
+    def touch(self, version: Optional[str]) -> None:
+        """Отмечает обращение к версии (mtime файла) без чтения: продлевает ttl и ссылки."""
+        if not version:
+            return
+        try:
+            os.utime(self.path(version))
+        except OSError:
+            pass
+
+    def put(self, data: bytes) -> str:
+        """Сохраняет байты и возвращает хэш версии. Одинаковое содержимое хранится один раз."""
+        version = content_hash(data)
+        path = self.path(version)
+        if os.path.exists(path):
+            self.touch(version)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Пишем во временный файл и атомарно переименовываем: читатель не увидит недописанный файл
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            logger.debug(f"BlobStore: сохранена версия {version[:12]} ({len(data)} байт).")
+        if time.time() - self._last_gc >= min(GC_INTERVAL_SECONDS, self.ttl_seconds):
+            self.collect_garbage()
+        return version
+
+    @contextmanager
+    def open(self, version: str) -> Iterator[Union[mmap.mmap, bytes]]:
+        """Отображает файл версии в память только для чтения (байты не копируются в процесс)."""
+        self.touch(version)
+        with open(self.path(version), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""  # пустой файл нельзя отобразить в память
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def read_bytes(self, version: str) -> bytes:
+        """Материализует байты версии (например, для скачивания по нажатию кнопки)."""
+        with self.open(version) as mm:
+            return bytes(mm)
+
+    def acquire(self, version: Optional[str]) -> None:
+        """Увеличивает счетчик ссылок: версия не будет удалена, пока на нее ссылаются."""
+        if not version:
+            return
+        with self._lock:
+            self._refs[version] = self._refs.get(version, 0) + 1
+        self.touch(version)
+
+    def release(self, version: Optional[str]) -> None:
+        """Уменьшает счетчик ссылок; после этого версия живет еще ttl секунд с последнего обращения."""
+        if not version:
+            return
+        with self._lock:
+            count = self._refs.get(version, 0) - 1
+            if count > 0:
+                self._refs[version] = count
+            else:
+                self._refs.pop(version, None)
+        self.touch(version)
+
+    def collect_garbage(self) -> int:
+        """
+        Удаляет версии без ссылок, к которым не обращались дольше ttl, предварительно сняв ссылки,
+        истекшие по ref_ttl. Возвращает число удаленных.
+        """
+        self._last_gc = time.time()
+        deadline = self._last_gc - self.ttl_seconds
+        ref_deadline = self._last_gc - self.ref_ttl_seconds
+        removed = 0
+        with self._lock:
+            referenced = set(self._refs)
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(shard_dir, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                    if name in referenced:
+                        if mtime >= ref_deadline:
+                            continue
+                        with self._lock:
+                            self._refs.pop(name, None)
+                        logger.info(f"BlobStore: ссылки на версию {name[:12]} истекли (нет обращений дольше {self.ref_ttl_seconds} с).")
+                    if mtime < deadline:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            logger.debug(f"BlobStore: удалено устаревших версий: {removed}.")
+        return removed
+
+
+_default_store: Optional[BlobStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    """Общее для процесса хранилище версий (создается при первом обращении)."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = BlobStore()
+        return _default_store
@@ -0,0 +1,129 @@
+# core/doc_cache.py
+from collections import OrderedDict
+import os
+from typing import Optional
+
+from docx import Document
+from loguru import logger
+
+from . import telemetry
+from .blob_store import BlobStore, get_blob_store
+from .docx_utils import extract_text_from_doc
+from .docx_stream import extract_text_streaming
+from .preview_engine import PreviewIndex
+
+# Во сколько раз разобранный документ (дерево lxml + объекты python-docx) больше исходного .docx.
+# Грубая оценка для ограничения памяти кэша: XML в архиве сжат примерно в 5-10 раз.
+PARSED_SIZE_FACTOR = 8
+DEFAULT_MAX_BYTES = int(os.getenv("DOC_CACHE_MAX_MB", "256")) * 1024 * 1024
+# Начиная с этого размера .docx текст для LLM извлекается потоково, без построения Document
+STREAMING_THRESHOLD_BYTES = int(os.getenv("DOC_STREAMING_THRESHOLD_MB", "20")) * 1024 * 1024
+
+
+@telemetry.span("docx_parse")
+def _parse(path: str) -> Document:
+    return Document(path)
+
+
+class ParsedDocumentCache:
+    """
+    Кэш разобранных документов (LRU), ключ - хэш версии документа в BlobStore.
+    Закэшированный Document используется только для чтения (предпросмотр, извлечение текста).
+    Для внесения правок документ забирается из кэша (checkout): запись удаляется, поэтому
+    измененный объект никогда не выдается как исходная версия.
+    Объем ограничен оценкой занимаемой памяти; самая свежая запись не вытесняется никогда.
+    Для больших документов get_text() читает текст потоково и хранит только его;
+    Document разбирается лениво, когда он действительно понадобится.
+    Документы читаются прямо из файла версии, байты в память процесса целиком не копируются.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, streaming_threshold: int = STREAMING_THRESHOLD_BYTES,
+                 store: Optional[BlobStore] = None):
+        self.max_bytes = max_bytes
+        self.streaming_threshold = streaming_threshold
+        self.store = store or get_blob_store()
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, version: str, parse: bool = True) -> dict:
+        entry = self._entries.get(version)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(version)
+            if parse and entry["doc"] is None:
+                logger.debug(f"ParsedDocumentCache: отложенный разбор документа {version[:12]}.")
+                entry = self._store(version, _parse(self.store.path(version)), self.store.size(version), entry["text"])
+            return entry
+        self.misses += 1
+        path = self.store.path(version)
+        if not parse:
+            logger.debug(f"ParsedDocumentCache: потоковое чтение текста {version[:12]}.")
+            with telemetry.span("extract_text_streaming"):
+                text = extract_text_streaming(path)
+            return self._store(version, None, 0, text)
+        logger.debug(f"ParsedDocumentCache: разбор документа {version[:12]}.")
+        return self._store(version, _parse(path), self.store.size(version))
+
+    def _store(self, version: str, doc: Optional[Document], size: int, text: str | None = None) -> dict:
+        # Запись только с текстом занимает примерно столько, сколько сам текст
+        entry_size = size * PARSED_SIZE_FACTOR + (len(text) * 2 if text else 0)
+        entry = {"doc": doc, "text": text, "preview": None, "size": entry_size}
+        old = self._entries.pop(version, None)
+        if old is not None:
+            self._total_bytes -= old["size"]
+        self._entries[version] = entry
+        self._total_bytes += entry["size"]
+        self._evict()
+        return entry
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            version, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry["size"]
+            logger.debug(f"ParsedDocumentCache: вытеснен документ {version[:12]}.")
+
+    def get(self, version: str) -> Document:
+        """Разобранный документ только для чтения. Изменять его нельзя - используйте checkout()."""
+        return self._entry(version)["doc"]
+
+    def get_text(self, version: str) -> str:
+        """Текст документа для LLM (извлекается один раз на версию, большие документы - потоково)."""
+        entry = self._entry(version, parse=self.store.size(version) < self.streaming_threshold)
+        if entry["text"] is None:
+            entry["text"] = extract_text_from_doc(entry["doc"])
+        return entry["text"]
+
+    def get_preview(self, version: str) -> PreviewIndex:
+        """Индекс предпросмотра правок (строится один раз на версию, пока версия в кэше)."""
+        entry = self._entry(version)
+        if entry["preview"] is None:
+            entry["preview"] = PreviewIndex(entry["doc"])
+            entry["size"] += entry["preview"].size_bytes
+            self._total_bytes += entry["preview"].size_bytes
+            self._evict()
+        return entry["preview"]
+
+    def checkout(self, version: str) -> Document:
+        """
+        Забирает разобранный документ из кэша для применения правок, вызывающий становится его владельцем.
+        deepcopy здесь не подходит: копии lxml-элементов, на которые уже ссылаются объекты python-docx,
+        копируются отдельно от дерева. Поэтому копия не создается, а исходная версия при следующем
+        чтении будет разобрана заново (обычно этого не происходит - после правок читается новая версия).
+        """
+        doc = self.get(version)
+        entry = self._entries.pop(version)
+        self._total_bytes -= entry["size"]
+        return doc
+
+    def put(self, version: str, doc: Document) -> None:
+        """
+        Регистрирует уже разобранный документ для новой версии (например, после сохранения правок),
+        чтобы следующий запрос к этой версии не разбирал байты заново. После вызова doc изменять нельзя.
+        """
+        self._store(version, doc, self.store.size(version))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._total_bytes = 0
@@ -0,0 +1,149 @@
+# core/doc_retrieval.py
+from collections import Counter, OrderedDict
+from typing import List, Optional
+import hashlib
+import math
+import os
+import re
+import threading
+
+from loguru import logger
+
+# Бюджеты контекста документа в промптах (в токенах): извлечение деталей правки и определение категории
+EXTRACTION_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "4000"))
+CATEGORIZE_CONTEXT_TOKENS = int(os.getenv("CATEGORIZE_CONTEXT_TOKENS", "500"))
+# Оценка длины в токенах без токенизатора модели: для кириллицы около трех символов на токен
+CHARS_PER_TOKEN = 3
+# Фрагмент - несколько подряд идущих абзацев общей длиной до стольких символов
+CHUNK_CHARS = 400
+# Слова сравниваются по началу: грубая замена стемминга для русских окончаний
+STEM_LENGTH = 6
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Вес точного вхождения фразы в кавычках из запроса (сверх оценки BM25)
+QUOTED_PHRASE_BOOST = 10.0
+GAP_MARKER = "[...]"
+CACHE_SIZE = 8
+
+_TOKEN_RE = re.compile(r"\w+")
+_QUOTED_RE = re.compile(r"[\"'«„“](.+?)[\"'»“”]")
+
+
+def _terms(text: str) -> List[str]:
+    return [token.lower()[:STEM_LENGTH] for token in _TOKEN_RE.findall(text)]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class DocumentRetriever:
+    """
+    Поиск фрагментов документа, относящихся к запросу, для контекста промптов (BM25).
+    Текст документа (одна строка - один абзац, как в extract_text_from_doc) режется на
+    фрагменты из целых абзацев, чтобы модель видела абзацы полностью и могла точно указать text_to_find.
+    """
+
+    def __init__(self, text: str, chunk_chars: int = CHUNK_CHARS):
+        self.text = text
+        self.chunks: List[str] = []
+        current: List[str] = []
+        current_len = 0
+        for line in text.split("\n"):
+            if current and current_len + len(line) > chunk_chars:
+                self.chunks.append("\n".join(current))
+                current, current_len = [], 0
+            current.append(line)
+            current_len += len(line) + 1
+        if current:
+            self.chunks.append("\n".join(current))
+
+        self._term_counts = [Counter(_terms(chunk)) for chunk in self.chunks]
+        self._lengths = [sum(counts.values()) for counts in self._term_counts]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        document_frequency = Counter(term for counts in self._term_counts for term in counts)
+        n = len(self.chunks)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+        logger.debug(f"DocumentRetriever: {n} фрагмент(ов), {len(self._idf)} термин(ов).")
+
+    def score(self, query: str) -> List[float]:
+        """Оценка BM25 каждого фрагмента по запросу; точные вхождения фраз в кавычках дают надбавку."""
+        query_terms = set(_terms(query))
+        quoted = [phrase.strip() for phrase in _QUOTED_RE.findall(query) if phrase.strip()]
+        scores = []
+        for chunk, counts, length in zip(self.chunks, self._term_counts, self._lengths):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self._avg_length) if self._avg_length else BM25_K1
+            score = 0.0
+            for term in query_terms:
+                tf = counts.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            score += QUOTED_PHRASE_BOOST * sum(1 for phrase in quoted if phrase in chunk)
+            scores.append(score)
+        return scores
+
+    def context_for(self, query: str, token_budget: int) -> str:
+        """
+        Контекст для промпта в пределах бюджета: весь документ, если он помещается, иначе самые
+        релевантные запросу фрагменты в порядке следования в документе. Пропуски между
+        фрагментами отмечаются GAP_MARKER. Если запросу не соответствует ничего - начало документа.
+        """
+        if estimate_tokens(self.text) <= token_budget:
+            return self.text
+        scores = self.score(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        if not ranked:
+            logger.info("DocumentRetriever: релевантные фрагменты не найдены, используется начало документа.")
+            ranked = range(len(self.chunks))
+
+        selected: List[int] = []
+        used = 0
+        for i in ranked:
+            cost = estimate_tokens(self.chunks[i])
+            if used + cost > token_budget:
+                continue  # фрагмент не помещается, но меньший следующий может поместиться
+            selected.append(i)
+            used += cost
+        if not selected:
+            # Даже самый релевантный фрагмент длиннее бюджета (очень длинный абзац) - обрезаем его
+            return self.chunks[ranked[0]][:token_budget * CHARS_PER_TOKEN]
+
+        parts = []
+        previous = -1
+        for i in sorted(selected):
+            if i != previous + 1:
+                parts.append(GAP_MARKER)
+            parts.append(self.chunks[i])
+            previous = i
+        if previous != len(self.chunks) - 1:
+            parts.append(GAP_MARKER)
+        logger.info(f"DocumentRetriever: выбрано {len(selected)} из {len(self.chunks)} фрагмент(ов), ~{used} токен(ов).")
+        return "\n".join(parts)
+
+
+_retrievers: "OrderedDict[str, DocumentRetriever]" = OrderedDict()
+_retrievers_lock = threading.Lock()
+
+
+def get_retriever(text: str, version: Optional[str] = None) -> DocumentRetriever:
+    """
+    Индекс для текста документа; строится один раз на версию (LRU на CACHE_SIZE версий).
+    Без версии ключом служит хэш самого текста.
+    """
+    key = version or hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _retrievers_lock:
+        retriever = _retrievers.get(key)
+        if retriever is not None and retriever.text == text:
+            _retrievers.move_to_end(key)
+            return retriever
+    retriever = DocumentRetriever(text)
+    with _retrievers_lock:
+        _retrievers[key] = retriever
+        while len(_retrievers) > CACHE_SIZE:
+            _retrievers.popitem(last=False)
+    return retriever
+
+
+def document_context(text: str, query: str, token_budget: int, version: Optional[str] = None) -> str:
+    """Фрагменты документа, относящиеся к запросу, в пределах бюджета токенов."""
+    return get_retriever(text, version).context_for(query, token_budget)
@@ -0,0 +1,206 @@
+# core/docx_index.py
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional
+
+from docx import Document
+from docx.text.paragraph import Paragraph
+from loguru import logger
+
+from . import telemetry
+from .docx_utils import (
+    paragraph_text_matches, paragraph_element_text,
+    iter_block_paragraph_elements, iter_header_footer_definitions,
+)
+
+# Типы контейнеров, в которых может находиться абзац
+CONTAINER_BODY = "body"
+CONTAINER_TABLE = "table"
+CONTAINER_HEADER = "header"
+CONTAINER_FOOTER = "footer"
+
+
+@dataclass
+class IndexedParagraph:
+    """Запись индекса: абзац, его контейнер, текст и смещение в сквозном тексте документа."""
+    paragraph: Paragraph
+    container: str
+    text: str
+    start: int = 0
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.text)
+
+
+def _iter_container_entries(parent_element, parent, container: str) -> Iterator[IndexedParagraph]:
+    """
+    Записи для абзацев контейнера в порядке документа. Родителем обертки Paragraph
+    служит сам контейнер (тело или колонтитул) - этого достаточно для операций python-docx.
+    """
+    for p_element, in_table in iter_block_paragraph_elements(parent_element):
+        kind = CONTAINER_TABLE if in_table and container == CONTAINER_BODY else container
+        yield IndexedParagraph(Paragraph(p_element, parent), kind, paragraph_element_text(p_element))
+
+
+class DocumentIndex:
+    """
+    Плоский индекс всех абзацев документа: тело (с таблицами) в порядке следования,
+    затем колонтитулы. Строится один раз за проход и обновляется обработчиками
+    при изменении, вставке и удалении абзацев, чтобы не обходить документ заново
+    для каждой инструкции. Каждый такой абзац (и абзац с измененным только форматированием,
+    о котором обработчик сообщает через touch) попадает в touched. Перед правкой обработчик
+    вызывает will_change: так edit_history.DeltaRecorder сохраняет состояние до правки только
+    у затронутых блоков документа, а по touched проверяет, что ни одна правка не пропущена.
+    """
+
+    def __init__(self, doc: Document):
+        self.doc = doc
+        self._entries: List[IndexedParagraph] = []
+        self._positions: dict = {}
+        self._starts: List[int] = []
+        # Позиции записей меняются только при вставке/удалении, смещения - при любом изменении текста
+        self._positions_dirty = True
+        self._offsets_dirty = True
+        # Элементы w:p, которые обработчики изменили, вставили или удалили (в порядке сообщений)
+        self.touched: list = []
+        # Функции, которым will_change передает элемент перед его правкой
+        self.listeners: list = []
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """Полностью перестраивает индекс (нужно после структурных изменений вне индекса)."""
+        self._entries = list(_iter_container_entries(self.doc.element.body, self.doc._body, CONTAINER_BODY))
+        for kind, hdr_ftr in iter_header_footer_definitions(self.doc):
+            self._entries.extend(_iter_container_entries(hdr_ftr._element, hdr_ftr, kind))
+        self._positions_dirty = self._offsets_dirty = True
+        logger.debug(f"DocumentIndex: проиндексировано {len(self._entries)} абзац(ев).")
+
+    def _ensure_positions(self) -> None:
+        """Пересчитывает позиции записей, если менялся состав индекса."""
+        if not self._positions_dirty:
+            return
+        self._positions = {entry.paragraph._p: pos for pos, entry in enumerate(self._entries)}
+        self._positions_dirty = False
+
+    def _ensure_offsets(self) -> None:
+        """Пересчитывает смещения записей в сквозном тексте, если менялся текст или состав индекса."""
+        if not self._offsets_dirty:
+            return
+        offset = 0
+        self._starts = []
+        for entry in self._entries:
+            entry.start = offset
+            self._starts.append(offset)
+            offset += len(entry.text) + 1  # +1 за разделитель "\n" в сквозном тексте
+        self._offsets_dirty = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[IndexedParagraph]:
+        self._ensure_offsets()
+        telemetry.add_paragraphs(scanned=len(self._entries))
+        return iter(self._entries)
+
+    @property
+    def full_text(self) -> str:
+        """Сквозной текст документа; смещения записей отсчитываются от его начала."""
+        return "\n".join(entry.text for entry in self._entries)
+
+    def entry_for(self, paragraph: Paragraph) -> Optional[IndexedParagraph]:
+        """Запись абзаца; ее смещение start актуально после обхода индекса или entry_at_offset()."""
+        self._ensure_positions()
+        pos = self._positions.get(paragraph._p)
+        return self._entries[pos] if pos is not None else None
+
+    def entry_at_offset(self, offset: int) -> Optional[IndexedParagraph]:
+        """Возвращает запись абзаца, в который попадает смещение в сквозном тексте."""
+        self._ensure_offsets()
+        if not self._entries or offset < 0:
+            return None
+        entry = self._entries[bisect_right(self._starts, offset) - 1]
+        return entry if offset <= entry.end else None
+
+    def paragraphs(self, containers: Optional[Iterable[str]] = None) -> List[Paragraph]:
+        """Все абзацы индекса (опционально только из указанных типов контейнеров)."""
+        allowed = set(containers) if containers else None
+        telemetry.add_paragraphs(scanned=len(self._entries))
+        return [e.paragraph for e in self._entries if allowed is None or e.container in allowed]
+
+    def find(self, text_to_find: str, partial_match: bool = False,
+             containers: Optional[Iterable[str]] = None) -> List[Paragraph]:
+        """Аналог find_paragraphs_with_text, работающий по закэшированному тексту абзацев."""
+        if not text_to_find:
+            return []
+        allowed = set(containers) if containers else None
+        found = [
+            e.paragraph for e in self._entries
+            if (allowed is None or e.container in allowed)
+            and paragraph_text_matches(e.text, text_to_find, partial_match)
+        ]
+        telemetry.add_paragraphs(scanned=len(self._entries))
+        logger.debug(f"DocumentIndex.find: '{text_to_find}' (partial_match={partial_match}) -> {len(found)} абзац(ев).")
+        return found
+
+    def will_change(self, block) -> None:
+        """
+        Сообщает о предстоящей правке абзаца или таблицы (Paragraph/Table): изменении, удалении,
+        вставке абзаца рядом с ним или внутрь таблицы. Вызывается до правки.
+        """
+        for listener in self.listeners:
+            listener(block._element)
+
+    def touch(self, paragraph: Paragraph) -> None:
+        """Регистрирует изменение абзаца, не затронувшее его текст (например, форматирование)."""
+        self.touched.append(paragraph._p)
+
+    def update(self, paragraph: Paragraph) -> None:
+        """
+        Обновляет закэшированный текст абзаца после его изменения. Сбрасываются только смещения:
+        позиции записей не меняются, и entry_for для следующих абзацев остается O(1).
+        """
+        self.touched.append(paragraph._p)
+        entry = self.entry_for(paragraph)
+        if entry is None:
+            logger.warning("DocumentIndex.update: абзац отсутствует в индексе, индекс будет перестроен.")
+            self.rebuild()
+            return
+        new_text = paragraph_element_text(paragraph._p)
+        if new_text != entry.text:
+            entry.text = new_text
+            self._offsets_dirty = True
+
+    def _insert(self, pos: int, paragraph: Paragraph, container: str) -> None:
+        self._entries.insert(pos, IndexedParagraph(paragraph, container, paragraph_element_text(paragraph._p)))
+        self._positions_dirty = self._offsets_dirty = True
+
+    def insert_after(self, anchor: Paragraph, paragraph: Paragraph) -> None:
+        """Регистрирует абзац, вставленный в документ сразу после anchor."""
+        self.touched.append(paragraph._p)
+        self._ensure_positions()
+        pos = self._positions.get(anchor._p)
+        if pos is None:
+            self.rebuild()
+            return
+        self._insert(pos + 1, paragraph, self._entries[pos].container)
+
+    def insert_before(self, anchor: Paragraph, paragraph: Paragraph) -> None:
+        """Регистрирует абзац, вставленный в документ непосредственно перед anchor."""
+        self.touched.append(paragraph._p)
+        self._ensure_positions()
+        pos = self._positions.get(anchor._p)
+        if pos is None:
+            self.rebuild()
+            return
+        self._insert(pos, paragraph, self._entries[pos].container)
+
+    def remove(self, paragraph: Paragraph) -> None:
+        """Убирает из индекса абзац, удаленный из документа."""
+        self.touched.append(paragraph._p)
+        self._ensure_positions()
+        pos = self._positions.get(paragraph._p)
+        if pos is None:
+            return
+        del self._entries[pos]
+        self._positions_dirty = self._offsets_dirty = True
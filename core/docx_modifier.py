@@ -6,10 +6,14 @@ from loguru import logger
 from .docx_operations import (
     handle_replace_text, handle_insert_text, handle_apply_text_formatting,
     handle_delete_element, handle_apply_paragraph_formatting,
-    handle_table_modify_cell, handle_table_add_row
+    handle_table_modify_cell, handle_table_add_row, handle_replace_text_batch
 )
 # Не забываем импортировать extract_text_from_doc, если он не перенесен полностью в docx_utils
 from .docx_utils import extract_text_from_doc 
+from .docx_index import DocumentIndex
+from .edit_history import DeltaRecorder, EditHistory
+from .batch_planner import InstructionPlan, reads_replaced_text
+from . import telemetry
 
 OPERATION_HANDLERS = {
     "REPLACE_TEXT": handle_replace_text,
@@ -24,9 +28,16 @@ OPERATION_HANDLERS = {
     # Или LLM должна сразу давать более конкретный тип.
     # Пока что, для примера, я разделил APPLY_FORMATTING на TEXT и PARAGRAPH.
 }
+# Каждый обработчик замеряется core.telemetry: время, исход, просмотренные и измененные абзацы
+OPERATION_HANDLERS = {op_type: telemetry.instrument_handler(op_type, handler) for op_type, handler in OPERATION_HANDLERS.items()}
 
-def apply_structured_instruction(doc: Document, instruction: dict) -> bool:
-    """Применяет одну структурированную инструкцию к документу."""
+def apply_structured_instruction(doc: Document, instruction: dict, index: DocumentIndex | None = None) -> int:
+    """
+    Применяет одну структурированную инструкцию к документу.
+    Если передан index, обработчик использует его вместо повторного обхода документа.
+    Возвращает число применений: для REPLACE_TEXT - число замен, для остальных операций 1;
+    0 - инструкция не применена.
+    """
     op_type = instruction.get("operation_type")
     target_desc = instruction.get("target_description", {})
     params = instruction.get("parameters", {})
@@ -36,25 +47,124 @@ def apply_structured_instruction(doc: Document, instruction: dict) -> bool:
     handler = OPERATION_HANDLERS.get(op_type)
     if handler:
         try:
-            return handler(doc, target_desc, params)
+            return int(handler(doc, target_desc, params, index=index))
         except Exception as e:
             logger.error(f"Ошибка при выполнении операции '{op_type}': {e}", exc_info=True)
-            return False
+            return 0
     else:
         logger.warning(f"Неизвестный или неподдерживаемый тип операции: '{op_type}'")
-        return False
+        return 0
+
+def apply_replace_text_batch(doc: Document, instructions: list[dict], index: DocumentIndex | None = None) -> list[int]:
+    """Применяет группу REPLACE_TEXT инструкций за один проход. Возвращает число замен по каждой."""
+    try:
+        with telemetry.span("REPLACE_TEXT_BATCH", "handler"):
+            return handle_replace_text_batch(doc, instructions, index=index)
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном выполнении REPLACE_TEXT: {e}", exc_info=True)
+        return [0] * len(instructions)
+
+def modify_document_with_structured_instructions(doc_object: Document, instructions: list[dict],
+                                                 batch_replace: bool = True,
+                                                 report: list | None = None,
+                                                 history: EditHistory | None = None) -> bool:
+    """
+    Применяет список структурированных инструкций к объекту Document.
 
-def modify_document_with_structured_instructions(doc_object: Document, instructions: list[dict]) -> bool:
-    """Применяет список структурированных инструкций к объекту Document."""
+    Args:
+        batch_replace: Если True, подряд идущие REPLACE_TEXT инструкции выполняются одним
+                       пакетом (один проход по документу на всю группу). Замена, которая ищет
+                       текст, вставленный предыдущей заменой группы, начинает новую группу
+                       (batch_planner.reads_replaced_text - та же проверка, что у шагов плана).
+                       В остальном результат совпадает с последовательным применением, кроме
+                       двух случаев: пересекающиеся old_text разрешаются по правилу "самое
+                       левое, затем самое длинное", а не по порядку инструкций, и текст,
+                       образованный заменой вместе с соседним текстом абзаца, повторно не ищется.
+                       False - инструкции строго по одной.
+        report: Необязательный список, в который для каждой инструкции (в исходном порядке)
+                добавляется словарь {"operation_type", "success", "hits"}. "hits" - число
+                применений (см. apply_structured_instruction): замен для REPLACE_TEXT, 1 или 0
+                для остальных операций.
+        history: Необязательная история правок. Если пакет применен успешно, в нее
+                 записывается дельта измененных блоков для отмены/повтора.
+    """
     if not instructions:
         logger.info("Нет инструкций для применения к документу.")
         return False
         
+    # Индекс абзацев строится один раз на весь пакет и поддерживается обработчиками в актуальном состоянии
+    index = DocumentIndex(doc_object)
+    recorder = DeltaRecorder(doc_object, index) if history is not None else None
     overall_success_flag = False
-    for instruction in instructions:
-        if apply_structured_instruction(doc_object, instruction):
+    pos = 0
+    while pos < len(instructions):
+        instruction = instructions[pos]
+        op_type = instruction.get("operation_type")
+
+        group_end = pos
+        while (batch_replace and group_end < len(instructions) and instructions[group_end].get("operation_type") == "REPLACE_TEXT"
+               and not any(reads_replaced_text(instructions[group_end], earlier) for earlier in instructions[pos:group_end])):
+            group_end += 1
+        if group_end - pos > 1:
+            # Группа подряд идущих замен: порядок относительно других операций сохраняется
+            hits = apply_replace_text_batch(doc_object, instructions[pos:group_end], index=index)
+            for count in hits:
+                if report is not None: report.append({"operation_type": "REPLACE_TEXT", "success": count > 0, "hits": count})
+            if any(hits):
+                overall_success_flag = True
+            pos = group_end
+            continue
+
+        hits = apply_structured_instruction(doc_object, instruction, index=index)
+        if report is not None: report.append({"operation_type": op_type, "success": hits > 0, "hits": hits})
+        if hits:
             overall_success_flag = True
+        pos += 1
     
+    if recorder is not None and overall_success_flag:
+        history.record(recorder.finish(), ", ".join(str(i.get("operation_type")) for i in instructions))
+
     if overall_success_flag: logger.info("Хотя бы одна структурированная инструкция была успешно применена.")
     else: logger.warning("Ни одна из структурированных инструкций не была успешно применена.")
-    return overall_success_flag
\ No newline at end of file
+    return overall_success_flag
+
+def apply_instruction_plan(doc_object: Document, plan: InstructionPlan,
+                           report: list | None = None,
+                           history: EditHistory | None = None) -> bool:
+    """
+    Выполняет план, построенный batch_planner.plan_instructions() для этого же документа:
+    инструкции идут в порядке плана, шаги из нескольких REPLACE_TEXT - одним пакетом,
+    отброшенные планом инструкции не выполняются. Индекс строится один раз на весь план.
+
+    Args:
+        report: Как в modify_document_with_structured_instructions, но записи идут в исходном
+                порядке инструкций и дополнительно содержат "status" из плана.
+        history: Необязательная история правок (см. modify_document_with_structured_instructions).
+    """
+    results = {item.position: {"operation_type": item.operation_type, "success": False,
+                                "hits": 0, "status": item.status} for item in plan.items}
+    if not plan.steps:
+        logger.info("В плане нет инструкций для выполнения.")
+        if report is not None: report.extend(results[pos] for pos in sorted(results))
+        return False
+
+    index = DocumentIndex(doc_object)
+    recorder = DeltaRecorder(doc_object, index) if history is not None else None
+    for step in plan.steps:
+        step_instructions = [plan.items[pos].instruction for pos in step]
+        if len(step) > 1:
+            hits = apply_replace_text_batch(doc_object, step_instructions, index=index)
+            for pos, count in zip(step, hits):
+                results[pos].update(success=count > 0, hits=count)
+        else:
+            count = apply_structured_instruction(doc_object, step_instructions[0], index=index)
+            results[step[0]].update(success=count > 0, hits=count)
+
+    overall_success_flag = any(result["success"] for result in results.values())
+    if recorder is not None and overall_success_flag:
+        history.record(recorder.finish(), ", ".join(str(i.get("operation_type")) for i in plan.instructions()))
+    if report is not None: report.extend(results[pos] for pos in sorted(results))
+
+    if overall_success_flag: logger.info("План выполнен: хотя бы одна инструкция успешно применена.")
+    else: logger.warning("План выполнен, но ни одна инструкция не была применена.")
+    return overall_success_flag
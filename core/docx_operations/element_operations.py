@@ -7,8 +7,11 @@ from docx.table import Table
 # from docx.oxml.ns import qn # Для удаления
 from loguru import logger
 from ..docx_utils import find_paragraphs_with_text, get_table_by_description # Относительный импорт
+from ..docx_index import DocumentIndex, CONTAINER_BODY
+from .. import telemetry
 
-def handle_delete_element(doc: Document, target_description: dict, parameters: dict) -> bool:
+def handle_delete_element(doc: Document, target_description: dict, parameters: dict,
+                          index: DocumentIndex | None = None) -> bool:
     logger.info(f"Выполнение DELETE_ELEMENT: target={target_description}")
     target_text = target_description.get("text_to_find")
     element_type = target_description.get("element_type")
@@ -24,32 +27,14 @@ def handle_delete_element(doc: Document, target_description: dict, parameters: d
     if element_type == "paragraph":
         logger.debug(f"Поиск абзацев для удаления. text_to_find='{target_text}'")
         
-        # Сначала пытаемся найти по полному совпадению (с учетом strip)
-        paragraphs_found = find_paragraphs_with_text(doc, target_text, partial_match=False)
-        # Расширяем поиск на колонтитулы и таблицы
-        for section in doc.sections:
-            paragraphs_found.extend(find_paragraphs_with_text(section.header, target_text, partial_match=False))
-            paragraphs_found.extend(find_paragraphs_with_text(section.footer, target_text, partial_match=False))
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    paragraphs_found.extend(find_paragraphs_with_text(cell, target_text, partial_match=False))
-        
-        unique_paragraphs_to_delete = list(dict.fromkeys(paragraphs_found))
+        if index is None: index = DocumentIndex(doc)
+        # Сначала пытаемся найти по полному совпадению (с учетом strip) во всем документе,
+        # включая колонтитулы и таблицы
+        unique_paragraphs_to_delete = index.find(target_text, partial_match=False)
 
         if not unique_paragraphs_to_delete:
             logger.info(f"Точное совпадение для '{target_text}' не найдено. Попытка частичного совпадения (partial_match=True).")
-            paragraphs_found_partial = []
-            paragraphs_found_partial.extend(find_paragraphs_with_text(doc, target_text, partial_match=True))
-            for section in doc.sections:
-                paragraphs_found_partial.extend(find_paragraphs_with_text(section.header, target_text, partial_match=True))
-                paragraphs_found_partial.extend(find_paragraphs_with_text(section.footer, target_text, partial_match=True))
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        paragraphs_found_partial.extend(find_paragraphs_with_text(cell, target_text, partial_match=True))
-            
-            unique_paragraphs_to_delete = list(dict.fromkeys(paragraphs_found_partial))
+            unique_paragraphs_to_delete = index.find(target_text, partial_match=True)
 
             if len(unique_paragraphs_to_delete) > 1:
                 logger.warning(f"DELETE_ELEMENT: Найдено {len(unique_paragraphs_to_delete)} абзацев по частичному совпадению с '{target_text}'. Удаление неоднозначно. Правка не применена.")
@@ -65,12 +50,15 @@ def handle_delete_element(doc: Document, target_description: dict, parameters: d
             element = p_to_delete._element
             parent = element.getparent()
             if parent is not None:
+                index.will_change(p_to_delete)
                 parent.remove(element)
+                index.remove(p_to_delete)
                 count_deleted += 1
             else: # ...
                 logger.warning(f"DELETE_ELEMENT: Не удалось найти родителя для удаления абзаца...")
 
         if count_deleted > 0:
+            telemetry.add_paragraphs(modified=count_deleted)
             logger.info(f"DELETE_ELEMENT: Удалено {count_deleted} абзац(ев) на основе текста '{target_text}'.")
             return True
         else:
@@ -124,7 +112,8 @@ def _apply_single_formatting_rule_to_paragraph(paragraph, rule: dict):
 
 
 # --- ИЗМЕНЕНИЕ: Полностью заменяем handle_apply_paragraph_formatting ---
-def handle_apply_paragraph_formatting(doc: Document, target_description: dict, parameters: dict) -> bool:
+def handle_apply_paragraph_formatting(doc: Document, target_description: dict, parameters: dict,
+                                      index: DocumentIndex | None = None) -> bool:
     """
     Применяет форматирование к ЦЕЛЫМ абзацам. Умеет обрабатывать как стили
     уровня абзаца (выравнивание), так и стили уровня текста (применяя их ко всем run'ам).
@@ -138,13 +127,15 @@ def handle_apply_paragraph_formatting(doc: Document, target_description: dict, p
         return False
 
     # Ищем абзацы для обработки
-    paragraphs_to_process = find_paragraphs_with_text(doc, target_text_context, partial_match=True)
+    if index is None: index = DocumentIndex(doc)
+    paragraphs_to_process = index.find(target_text_context, partial_match=True, containers=(CONTAINER_BODY,))
     if not paragraphs_to_process:
         logger.warning(f"APPLY_PARAGRAPH_FORMATTING: Текст '{target_text_context}' не найден.")
         return False
 
     modified_something = False
     for p in paragraphs_to_process:
+        index.will_change(p)
         for rule in formatting_rules:
             # Если стиль для абзаца (выравнивание) - применяем к абзацу
             if rule.get("style") == "alignment":
@@ -155,8 +146,10 @@ def handle_apply_paragraph_formatting(doc: Document, target_description: dict, p
                 for run in p.runs:
                     _apply_single_formatting_rule_to_run(run, rule)
                 modified_something = True
+        index.touch(p)
     
     if modified_something:
+        telemetry.add_paragraphs(modified=len(paragraphs_to_process))
         logger.info(f"APPLY_PARAGRAPH_FORMATTING: Форматирование параграфа применено.")
     
     return modified_something
\ No newline at end of file
@@ -2,9 +2,14 @@
 from docx import Document
 from docx.table import Table, _Cell as CellType
 from loguru import logger
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 from ..docx_utils import get_table_by_description # Относительный импорт
+from ..docx_index import DocumentIndex
+from .. import telemetry
 
-def handle_table_modify_cell(doc: Document, target_description: dict, parameters: dict) -> bool:
+def handle_table_modify_cell(doc: Document, target_description: dict, parameters: dict,
+                             index: DocumentIndex | None = None) -> bool:
     # ... (ваш существующий код _handle_table_modify_cell, использующий get_table_by_description) ...
     logger.info(f"Выполнение TABLE_MODIFY_CELL: target={target_description}, params={parameters}")
     table_coords = target_description.get("table_coords")
@@ -19,15 +24,23 @@ def handle_table_modify_cell(doc: Document, target_description: dict, parameters
     
     try:
         cell_to_modify: CellType = table.cell(row_idx, col_idx)
-        while len(cell_to_modify.paragraphs) > 1: p_el = cell_to_modify.paragraphs[-1]._element; p_el.getparent().remove(p_el)
+        if index is not None: index.will_change(table)
+        while len(cell_to_modify.paragraphs) > 1:
+            last_para = cell_to_modify.paragraphs[-1]
+            if index is not None: index.will_change(last_para)
+            last_para._element.getparent().remove(last_para._element)
+            if index is not None: index.remove(last_para)
         first_para = cell_to_modify.paragraphs[0] if cell_to_modify.paragraphs else cell_to_modify.add_paragraph()
         first_para.text = new_cell_text
+        if index is not None: index.update(first_para)
+        telemetry.add_paragraphs(modified=1)
         logger.info(f"TABLE_MODIFY_CELL: Ячейка ({row_idx},{col_idx}) изменена на '{new_cell_text}'.")
         return True
     except IndexError: logger.warning(f"TABLE_MODIFY_CELL: Индекс ({row_idx},{col_idx}) вне диапазона."); return False
     except Exception as e: logger.error(f"TABLE_MODIFY_CELL: Ошибка: {e}"); return False
 
-def handle_table_add_row(doc: Document, target_description: dict, parameters: dict) -> bool:
+def handle_table_add_row(doc: Document, target_description: dict, parameters: dict,
+                         index: DocumentIndex | None = None) -> bool:
     # ... (ваш существующий код _handle_table_add_row, использующий get_table_by_description) ...
     logger.info(f"Выполнение TABLE_ADD_ROW: target={target_description}, params={parameters}")
     row_data = parameters.get("row_data")
@@ -40,7 +53,18 @@ def handle_table_add_row(doc: Document, target_description: dict, parameters: di
 
     # Логика вставки по индексу (упрощенная - всегда в конец)
     if insert_at_index is not None: logger.warning("TABLE_ADD_ROW: Вставка по индексу пока не полностью поддерживается, строка добавлена в конец.")
+    # Последний абзац таблицы до вставки - якорь для регистрации новых абзацев в индексе
+    table_paragraphs = table._tbl.findall(".//" + qn("w:p"))
+    anchor = Paragraph(table_paragraphs[-1], table) if table_paragraphs else None
+    if index is not None: index.will_change(table)
     new_row = table.add_row()
     for i, cell_text in enumerate(row_data): new_row.cells[i].text = str(cell_text)
+    if index is not None:
+        if anchor is None: index.rebuild()
+        else:
+            # Обходим XML строки напрямую: new_row.cells повторяет объединенные ячейки
+            for p_el in new_row._tr.iter(qn("w:p")):
+                new_p = Paragraph(p_el, table); index.insert_after(anchor, new_p); anchor = new_p
+    telemetry.add_paragraphs(modified=len(row_data))
     logger.info(f"TABLE_ADD_ROW: Строка {row_data} добавлена в таблицу.")
     return True
\ No newline at end of file
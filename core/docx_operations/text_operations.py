@@ -5,94 +5,33 @@ from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_COLOR_INDEX # WD_COLOR_INDEX 
 from docx.text.paragraph import Paragraph
 from docx.oxml import OxmlElement
 from loguru import logger
-from ..docx_utils import find_paragraphs_with_text, find_runs_with_text # Используем относительный импорт
+from ..docx_utils import RunOffsetMap # Используем относительный импорт
+from ..docx_index import DocumentIndex, CONTAINER_BODY
+from ..pattern_matcher import MultiPatternMatcher, select_leftmost_longest
+from .. import telemetry
 
-# Ваша функция _replace_text_in_paragraph_runs_with_highlight должна быть здесь
-# или в docx_utils.py, если она достаточно общая.
-# Давайте предположим, что она остается здесь, так как тесно связана с заменой.
-def _replace_text_in_paragraph_runs_with_highlight(p: Paragraph, old_text: str, new_text: str) -> bool:
+def _replace_text_in_paragraph_runs_with_highlight(p: Paragraph, old_text: str, new_text: str,
+                                                    index: DocumentIndex | None = None) -> int:
     """
-    Находит и заменяет текст в абзаце, который может быть разбит на несколько 'runs'.
-    Версия без подсветки.
+    Находит и заменяет ВСЕ вхождения текста в абзаце, в том числе разбитые на несколько 'runs'.
+    Смещения run'ов считаются один раз (RunOffsetMap), поэтому стоимость линейна по числу run'ов.
+    Версия без подсветки. Перед заменой сообщает index о правке абзаца. Возвращает число выполненных замен.
     """
-    if not old_text or old_text not in p.text:
-        return False
-
-    runs = p.runs
-    
-    # --- Простая замена (если весь old_text находится в одном run) ---
-    for i, run in enumerate(runs):
-        if old_text in run.text:
-            # Проверяем, что это не просто часть совпадения, разбросанного по нескольким run'ам
-            run_text_start_in_para = sum(len(r.text) for r in runs[:i])
-            para_find_start = p.text.find(old_text)
-            
-            # Если начальная позиция совпадения в полном тексте абзаца находится внутри текущего run'а
-            if para_find_start >= run_text_start_in_para and \
-               para_find_start + len(old_text) <= run_text_start_in_para + len(run.text):
-                
-                logger.debug(f" (простая замена): old_text ('{old_text}') найден и заменяется в одном run: '{run.text}'")
-                current_run_text = run.text
-                start_replace_index = current_run_text.find(old_text)
-                
-                if start_replace_index != -1:
-                    end_replace_index = start_replace_index + len(old_text)
-                    run.text = current_run_text[:start_replace_index] + new_text + current_run_text[end_replace_index:]
-                    # СТРОКА С ПОДСВЕТКОЙ УДАЛЕНА
-                    return True
-    
-    # --- Сложная замена (если old_text разбит на несколько run'ов) ---
-    current_pos = 0
-    text_segments = []
-    para_full_text = ""
-    for i, run_obj_iter in enumerate(runs):
-        text_segments.append({'index': i, 'start_pos': current_pos, 'text': run_obj_iter.text, 'obj': run_obj_iter})
-        para_full_text += run_obj_iter.text
-        current_pos += len(run_obj_iter.text)
-        
-    start_match_idx = para_full_text.find(old_text)
-    if start_match_idx != -1:
-        end_match_idx = start_match_idx + len(old_text)
-        first_run_involved_details = None
-        
-        for seg in text_segments:
-            if seg['start_pos'] <= start_match_idx < (seg['start_pos'] + len(seg['text'])):
-                first_run_involved_details = seg
-                break
-        
-        if first_run_involved_details:
-            first_run_obj = first_run_involved_details['obj']
-            offset_in_first_run = start_match_idx - first_run_involved_details['start_pos']
-            prefix = first_run_obj.text[:offset_in_first_run]
-            len_old_text_in_first_run_after_prefix = len(first_run_involved_details['text']) - offset_in_first_run
-            
-            first_run_obj.text = prefix + new_text
-            # СТРОКА С ПОДСВЕТКОЙ УДАЛЕНА
-            
-            remaining_old_text_to_remove_len = len(old_text) - len_old_text_in_first_run_after_prefix
-            if remaining_old_text_to_remove_len < 0:
-                remaining_old_text_to_remove_len = 0
-            
-            for k in range(first_run_involved_details['index'] + 1, len(text_segments)):
-                if remaining_old_text_to_remove_len <= 0:
-                    break
-                current_run_seg = text_segments[k]
-                current_run_obj = current_run_seg['obj']
-                if len(current_run_obj.text) <= remaining_old_text_to_remove_len:
-                    remaining_old_text_to_remove_len -= len(current_run_obj.text)
-                    current_run_obj.text = ""
-                else:
-                    current_run_obj.text = current_run_obj.text[remaining_old_text_to_remove_len:]
-                    remaining_old_text_to_remove_len = 0
-            
-            return True
-            
-    return False
+    if not old_text:
+        return 0
+    offset_map = RunOffsetMap(p)
+    if old_text not in offset_map.text:
+        return 0
+    if index is not None: index.will_change(p)
+    replaced = offset_map.replace_all(old_text, new_text)
+    if replaced:
+        logger.debug(f" Замена в абзаце: '{old_text}' -> '{new_text}', вхождений: {replaced}")
+    return replaced
 
 
-def handle_replace_text(doc: Document, target_description: dict, parameters: dict) -> bool:
-    # ... (ваш существующий код _handle_replace_text, но использующий _replace_text_in_paragraph_runs_with_highlight отсюда
-    # и find_paragraphs_with_text из docx_utils) ...
+def handle_replace_text(doc: Document, target_description: dict, parameters: dict,
+                        index: DocumentIndex | None = None) -> int:
+    """Возвращает число выполненных замен (0 - текст не найден)."""
     logger.info(f"Выполнение REPLACE_TEXT: target={target_description}, params={parameters}")
     old_text = parameters.get("old_text")
     new_text = parameters.get("new_text", "")
@@ -104,41 +43,104 @@ def handle_replace_text(doc: Document, target_description: dict, parameters: dic
         logger.info(f"Используем плейсхолдер '{placeholder}' как old_text.")
     if not old_text:
         logger.warning("REPLACE_TEXT: 'old_text' или 'placeholder' не указан или пуст.")
-        return False
+        return 0
 
+    if index is None: index = DocumentIndex(doc)
     modified_count = 0
     elements_to_search_in = []
     if context_text:
-        elements_to_search_in.extend(find_paragraphs_with_text(doc, context_text))
-        for section in doc.sections:
-            elements_to_search_in.extend(find_paragraphs_with_text(section.header, context_text))
-            elements_to_search_in.extend(find_paragraphs_with_text(section.footer, context_text))
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    elements_to_search_in.extend(find_paragraphs_with_text(cell, context_text))
+        elements_to_search_in = index.find(context_text)
         if not elements_to_search_in: logger.warning(f"REPLACE_TEXT: Контекстный текст '{context_text}' не найден.")
 
     if not elements_to_search_in:
-        elements_to_search_in.extend(doc.paragraphs)
-        for section in doc.sections:
-            elements_to_search_in.extend(section.header.paragraphs)
-            elements_to_search_in.extend(section.footer.paragraphs)
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    elements_to_search_in.extend(cell.paragraphs)
+        elements_to_search_in = index.paragraphs()
     
-    unique_paragraphs = list(dict.fromkeys(elements_to_search_in))
-    for p in unique_paragraphs:
-        if _replace_text_in_paragraph_runs_with_highlight(p, old_text, new_text):
-            modified_count += 1
+    for p in elements_to_search_in:
+        replaced = _replace_text_in_paragraph_runs_with_highlight(p, old_text, new_text, index)
+        if replaced:
+            index.update(p)
+            telemetry.add_paragraphs(modified=1)
+            modified_count += replaced
     
-    if modified_count > 0: logger.info(f"REPLACE_TEXT: Текст '{old_text}' заменен на '{new_text}' в {modified_count} местах."); return True
-    else: logger.warning(f"REPLACE_TEXT: Текст '{old_text}' не найден для замены."); return False
+    if modified_count > 0: logger.info(f"REPLACE_TEXT: Текст '{old_text}' заменен на '{new_text}' в {modified_count} местах.")
+    else: logger.warning(f"REPLACE_TEXT: Текст '{old_text}' не найден для замены.")
+    return modified_count
+
+
+def handle_replace_text_batch(doc: Document, instructions: list[dict],
+                              index: DocumentIndex | None = None) -> list[int]:
+    """
+    Пакетный REPLACE_TEXT: все old_text пакета ищутся за один проход по каждому абзацу
+    автоматом Ахо-Корасик. Пересечения разрешаются по правилу "самое левое, затем самое
+    длинное"; при одинаковом old_text выигрывает более ранняя инструкция, применимая к абзацу.
+    Замена выполняется по исходному тексту, результат одной замены не ищется повторно.
+
+    Returns:
+        list[int]: Число выполненных замен для каждой инструкции (в порядке пакета).
+    """
+    logger.info(f"Выполнение пакетного REPLACE_TEXT: {len(instructions)} инструкций.")
+    if index is None: index = DocumentIndex(doc)
+    hits = [0] * len(instructions)
+
+    pattern_ids: dict[str, int] = {}
+    pattern_instructions: list[list[int]] = []  # индекс шаблона -> инструкции с этим old_text
+    new_texts: list[str] = []
+    allowed_paragraphs: list[set | None] = []  # None - инструкция применяется ко всему документу
+    for i, instruction in enumerate(instructions):
+        target_description = instruction.get("target_description", {}) or {}
+        parameters = instruction.get("parameters", {}) or {}
+        old_text = parameters.get("old_text") or target_description.get("placeholder")
+        new_texts.append(parameters.get("new_text", "") or "")
+        allowed_paragraphs.append(None)
+        if not old_text:
+            logger.warning(f"REPLACE_TEXT (пакет): инструкция #{i} без 'old_text'/'placeholder' пропущена.")
+            continue
+        context_text = target_description.get("text_to_find")
+        if context_text:
+            context_paragraphs = index.find(context_text)
+            if context_paragraphs:
+                allowed_paragraphs[i] = {p._p for p in context_paragraphs}
+            else:
+                logger.warning(f"REPLACE_TEXT (пакет): Контекстный текст '{context_text}' не найден, поиск по всему документу.")
+        if old_text not in pattern_ids:
+            pattern_ids[old_text] = len(pattern_instructions)
+            pattern_instructions.append([])
+        pattern_instructions[pattern_ids[old_text]].append(i)
+
+    if not pattern_ids:
+        return hits
+    matcher = MultiPatternMatcher(pattern_ids.keys())
+
+    for entry in list(index):
+        if not matcher.has_match(entry.text):
+            continue
+        p = entry.paragraph
+        # Замена выполняется по тексту run'ов (p.text может включать текст гиперссылок)
+        offset_map = RunOffsetMap(p)
+        candidates = []
+        for start, end, pattern_id in matcher.iter_matches(offset_map.text):
+            owner = next((i for i in pattern_instructions[pattern_id]
+                          if allowed_paragraphs[i] is None or p._p in allowed_paragraphs[i]), None)
+            if owner is not None:
+                candidates.append((start, end, owner))
+        selected = select_leftmost_longest(candidates)
+        if not selected:
+            continue
+        index.will_change(p)
+        offset_map.replace_spans([(start, end, new_texts[owner]) for start, end, owner in selected])
+        index.update(p)
+        telemetry.add_paragraphs(modified=1)
+        for _, _, owner in selected:
+            hits[owner] += 1
+
+    for i, count in enumerate(hits):
+        if count: logger.info(f"REPLACE_TEXT (пакет): инструкция #{i}: {count} замен(а).")
+        else: logger.warning(f"REPLACE_TEXT (пакет): инструкция #{i}: текст для замены не найден.")
+    return hits
 
 
-def handle_insert_text(doc: Document, target_description: dict, parameters: dict) -> bool:
+def handle_insert_text(doc: Document, target_description: dict, parameters: dict,
+                       index: DocumentIndex | None = None) -> bool:
     logger.info(f"Выполнение INSERT_TEXT: target={target_description}, params={parameters}")
     text_to_insert = parameters.get("text_to_insert")
     position = parameters.get("position")
@@ -148,7 +150,8 @@ def handle_insert_text(doc: Document, target_description: dict, parameters: dict
         logger.warning("INSERT_TEXT: Не все параметры указаны.")
         return False
     
-    target_paragraphs = find_paragraphs_with_text(doc, target_text)
+    if index is None: index = DocumentIndex(doc)
+    target_paragraphs = index.find(target_text, containers=(CONTAINER_BODY,))
     if not target_paragraphs:
         logger.warning(f"INSERT_TEXT: Абзац с текстом '{target_text}' не найден.")
         return False
@@ -158,6 +161,7 @@ def handle_insert_text(doc: Document, target_description: dict, parameters: dict
         logger.warning(f"INSERT_TEXT: Найдено несколько абзацев с '{target_text}'. Используется первый.")
 
     # --- ЛОГИКА СОХРАНЕНИЯ СТИЛЯ ---
+    index.will_change(target_p)
 
     if position == "after_paragraph":
         # Создаем новый абзац и ПРИМЕНЯЕМ К НЕМУ СТИЛЬ целевого абзаца
@@ -179,6 +183,7 @@ def handle_insert_text(doc: Document, target_description: dict, parameters: dict
         p_element = target_p._element
         new_p_element = new_p._element
         p_element.addnext(new_p_element)
+        index.insert_after(target_p, new_p)
 
     elif position == "before_paragraph":
         # Метод insert_paragraph_before уже хорошо справляется с копированием стиля абзаца.
@@ -194,6 +199,7 @@ def handle_insert_text(doc: Document, target_description: dict, parameters: dict
             new_run.font.italic = first_run_style.italic
             new_run.font.underline = first_run_style.underline
             new_run.font.color.rgb = first_run_style.color.rgb
+        index.insert_before(target_p, new_p)
 
     elif position == "start_of_paragraph":
         # Добавляем run в начало, копируя стиль первого существующего run'а
@@ -219,6 +225,7 @@ def handle_insert_text(doc: Document, target_description: dict, parameters: dict
             new_run.font.color.rgb = first_run.font.color.rgb
         else: # Если абзац был пустой
              new_run.style = target_p.style
+        index.update(target_p)
 
     elif position == "end_of_paragraph":
         # Добавляем run в конец, копируя стиль последнего существующего run'а
@@ -240,11 +247,13 @@ def handle_insert_text(doc: Document, target_description: dict, parameters: dict
             new_run.font.color.rgb = last_run.font.color.rgb
         else: # Если абзац был пустой
             new_run.style = target_p.style
+        index.update(target_p)
 
     else:
         logger.warning(f"INSERT_TEXT: Неизвестная позиция '{position}'.")
         return False
         
+    telemetry.add_paragraphs(modified=1)
     logger.info(f"INSERT_TEXT: Текст '{text_to_insert}' вставлен {position} относительно '{target_text}' с сохранением стиля.")
     return True
 
@@ -344,7 +353,8 @@ def _format_text_within_paragraph(p, text_to_format, rules):
     return True
 
 
-def handle_apply_text_formatting(doc: Document, target_description: dict, parameters: dict) -> bool:
+def handle_apply_text_formatting(doc: Document, target_description: dict, parameters: dict,
+                                 index: DocumentIndex | None = None) -> bool:
     """
     Применяет форматирование к конкретным сегментам текста.
     """
@@ -360,15 +370,19 @@ def handle_apply_text_formatting(doc: Document, target_description: dict, parame
         
     # ИЗМЕНЕНИЕ: Ищем абзацы, содержащие точный сегмент, а не контекст.
     # Это более надежно, если LLM ошиблась с контекстом.
-    paragraphs_to_process = find_paragraphs_with_text(doc, apply_to_text_segment, partial_match=True)
+    if index is None: index = DocumentIndex(doc)
+    paragraphs_to_process = index.find(apply_to_text_segment, partial_match=True, containers=(CONTAINER_BODY,))
     if not paragraphs_to_process:
         logger.warning(f"APPLY_TEXT_FORMATTING: Сегмент для форматирования '{apply_to_text_segment}' не найден в документе.")
         return False
     
     modified_something = False
     for p in paragraphs_to_process:
+        index.will_change(p)
         # Внутри найденного абзаца применяем форматирование
         if _format_text_within_paragraph(p, apply_to_text_segment, formatting_rules):
+            index.touch(p)
+            telemetry.add_paragraphs(modified=1)
             modified_something = True
     
     if modified_something:
@@ -0,0 +1,141 @@
+# core/docx_save.py
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Iterator, List, Optional, Tuple, Union
+import mmap
+import struct
+import zipfile
+import zlib
+
+from docx import Document
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
+from loguru import logger
+
+from . import telemetry
+
+# Фиксированная часть локального заголовка записи zip; за ней идут имя файла и extra-поле
+_LOCAL_HEADER_SIZE = 30
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+
+def save_document_full(doc: Document) -> bytes:
+    """Обычное сохранение python-docx: все части сериализуются и сжимаются заново."""
+    bio = BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+
+def _package_members(doc: Document) -> dict:
+    """
+    Содержимое пакета в том виде, в каком его записал бы doc.save(): имя записи архива -> байты.
+    Набор и порядок записей совпадают с PackageWriter python-docx.
+    """
+    package = doc.part.package
+    parts = list(package.parts)
+    for part in parts:
+        part.before_marshal()
+    members = {
+        CONTENT_TYPES_URI.membername: _ContentTypesItem.from_parts(parts).blob,
+        PACKAGE_URI.rels_uri.membername: package.rels.xml,
+    }
+    for part in parts:
+        members[part.partname.membername] = part.blob
+        if len(part.rels):
+            members[part.partname.rels_uri.membername] = part.rels.xml
+    return {name: blob.encode("utf-8") if isinstance(blob, str) else blob for name, blob in members.items()}
+
+
+def _is_unchanged(info: zipfile.ZipInfo, blob: bytes) -> bool:
+    """Запись исходного архива совпадает с новыми байтами части (размер и CRC32)."""
+    if info.flag_bits & _FLAG_ENCRYPTED or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        return False
+    if info.compress_size > _ZIP32_LIMIT or info.file_size > _ZIP32_LIMIT:
+        return False
+    return info.file_size == len(blob) and info.CRC == zlib.crc32(blob)
+
+
+def _copy_raw_entry(out_zip: zipfile.ZipFile, info: zipfile.ZipInfo, source_view: memoryview) -> None:
+    """
+    Переносит запись в выходной архив без распаковки: сжатые байты берутся из исходного
+    архива как есть, заголовки пишутся заново (без data descriptor и старых extra-полей).
+    """
+    offset = info.header_offset
+    name_len, extra_len = struct.unpack("<HH", source_view[offset + 26:offset + _LOCAL_HEADER_SIZE])
+    data_start = offset + _LOCAL_HEADER_SIZE + name_len + extra_len
+    raw = source_view[data_start:data_start + info.compress_size]
+
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.flag_bits = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    new_info.external_attr = info.external_attr
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    new_info.header_offset = out_zip.fp.tell()
+    out_zip.fp.write(new_info.FileHeader())
+    out_zip.fp.write(raw)
+    # Регистрируем запись так же, как это делает ZipFile.writestr, чтобы close() записал центральный каталог
+    out_zip.filelist.append(new_info)
+    out_zip.NameToInfo[new_info.filename] = new_info
+    out_zip.start_dir = out_zip.fp.tell()
+    out_zip._didModify = True
+
+
+@contextmanager
+def _open_source(source: Union[bytes, str]) -> Iterator[Tuple[zipfile.ZipFile, memoryview]]:
+    """Исходный архив и представление его байтов; файл по пути отображается в память, а не читается."""
+    if isinstance(source, (bytes, bytearray)):
+        with zipfile.ZipFile(BytesIO(source)) as src_zip:
+            yield src_zip, memoryview(source)
+        return
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            zipfile.ZipFile(f) as src_zip:
+        view = memoryview(mm)
+        try:
+            yield src_zip, view
+        finally:
+            view.release()
+
+
+@telemetry.span("docx_save")
+def save_document_incremental(doc: Document, source: Union[bytes, str, None], report: Optional[List[str]] = None) -> bytes:
+    """
+    Сохраняет документ, переписывая только измененные части пакета.
+
+    Части сериализуются так же, как в doc.save(); запись, байты которой совпадают с записью
+    исходного архива source (байты или путь к файлу, из которого был открыт doc), копируется в сжатом виде без
+    повторного сжатия - это прежде всего изображения и прочие двоичные части. Заново сжимаются
+    только измененные и новые части (обычно word/document.xml и, возможно, колонтитул).
+    Порядок записей исходного архива сохраняется, новые записи добавляются в конец.
+    Если передан report, в него добавляются имена переписанных записей.
+    При любой ошибке выполняется обычное полное сохранение.
+    """
+    if not source:
+        return save_document_full(doc)
+    try:
+        members = _package_members(doc)
+        rewritten = []
+        out = BytesIO()
+        with _open_source(source) as (src_zip, source_view), \
+                zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as out_zip:
+            source_infos = {info.filename: info for info in src_zip.infolist()}
+            order = [name for name in source_infos if name in members]
+            order += [name for name in members if name not in source_infos]
+            for name in order:
+                blob = members[name]
+                info = source_infos.get(name)
+                if info is not None and _is_unchanged(info, blob):
+                    _copy_raw_entry(out_zip, info, source_view)
+                else:
+                    out_zip.writestr(name, blob)
+                    rewritten.append(name)
+        logger.debug(f"save_document_incremental: переписано {len(rewritten)} из {len(order)} записей: {rewritten}")
+        if report is not None:
+            report.extend(rewritten)
+        return out.getvalue()
+    except Exception as e:
+        logger.warning(f"save_document_incremental: инкрементальное сохранение не удалось ({e}), выполняется полное сохранение.")
+        return save_document_full(doc)
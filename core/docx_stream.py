@@ -0,0 +1,149 @@
+# core/docx_stream.py
+from dataclasses import dataclass
+from io import BytesIO
+from typing import IO, Iterator, List, Tuple, Union
+import posixpath
+import zipfile
+
+from docx.oxml.ns import qn
+from lxml import etree
+from loguru import logger
+
+from .docx_index import CONTAINER_BODY, CONTAINER_TABLE, CONTAINER_HEADER, CONTAINER_FOOTER
+from .docx_utils import paragraph_element_text
+
+DocxSource = Union[bytes, str, IO[bytes]]
+
+_OFFICE_DOCUMENT_REL = "/officeDocument"
+_PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_R_ID = qn("r:id")
+_W_TYPE = qn("w:type")
+_W_P, _W_TBL, _W_TC = qn("w:p"), qn("w:tbl"), qn("w:tc")
+_W_BODY, _W_HDR, _W_FTR = qn("w:body"), qn("w:hdr"), qn("w:ftr")
+_W_PPR, _W_SECTPR = qn("w:pPr"), qn("w:sectPr")
+_W_HEADER_REF, _W_FOOTER_REF = qn("w:headerReference"), qn("w:footerReference")
+# Порядок колонтитулов раздела тот же, что в docx_utils.iter_header_footer_definitions
+_HDR_FTR_TYPES = ("default", "first", "even")
+
+
+@dataclass
+class ParagraphRecord:
+    """Абзац, прочитанный потоково: контейнер, текст и смещение в сквозном тексте документа."""
+    container: str
+    text: str
+    start: int = 0
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.text)
+
+
+def _read_rels(zf: zipfile.ZipFile, part_name: str) -> dict:
+    """Связи части пакета: rId -> имя части внутри архива."""
+    rels_name = posixpath.join(posixpath.dirname(part_name), "_rels", posixpath.basename(part_name) + ".rels")
+    if rels_name not in zf.namelist():
+        return {}
+    rels = {}
+    root = etree.fromstring(zf.read(rels_name))
+    for rel in root.iterchildren(f"{{{_PKG_REL_NS}}}Relationship"):
+        if rel.get("TargetMode") == "External":
+            continue
+        target = rel.get("Target", "")
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(part_name), target))
+        rels[rel.get("Id")] = (rel.get("Type", ""), target)
+    return rels
+
+
+def _main_document_part(zf: zipfile.ZipFile) -> str:
+    for rel_type, target in _read_rels(zf, "").values():
+        if rel_type.endswith(_OFFICE_DOCUMENT_REL):
+            return target
+    return "word/document.xml"
+
+
+def _iter_part_paragraphs(stream: IO[bytes], root_tag: str, sect_refs: List[dict] | None = None) -> Iterator[Tuple[str, bool]]:
+    """
+    Потоково разбирает часть (document.xml / header / footer) и возвращает (текст, в_таблице)
+    для абзацев, являющихся прямыми детьми корня-контейнера или ячейки таблицы.
+    Завершенные блоки верхнего уровня очищаются, поэтому память ограничена самым большим блоком.
+    Если передан sect_refs, в него собираются ссылки на колонтитулы каждого раздела.
+    """
+    table_depth = 0
+    # События нужны только для блоков; run'ы и текст достраиваются парсером внутри абзаца
+    for event, elem in etree.iterparse(stream, events=("start", "end"), tag=(_W_P, _W_TBL, _W_SECTPR)):
+        tag = elem.tag
+        if event == "start":
+            if tag == _W_TBL:
+                table_depth += 1
+            continue
+
+        parent = elem.getparent()
+        if tag == _W_SECTPR and sect_refs is not None:
+            grandparent = parent.getparent() if parent is not None and parent.tag == _W_PPR else None
+            is_section = parent is not None and (parent.tag == _W_BODY or (
+                grandparent is not None and grandparent.getparent() is not None
+                and grandparent.getparent().tag == _W_BODY))
+            if is_section:
+                refs = {"header": {}, "footer": {}}
+                for ref in elem:
+                    if ref.tag in (_W_HEADER_REF, _W_FOOTER_REF):
+                        kind = "header" if ref.tag == _W_HEADER_REF else "footer"
+                        refs[kind][ref.get(_W_TYPE, "default")] = ref.get(_R_ID)
+                sect_refs.append(refs)
+            continue
+
+        if tag == _W_P and parent is not None and (parent.tag == root_tag or parent.tag == _W_TC):
+            yield paragraph_element_text(elem), table_depth > 0
+        elif tag == _W_TBL:
+            table_depth -= 1
+        else:
+            continue
+
+        # Очищаем только блоки верхнего уровня: содержимое ячеек нужно до конца таблицы
+        if parent is not None and parent.tag == root_tag:
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+def iter_paragraph_records(source: DocxSource) -> Iterator[ParagraphRecord]:
+    """
+    Потоково читает .docx и возвращает записи абзацев в том же порядке и с тем же текстом,
+    что и extract_text_from_doc: тело (с таблицами), затем колонтитулы разделов.
+    Архив открывается лениво; медиа и прочие части не читаются, дерево целиком не строится.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    offset = 0
+    with zipfile.ZipFile(source) as zf:
+        main_part = _main_document_part(zf)
+        sect_refs: List[dict] = []
+        with zf.open(main_part) as stream:
+            for text, in_table in _iter_part_paragraphs(stream, _W_BODY, sect_refs):
+                yield ParagraphRecord(CONTAINER_TABLE if in_table else CONTAINER_BODY, text, offset)
+                offset += len(text) + 1
+
+        rels = _read_rels(zf, main_part)
+        seen_parts = set()
+        for refs in sect_refs:
+            for kind, root_tag, container in (("header", _W_HDR, CONTAINER_HEADER), ("footer", _W_FTR, CONTAINER_FOOTER)):
+                for hdr_ftr_type in _HDR_FTR_TYPES:
+                    r_id = refs[kind].get(hdr_ftr_type)
+                    part_name = rels.get(r_id, (None, None))[1] if r_id else None
+                    if not part_name or part_name in seen_parts:
+                        continue
+                    seen_parts.add(part_name)
+                    with zf.open(part_name) as stream:
+                        for text, _ in _iter_part_paragraphs(stream, root_tag):
+                            yield ParagraphRecord(container, text, offset)
+                            offset += len(text) + 1
+
+
+def extract_text_streaming(source: DocxSource) -> str:
+    """Потоковый аналог extract_text_from_doc для больших документов: без построения Document."""
+    text = "\n".join(record.text for record in iter_paragraph_records(source))
+    logger.debug(f"extract_text_streaming: извлечено {len(text)} символов.")
+    return text
@@ -4,11 +4,32 @@ from docx.text.paragraph import Paragraph
 from docx.table import Table, _Cell
 from loguru import logger
 from docx.section import _Header, _Footer
-from typing import Union, List
+from docx.oxml.ns import nsmap, qn
+from lxml import etree
+from typing import Union, List, Iterator, Tuple
+from bisect import bisect_right
 import sys
 
+from . import telemetry
+
 ContainerType = Union[Document, _Cell, _Header, _Footer, Paragraph]
 
+def paragraph_text_matches(paragraph_text: str, text_to_find: str, partial_match: bool = False) -> bool:
+    """
+    Проверяет, подходит ли текст абзаца под искомый текст.
+    Правило то же, что и в find_paragraphs_with_text: сначала сравнение как есть,
+    затем сравнение без крайних пробелов.
+    """
+    if not text_to_find:
+        return False
+    p_text_stripped = paragraph_text.strip()
+    text_to_find_stripped = text_to_find.strip()
+    if partial_match:
+        if text_to_find in paragraph_text:
+            return True
+        return bool(text_to_find_stripped and p_text_stripped and text_to_find_stripped in p_text_stripped)
+    return paragraph_text == text_to_find or p_text_stripped == text_to_find_stripped
+
 def find_paragraphs_with_text(container: ContainerType, 
                               text_to_find: str, 
                               partial_match: bool = False) -> List[Paragraph]:
@@ -39,33 +60,13 @@ def find_paragraphs_with_text(container: ContainerType,
     found_paragraphs = []
     try:
         for p_idx, p in enumerate(container.paragraphs):
-            p_text_stripped = p.text.strip() # Часто полезно для сравнения без крайних пробелов
-            text_to_find_stripped = text_to_find.strip()
-
-            logger.trace(f"  Проверка абзаца #{p_idx}: repr(p.text)='{repr(p.text)}'")
+            p_text = p.text
+            logger.trace(f"  Проверка абзаца #{p_idx}: repr(p.text)='{repr(p_text)}'")
             logger.trace(f"    Искомый текст (repr): '{repr(text_to_find)}'")
-            logger.trace(f"    p.text.strip() (repr): '{repr(p_text_stripped)}'")
-            logger.trace(f"    text_to_find.strip() (repr): '{repr(text_to_find_stripped)}'")
-
-            match_found = False
-            if partial_match:
-                if text_to_find in p.text:
-                    logger.debug(f"    ЧАСТИЧНОЕ СОВПАДЕНИЕ НАЙДЕНО: '{text_to_find}' in '{p.text}'")
-                    match_found = True
-                # Дополнительная проверка для частичного совпадения без учета крайних пробелов
-                elif text_to_find_stripped and p_text_stripped and text_to_find_stripped in p_text_stripped:
-                    logger.debug(f"    ЧАСТИЧНОЕ СОВПАДЕНИЕ (со strip) НАЙДЕНО: '{text_to_find_stripped}' in '{p_text_stripped}'")
-                    match_found = True
-            else: # Точное совпадение
-                if p.text == text_to_find:
-                    logger.debug(f"    ТОЧНОЕ СОВПАДЕНИЕ НАЙДЕНО: p.text == '{text_to_find}'")
-                    match_found = True
-                # Дополнительная проверка для точного совпадения без учета крайних пробелов
-                elif p_text_stripped == text_to_find_stripped:
-                    logger.debug(f"    ТОЧНОЕ СОВПАДЕНИЕ (со strip) НАЙДЕНО: p.text.strip() == '{text_to_find_stripped}'")
-                    match_found = True
-            
+
+            match_found = paragraph_text_matches(p_text, text_to_find, partial_match)
             if match_found:
+                logger.debug(f"    {'ЧАСТИЧНОЕ' if partial_match else 'ТОЧНОЕ'} СОВПАДЕНИЕ НАЙДЕНО: '{text_to_find}' / '{p_text}'")
                 found_paragraphs.append(p)
             else:
                 logger.trace(f"    Совпадение не найдено для абзаца #{p_idx}.")
@@ -89,6 +90,72 @@ def find_runs_with_text(paragraph: Paragraph, text_to_find: str) -> list: # list
                 found_runs.append(run)
     return found_runs
 
+class RunOffsetMap:
+    """
+    Карта смещений run'ов абзаца: тексты run'ов и префиксные суммы их длин,
+    посчитанные один раз. Позволяет находить вхождения строки, разбитой на любое
+    число run'ов, и переписывать их за один проход без повторного чтения p.text.
+    """
+
+    def __init__(self, paragraph: Paragraph):
+        self.paragraph = paragraph
+        self.runs = paragraph.runs
+        self.texts = [r.text for r in self.runs]
+        self._rebuild_offsets()
+
+    def _rebuild_offsets(self) -> None:
+        self.starts = []
+        offset = 0
+        for text in self.texts:
+            self.starts.append(offset)
+            offset += len(text)
+        self.text = "".join(self.texts)
+
+    def run_index_at(self, offset: int) -> int:
+        """Индекс run'а, содержащего символ с данным смещением (самый правый с началом <= offset)."""
+        return bisect_right(self.starts, offset) - 1
+
+    def find_all(self, needle: str) -> List[tuple]:
+        """Все непересекающиеся вхождения needle в тексте run'ов как интервалы [start, end)."""
+        spans = []
+        if not needle:
+            return spans
+        pos = self.text.find(needle)
+        while pos != -1:
+            spans.append((pos, pos + len(needle)))
+            pos = self.text.find(needle, pos + len(needle))
+        return spans
+
+    def replace_spans(self, spans: List[tuple]) -> int:
+        """
+        Заменяет непересекающиеся интервалы (start, end, new_text), отсортированные по start.
+        Интервалы обрабатываются справа налево, поэтому еще не обработанные смещения
+        остаются верными. Новый текст получает форматирование первого затронутого run'а,
+        остаток совпадения вырезается из последующих run'ов. Возвращает число замен.
+        """
+        if not spans or not self.runs:
+            return 0
+        texts = self.texts
+        for start, end, new_text in reversed(spans):
+            run_idx = self.run_index_at(start)
+            first_start = self.starts[run_idx]
+            first_text = texts[run_idx]
+            tail = first_text[end - first_start:] if end <= first_start + len(first_text) else ""
+            texts[run_idx] = first_text[:start - first_start] + new_text + tail
+            self.runs[run_idx].text = texts[run_idx]
+            k = run_idx + 1
+            while k < len(self.runs) and self.starts[k] < end:
+                cut = min(end - self.starts[k], len(texts[k]))
+                texts[k] = texts[k][cut:]
+                self.runs[k].text = texts[k]
+                k += 1
+        self._rebuild_offsets()
+        return len(spans)
+
+    def replace_all(self, old_text: str, new_text: str) -> int:
+        """Заменяет все вхождения old_text в абзаце. Возвращает число замен."""
+        return self.replace_spans([(start, end, new_text) for start, end in self.find_all(old_text)])
+
 def get_table_by_description(doc: Document, target_description: dict) -> Table | None:
     """Находит таблицу по описанию (индекс или текст)."""
     table_index = target_description.get("table_index")
@@ -117,31 +184,88 @@ def get_table_by_description(doc: Document, target_description: dict) -> Table |
     logger.warning(f"Не удалось однозначно идентифицировать таблицу по описанию: {target_description}")
     return None
 
-def extract_text_from_doc(doc_object: Document) -> str:
-    """Извлекает весь видимый текст из документа для передачи в LLM."""
-    # ... (ваш существующий код extract_text_from_doc) ...
-    full_text_parts = []
-    for p in doc_object.paragraphs:
-        full_text_parts.append(p.text)
-    # ... и так далее для таблиц, колонтитулов ...
-    for table in doc_object.tables:
-         for row in table.rows:
-             for cell in row.cells:
-                 for p_in_cell in cell.paragraphs:
-                     full_text_parts.append(p_in_cell.text)
+# Текстовые элементы run'ов в том же составе, что учитывает python-docx в Paragraph.text
+# (run'ы абзаца и run'ы гиперссылок). Объединение в XPath возвращает их в порядке документа.
+_RUN_TEXT_CHILDREN = "w:t | w:tab | w:ptab | w:br | w:cr | w:noBreakHyphen"
+_PARAGRAPH_TEXT_XPATH = etree.XPath(
+    " | ".join(f"./w:r/{tag} | ./w:hyperlink/w:r/{tag}" for tag in _RUN_TEXT_CHILDREN.split(" | ")),
+    namespaces={"w": nsmap["w"]},
+)
+_W_P, _W_TBL, _W_TR, _W_TC = qn("w:p"), qn("w:tbl"), qn("w:tr"), qn("w:tc")
+_W_T, _W_TAB, _W_PTAB, _W_BR, _W_CR = qn("w:t"), qn("w:tab"), qn("w:ptab"), qn("w:br"), qn("w:cr")
+_W_TYPE = qn("w:type")
+
+
+def paragraph_element_text(p_element) -> str:
+    """Текст элемента w:p напрямую по XML; совпадает с Paragraph.text, но без объектов-оберток."""
+    parts = []
+    for el in _PARAGRAPH_TEXT_XPATH(p_element):
+        tag = el.tag
+        if tag == _W_T: parts.append(el.text or "")
+        elif tag == _W_TAB or tag == _W_PTAB: parts.append("\t")
+        elif tag == _W_CR: parts.append("\n")
+        elif tag == _W_BR:
+            if el.get(_W_TYPE, "textWrapping") == "textWrapping": parts.append("\n")
+        else: parts.append("-")  # w:noBreakHyphen
+    return "".join(parts)
+
+
+def iter_block_paragraph_elements(parent_element) -> Iterator[Tuple[object, bool]]:
+    """
+    Итеративно обходит w:body / w:hdr / w:ftr / w:tc в порядке документа и возвращает
+    пары (элемент w:p, находится_ли_в_таблице). Таблицы, в том числе вложенные,
+    разворачиваются по строкам и ячейкам; каждая w:tc посещается один раз,
+    поэтому объединенные по горизонтали ячейки не дублируются.
+    """
+    stack = [(iter(parent_element), False)]
+    while stack:
+        children, in_table = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            continue
+        if child.tag == _W_P:
+            yield child, in_table
+        elif child.tag == _W_TBL:
+            cells = (tc for tr in child.iterchildren(_W_TR) for tc in tr.iterchildren(_W_TC))
+            stack.append((_iter_cells_content(cells), True))
+
+
+def _iter_cells_content(cells) -> Iterator:
+    for tc in cells:
+        yield from tc
+
+
+def iter_header_footer_definitions(doc_object: Document) -> Iterator[Tuple[str, object]]:
+    """
+    Перечисляет колонтитулы всех разделов как пары ("header" | "footer", _Header | _Footer).
+    Колонтитулы, связанные с предыдущим разделом, пропускаются: их содержимое уже учтено,
+    а обращение к ним в первом разделе создало бы в документе пустое определение.
+    """
+    seen_parts = set()
     for section in doc_object.sections:
-         for p_in_header in section.header.paragraphs:
-             full_text_parts.append(p_in_header.text)
-         for table_in_header in section.header.tables: # Добавлено
-             for row in table_in_header.rows:
-                 for cell in row.cells:
-                     for p_in_cell in cell.paragraphs:
-                         full_text_parts.append(p_in_cell.text)
-         for p_in_footer in section.footer.paragraphs:
-             full_text_parts.append(p_in_footer.text)
-         for table_in_footer in section.footer.tables: # Добавлено
-             for row in table_in_footer.rows:
-                 for cell in row.cells:
-                     for p_in_cell in cell.paragraphs:
-                         full_text_parts.append(p_in_cell.text)
-    return "\n".join(full_text_parts)
\ No newline at end of file
+        for kind, hdr_ftr_list in (
+            ("header", (section.header, section.first_page_header, section.even_page_header)),
+            ("footer", (section.footer, section.first_page_footer, section.even_page_footer)),
+        ):
+            for hdr_ftr in hdr_ftr_list:
+                if hdr_ftr.is_linked_to_previous:
+                    continue
+                element = hdr_ftr._element
+                if id(element) in seen_parts:
+                    continue
+                seen_parts.add(id(element))
+                yield kind, hdr_ftr
+
+
+@telemetry.span("extract_text")
+def extract_text_from_doc(doc_object: Document) -> str:
+    """
+    Извлекает весь видимый текст из документа для передачи в LLM.
+    Работает напрямую по XML: абзацы и таблицы (включая вложенные) тела документа
+    в порядке следования, затем колонтитулы. Один абзац - одна строка результата.
+    """
+    full_text_parts = [paragraph_element_text(p_el) for p_el, _ in iter_block_paragraph_elements(doc_object.element.body)]
+    for _, hdr_ftr in iter_header_footer_definitions(doc_object):
+        full_text_parts.extend(paragraph_element_text(p_el) for p_el, _ in iter_block_paragraph_elements(hdr_ftr._element))
+    return "\n".join(full_text_parts)
@@ -0,0 +1,346 @@
+# core/edit_history.py
+from difflib import SequenceMatcher
+from typing import Callable, Dict, List, Optional
+import copy
+import os
+import zlib
+
+from docx import Document
+from docx.oxml.parser import parse_xml
+from docx.parts.hdrftr import FooterPart, HeaderPart
+from lxml import etree
+from loguru import logger
+
+from .docx_index import DocumentIndex
+
+DEFAULT_MAX_STEPS = int(os.getenv("EDIT_HISTORY_MAX_STEPS", "50"))
+# Разделитель блоков в упакованной дельте: символ NUL в XML недопустим
+_BLOCK_SEPARATOR = b"\0"
+
+
+def _story_containers(doc: Document) -> Dict[str, object]:
+    """
+    Контейнеры блоков, которые меняют обработчики: w:body основного документа и корни
+    колонтитулов. Ключ - имя части пакета, поэтому дельта применима к заново открытому документу.
+    """
+    containers = {str(doc.part.partname): doc.element.body}
+    for part in doc.part.package.iter_parts():
+        if isinstance(part, (HeaderPart, FooterPart)):
+            containers[str(part.partname)] = part.element
+    return containers
+
+
+def _serialize_block(element) -> bytes:
+    """
+    Каноническая сериализация блока. Исключающая C14N объявляет только реально используемые
+    пространства имен, а не все объявления корня документа - блоки получаются в разы компактнее.
+    """
+    return etree.tostring(element, method="c14n", exclusive=True)
+
+
+def _pack(blocks: List[bytes]) -> bytes:
+    return zlib.compress(_BLOCK_SEPARATOR.join(blocks)) if blocks else b""
+
+
+def _unpack(packed: bytes) -> List[bytes]:
+    return zlib.decompress(packed).split(_BLOCK_SEPARATOR) if packed else []
+
+
+def _make_op(pos_before: int, before: List[bytes], pos_after: int, after: List[bytes]) -> dict:
+    return {
+        "pos_before": pos_before, "n_before": len(before), "before": _pack(before),
+        "pos_after": pos_after, "n_after": len(after), "after": _pack(after),
+    }
+
+
+def _diff_by_identity(before_elements: list, before_block: Callable[[int], bytes], after_elements: list,
+                      changed: Optional[set] = None) -> Optional[List[dict]]:
+    """
+    Операции, переводящие блоки до правок в текущие, за один линейный проход.
+    Обработчики меняют блоки на месте, вставляют новые и удаляют старые, но не переставляют их,
+    поэтому блоки сопоставляются по тождеству lxml-элементов. changed - id уцелевших блоков,
+    которые могли измениться: остальные не сериализуются (None - сравнить все).
+    Если порядок уцелевших блоков изменился, возвращает None.
+    """
+    before_ids = {id(el) for el in before_elements}
+    after_ids = {id(el) for el in after_elements}
+    ops = []
+    pending = None  # [pos_before, блоки до, pos_after, блоки после] открытой операции
+    i = j = 0
+    while i < len(before_elements) or j < len(after_elements):
+        if j < len(after_elements) and id(after_elements[j]) not in before_ids:
+            pending = pending or [i, [], j, []]
+            pending[3].append(_serialize_block(after_elements[j]))
+            j += 1
+        elif i < len(before_elements) and id(before_elements[i]) not in after_ids:
+            pending = pending or [i, [], j, []]
+            pending[1].append(before_block(i))
+            i += 1
+        elif i < len(before_elements) and j < len(after_elements) and before_elements[i] is after_elements[j]:
+            block = _serialize_block(after_elements[j]) if changed is None or id(after_elements[j]) in changed else None
+            if block is not None and block != before_block(i):
+                pending = pending or [i, [], j, []]
+                pending[1].append(before_block(i))
+                pending[3].append(block)
+            elif pending:
+                ops.append(_make_op(*pending))
+                pending = None
+            i += 1
+            j += 1
+        else:
+            return None
+    if pending:
+        ops.append(_make_op(*pending))
+    return ops
+
+
+def _diff_blocks(before: List[bytes], after: List[bytes]) -> List[dict]:
+    """Операции, переводящие список блоков before в after (общий случай, сравнение последовательностей)."""
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, before, after).get_opcodes():
+        if tag != "equal":
+            ops.append(_make_op(i1, before[i1:i2], j1, after[j1:j2]))
+    return ops
+
+
+def delta_size(delta: List[dict]) -> int:
+    """Объем, занимаемый дельтой (сжатые блоки), в байтах."""
+    return sum(len(op["before"]) + len(op["after"]) for part_delta in delta for op in part_delta["ops"])
+
+
+class _MissingBefore(Exception):
+    """Блок изменился, но его состояние до правки не сохранено (обработчик не вызвал will_change)."""
+
+
+class DeltaRecorder:
+    """
+    Запись пакета правок. finish() сравнивает блоки до правок с текущим состоянием и возвращает
+    дельту: для каждой измененной части - список операций
+    {"pos_before", "n_before", "before", "pos_after", "n_after", "after"}, где before/after -
+    сжатые блоки верхнего уровня до и после правки, а позиции - индексы блоков в контейнере.
+    В истории остаются лишь измененные блоки.
+
+    С index (через который обработчики сообщают о правках) запись стоит O(число блоков):
+    запоминаются только ссылки на блоки верхнего уровня, а блок сериализуется в момент первого
+    DocumentIndex.will_change для его абзаца или таблицы, то есть до правки. По touched finish()
+    проверяет, что у каждого измененного блока есть сохраненное состояние; если правка прошла
+    мимо will_change, дельту построить нельзя и finish() возвращает None.
+    Без index снимок - копия всего дерева контейнеров, O(размер документа) на каждый пакет.
+    """
+
+    def __init__(self, doc: Document, index: Optional[DocumentIndex] = None):
+        self.doc = doc
+        self.index = index
+        self._before: Dict[str, list] = {}
+        self._copies: Dict[str, list] = {}
+        containers = _story_containers(doc)
+        for name, container in containers.items():
+            # Ссылки на элементы сохраняют объекты-обертки lxml, а с ними и тождество элементов
+            self._before[name] = list(container)
+            if index is None:
+                self._copies[name] = list(copy.deepcopy(container))
+        self._roots = {id(container): name for name, container in containers.items()}
+        self._positions = {name: {id(el): i for i, el in enumerate(elements)} for name, elements in self._before.items()}
+        # Сохраненные до правки блоки: часть -> позиция блока -> сериализация
+        self._captured: Dict[str, Dict[int, bytes]] = {name: {} for name in containers}
+        # Элементы, о правке которых сообщили заранее (ссылки держат id неизменными)
+        self._notified: Dict[int, object] = {}
+        if index is not None:
+            self._touched_from = len(index.touched)
+            index.listeners.append(self._capture)
+
+    def _locate(self, element) -> Optional[tuple]:
+        """(часть, блок верхнего уровня) элемента; None - элемент не в документе."""
+        block = element
+        for ancestor in element.iterancestors():
+            name = self._roots.get(id(ancestor))
+            if name is not None:
+                return name, block
+            block = ancestor
+        return None
+
+    def _capture(self, element) -> None:
+        self._notified[id(element)] = element
+        located = self._locate(element)
+        if located is None:
+            return
+        name, block = located
+        pos = self._positions[name].get(id(block))
+        if pos is not None and pos not in self._captured[name]:
+            self._captured[name][pos] = _serialize_block(block)
+
+    def _uncovered(self) -> Optional[object]:
+        """Затронутый элемент, состояние блока которого до правки не сохранено (None - таких нет)."""
+        for element in self.index.touched[self._touched_from:]:
+            if id(element) in self._notified:
+                continue
+            located = self._locate(element)
+            if located is None:
+                return element
+            name, block = located
+            pos = self._positions[name].get(id(block))
+            if pos is not None and pos not in self._captured[name]:
+                return element
+        return None
+
+    def finish(self) -> Optional[List[dict]]:
+        if self.index is not None:
+            self.index.listeners.remove(self._capture)
+            if self._uncovered() is not None:
+                logger.error("DeltaRecorder: правка прошла без will_change, состояние до правки не сохранено.")
+                return None
+        delta = []
+        for name, container in _story_containers(self.doc).items():
+            before_elements = self._before.get(name, [])
+            after_elements = list(container)
+            if self.index is None:
+                copies, cache = self._copies.get(name, []), {}
+
+                def before_block(i: int) -> bytes:
+                    if i not in cache:
+                        cache[i] = _serialize_block(copies[i])
+                    return cache[i]
+
+                ops = _diff_by_identity(before_elements, before_block, after_elements)
+                if ops is None:
+                    ops = _diff_blocks([before_block(i) for i in range(len(copies))],
+                                       [_serialize_block(el) for el in after_elements])
+            else:
+                captured = self._captured.get(name, {})
+
+                def before_block(i: int) -> bytes:
+                    if i not in captured:
+                        raise _MissingBefore(i)
+                    return captured[i]
+
+                try:
+                    ops = _diff_by_identity(before_elements, before_block, after_elements,
+                                            {id(before_elements[i]) for i in captured})
+                except _MissingBefore:
+                    ops = None
+                if ops is None:
+                    logger.error(f"DeltaRecorder: часть {name} изменена без will_change, дельту построить нельзя.")
+                    return None
+            if ops:
+                delta.append({"part": name, "ops": ops})
+        self._before, self._copies, self._captured, self._notified = {}, {}, {}, {}
+        logger.debug(f"DeltaRecorder: изменено частей: {len(delta)}, размер дельты {delta_size(delta)} байт.")
+        return delta
+
+
+def _seek(container, cursor: Optional[tuple], pos: int):
+    """
+    Элемент с индексом pos. Операции идут по возрастанию позиций, поэтому от предыдущей
+    позиции обычно ближе дойти через getnext(), чем искать элемент с начала контейнера.
+    """
+    if cursor is not None and cursor[1] <= pos and (pos - cursor[1]) * 5 < pos:
+        el, at = cursor
+        while el is not None and at < pos:
+            el, at = el.getnext(), at + 1
+        return el
+    return container[pos] if pos < len(container) else None
+
+
+def apply_delta(doc: Document, delta: List[dict], reverse: bool = False) -> None:
+    """
+    Применяет дельту к документу (reverse=True - откатывает ее). Затрагиваются только измененные
+    блоки. Перед изменением проверяется, что заменяемые блоки совпадают с записанными,
+    иначе выбрасывается ValueError и документ не меняется.
+    """
+    containers = _story_containers(doc)
+    plan = []
+    for part_delta in delta:
+        container = containers.get(part_delta["part"])
+        if container is None:
+            raise ValueError(f"Часть {part_delta['part']} отсутствует в документе.")
+        cursor = None
+        for op in part_delta["ops"]:
+            if reverse:
+                pos, count, expected, replacement = op["pos_after"], op["n_after"], op["after"], op["before"]
+            else:
+                pos, count, expected, replacement = op["pos_before"], op["n_before"], op["before"], op["after"]
+            current = []
+            el = _seek(container, cursor, pos) if count else None
+            while el is not None and len(current) < count:
+                current.append(el)
+                el = el.getnext()
+            if len(current) != count or [_serialize_block(c) for c in current] != _unpack(expected):
+                raise ValueError(f"Документ не соответствует записанной версии (часть {part_delta['part']}, блок {pos}).")
+            if current:
+                cursor = (current[0], pos)
+            plan.append((container, pos, current, replacement))
+
+    # Операции внутри части идут по возрастанию позиций: с конца, чтобы не сдвигать еще не примененные
+    for container, pos, current, replacement in reversed(plan):
+        anchor = current[0].getprevious() if current else (container[pos - 1] if pos > 0 else None)
+        for el in current:
+            container.remove(el)
+        new_elements = [parse_xml(block) for block in _unpack(replacement)]
+        for el in reversed(new_elements):
+            if anchor is not None:
+                anchor.addnext(el)
+            else:
+                container.insert(0, el)
+
+
+class EditHistory:
+    """
+    История правок документа для отмены и повтора. Каждый шаг - дельта одного примененного
+    пакета инструкций (только измененные блоки), поэтому шаг занимает килобайты независимо
+    от размера документа. Отмена и повтор применяются к документу в состоянии после
+    (соответственно до) шага. Новая правка очищает стек повтора.
+    """
+
+    def __init__(self, max_steps: int = DEFAULT_MAX_STEPS):
+        self.max_steps = max_steps
+        self._undo: List[dict] = []
+        self._redo: List[dict] = []
+
+    def record(self, delta: Optional[List[dict]], description: str = "") -> None:
+        """None - дельту построить не удалось (см. DeltaRecorder.finish): шаг нельзя отменить, история очищается."""
+        if delta is None:
+            logger.warning(f"EditHistory: шаг '{description}' не записан, история очищена.")
+            self.clear()
+            return
+        if not delta:
+            return
+        self._undo.append({"delta": delta, "description": description, "size": delta_size(delta)})
+        self._redo.clear()
+        if len(self._undo) > self.max_steps:
+            self._undo.pop(0)
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(step["size"] for step in self._undo + self._redo)
+
+    def undo(self, doc: Document) -> Optional[dict]:
+        """Откатывает последний шаг в doc. Возвращает шаг или None, если отменять нечего."""
+        if not self._undo:
+            return None
+        step = self._undo[-1]
+        apply_delta(doc, step["delta"], reverse=True)
+        self._redo.append(self._undo.pop())
+        logger.info(f"EditHistory: отменен шаг '{step['description']}'.")
+        return step
+
+    def redo(self, doc: Document) -> Optional[dict]:
+        """Повторно применяет последний отмененный шаг к doc. Возвращает шаг или None."""
+        if not self._redo:
+            return None
+        step = self._redo[-1]
+        apply_delta(doc, step["delta"])
+        self._undo.append(self._redo.pop())
+        logger.info(f"EditHistory: повторен шаг '{step['description']}'.")
+        return step
+
+    def clear(self) -> None:
+        self._undo.clear()
+        self._redo.clear()
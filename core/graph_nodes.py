@@ -1,30 +1,117 @@
 # core/graph_nodes.py
+from typing import List, Optional
+import asyncio
+import os
+
 from loguru import logger
-from io import BytesIO
 from docx import Document
+from langgraph.config import get_stream_writer
 
 # Локальные импорты из нашего пакета
 from .state import GraphState
-from .llm_invoker import invoke_gemini_json_mode
+from .llm_invoker import (
+    invoke_gemini_json_mode, ainvoke_gemini_json_mode,
+    stream_gemini_json_mode, astream_gemini_json_mode,
+)
 from . import prompts
+from . import telemetry
+from .doc_retrieval import document_context, EXTRACTION_CONTEXT_TOKENS, CATEGORIZE_CONTEXT_TOKENS
 
-# --- Узлы графа, использующие LLM ---
+def _document_context(state: GraphState, token_budget: int = EXTRACTION_CONTEXT_TOKENS) -> str:
+    """Фрагменты документа, относящиеся к запросу, вместо обрезки текста по длине."""
+    return document_context(state["document_content_text"], state["current_user_query"],
+                            token_budget, version=state.get("document_version"))
 
-def categorize_request_node(state: GraphState) -> GraphState:
-    logger.info(">>> Вход в categorize_request_node")
-    user_query = state["current_user_query"]
-    doc_text_snippet = state["document_content_text"][:2000]
+# --- Проверка извлеченных инструкций (общая для узлов извлечения и быстрого пути) ---
+
+def _is_valid_replacement(item: dict) -> bool:
+    return (item.get("operation_type") == "REPLACE_TEXT" and
+            item.get("parameters", {}).get("old_text") and
+            item.get("parameters", {}).get("new_text") is not None)
+
+def _is_valid_insertion(item: dict) -> bool:
+    return (item.get("operation_type") == "INSERT_TEXT" and
+            item.get("target_description", {}).get("text_to_find") and
+            item.get("parameters", {}).get("text_to_insert") and
+            item.get("parameters", {}).get("position"))
+
+def _is_valid_deletion(item: dict) -> bool:
+    return (item.get("operation_type") == "DELETE_ELEMENT" and
+            item.get("target_description", {}).get("element_type"))
 
-    prompt = prompts.CATEGORIZE_REQUEST_PROMPT.format(
-        doc_text_snippet=doc_text_snippet,
-        user_query=user_query
+def _is_valid_formatting(item: dict) -> bool:
+    op_type = item.get("operation_type")
+    target = item.get("target_description", {})
+    params = item.get("parameters", {})
+    rules = params.get("formatting_rules")
+    # Форматирование абзаца
+    if op_type == "APPLY_PARAGRAPH_FORMATTING":
+        return bool(target.get("text_to_find") and rules)
+    # Форматирование текста
+    return bool(op_type == "APPLY_TEXT_FORMATTING" and target.get("text_to_find") and
+                params.get("apply_to_text_segment") and rules)
+
+# Категория запроса -> правило проверки инструкции этой категории
+CATEGORY_VALIDATORS = {
+    "REPLACE_TEXT": _is_valid_replacement,
+    "INSERT_TEXT": _is_valid_insertion,
+    "DELETE_ELEMENT": _is_valid_deletion,
+    "APPLY_FORMATTING": _is_valid_formatting,
+}
+
+def validate_instructions(category: str, items) -> list:
+    """Инструкции из ответа LLM, прошедшие проверку для категории (остальные отбрасываются)."""
+    validator = CATEGORY_VALIDATORS.get(category)
+    if validator is None or not isinstance(items, list):
+        return []
+    valid = []
+    for item in items:
+        try:
+            if isinstance(item, dict) and validator(item):
+                valid.append(item)
+        except AttributeError: # например, "parameters": null
+            continue
+    return valid
+
+# Узлы извлечения читают ответ LLM потоком и сообщают о каждой готовой инструкции (LLM_STREAMING=0 - отключить)
+STREAMING_ENABLED = os.getenv("LLM_STREAMING", "1") not in ("0", "false", "False", "")
+# Сколько подзапросов составного запроса обрабатывается (остальные отбрасываются)
+MAX_INTENTS = int(os.getenv("MAX_REQUEST_INTENTS", "5"))
+
+# --- Узлы графа, использующие LLM ---
+# Каждый узел разделен на построение промпта и обработку ответа: синхронный вариант узла
+# и асинхронный (a*, для graph.ainvoke) отличаются только способом вызова LLM.
+
+def _categorize_prompt(state: GraphState) -> str:
+    return prompts.CATEGORIZE_REQUEST_PROMPT.format(
+        doc_text_snippet=_document_context(state, CATEGORIZE_CONTEXT_TOKENS),
+        user_query=state["current_user_query"]
     )
-    response_json = invoke_gemini_json_mode(prompt)
-    
+
+def _parse_intents(response_json: dict) -> List[dict]:
+    """Подзапросы из ответа категоризации: [{"position", "category", "query"}], не больше MAX_INTENTS."""
+    intents = []
+    raw_intents = response_json.get("intents")
+    for item in raw_intents if isinstance(raw_intents, list) else []:
+        if not isinstance(item, dict):
+            continue
+        query, category = item.get("query"), item.get("category")
+        if isinstance(query, str) and query.strip() and isinstance(category, str):
+            intents.append({"position": len(intents), "category": category, "query": query.strip()})
+    if len(intents) > MAX_INTENTS:
+        logger.warning(f"Составной запрос: {len(intents)} подзапрос(ов), обрабатываются первые {MAX_INTENTS}.")
+    return intents[:MAX_INTENTS]
+
+def _categorize_result(state: GraphState, response_json) -> GraphState:
     category = "UNKNOWN_OPERATION"
-    if isinstance(response_json, dict) and "category" in response_json:
-        category = response_json["category"]
+    state["intents"] = None
+    intents = _parse_intents(response_json) if isinstance(response_json, dict) else []
+    if isinstance(response_json, dict) and ("category" in response_json or intents):
+        category = response_json.get("category") or intents[0]["category"]
         logger.info(f"LLM определила категорию: {category}")
+        if len(intents) > 1:
+            state["intents"] = intents
+            logger.info(f"Составной запрос, подзапросы: {[(i['category'], i['query']) for i in intents]}")
     else:
         logger.warning(f"Не удалось определить категорию, получен ответ: {response_json}")
         state["system_message"] = "Не удалось определить тип вашего запроса. Пожалуйста, попробуйте переформулировать."
@@ -32,178 +119,266 @@ def categorize_request_node(state: GraphState) -> GraphState:
     state["next_node_to_call"] = category
     return state
 
-def extract_replacement_details_node(state: GraphState) -> GraphState:
-    logger.info(">>> Вход в extract_replacement_details_node")
-    user_query = state["current_user_query"]
-    doc_text = state["document_content_text"][:15000]
-
-    prompt = prompts.EXTRACT_REPLACEMENT_DETAILS_PROMPT.format(
-        doc_text=doc_text,
-        user_query=user_query
-    )
-    response_json_list = invoke_gemini_json_mode(prompt)
+def categorize_request_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в categorize_request_node")
+    return _categorize_result(state, invoke_gemini_json_mode(_categorize_prompt(state)))
 
-    if isinstance(response_json_list, list) and response_json_list:
-        valid_instructions = [
-            item for item in response_json_list
-            if isinstance(item, dict) and 
-               item.get("operation_type") == "REPLACE_TEXT" and
-               item.get("parameters", {}).get("old_text") and
-               item.get("parameters", {}).get("new_text") is not None
-        ]
-        state["extracted_instructions"] = valid_instructions if valid_instructions else None
-        if not valid_instructions:
-            state["system_message"] = "Не удалось извлечь детали для замены текста."
-    elif isinstance(response_json_list, dict) and "error" in response_json_list:
-        state["system_message"] = f"Ошибка LLM при извлечении деталей: {response_json_list['error']}"
-        state["extracted_instructions"] = None
-    else:
-        state["system_message"] = "Не удалось извлечь детали для замены текста (неверный формат ответа LLM)."
-        state["extracted_instructions"] = None
-        
-    logger.info(f"Извлеченные инструкции для замены: {state.get('extracted_instructions')}")
-    return state
+async def acategorize_request_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в categorize_request_node (async)")
+    return _categorize_result(state, await ainvoke_gemini_json_mode(_categorize_prompt(state)))
 
-def extract_insertion_details_node(state: GraphState) -> GraphState:
-    logger.info(">>> Вход в extract_insertion_details_node")
-    user_query = state["current_user_query"]
-    doc_text = state["document_content_text"][:15000] # Ограничиваем для контекста
+# Категории, для которых быстрый путь не извлекает инструкций: маршрут определяется самой категорией
+NON_EXTRACTION_CATEGORIES = ("TABLE_OPERATION", "CLARIFICATION_NEEDED", "UNKNOWN_OPERATION")
 
-    prompt = prompts.EXTRACT_INSERTION_DETAILS_PROMPT.format(
-        doc_text=doc_text,
-        user_query=user_query
+def _categorize_and_extract_prompt(state: GraphState) -> str:
+    return prompts.CATEGORIZE_AND_EXTRACT_PROMPT.format(
+        doc_text=_document_context(state),
+        user_query=state["current_user_query"]
     )
-    response_json_list = invoke_gemini_json_mode(prompt)
-
-    if isinstance(response_json_list, list) and response_json_list:
-        valid_instructions = []
-        for item in response_json_list:
-            # Валидация для операции вставки
-            if (isinstance(item, dict) and
-                    item.get("operation_type") == "INSERT_TEXT" and
-                    item.get("target_description", {}).get("text_to_find") and
-                    item.get("parameters", {}).get("text_to_insert") and
-                    item.get("parameters", {}).get("position")):
-                valid_instructions.append(item)
 
-        state["extracted_instructions"] = valid_instructions if valid_instructions else None
-        if not valid_instructions:
-            state["system_message"] = "Не удалось извлечь корректные детали для вставки текста."
-            
-    elif isinstance(response_json_list, dict) and "error" in response_json_list:
-        state["system_message"] = f"Ошибка LLM при извлечении деталей вставки: {response_json_list['error']}"
-        state["extracted_instructions"] = None
+def _categorize_and_extract_result(state: GraphState, response_json) -> GraphState:
+    """
+    Быстрый путь: категория и инструкции за один вызов LLM. Инструкции проверяются теми же
+    правилами, что и в узлах извлечения. Если ответ не прошел проверку, next_node_to_call
+    остается None, и граф переходит к обычному пути (категоризация, затем извлечение).
+    """
+    state["next_node_to_call"] = None
+    state["extracted_instructions"] = None
+    category = response_json.get("category") if isinstance(response_json, dict) else None
+    if category in CATEGORY_VALIDATORS:
+        valid_instructions = validate_instructions(category, response_json.get("instructions"))
+        if valid_instructions:
+            state["next_node_to_call"] = category
+            state["extracted_instructions"] = valid_instructions
+            logger.info(f"Быстрый путь: категория {category}, инструкций: {len(valid_instructions)}")
+        else:
+            logger.info(f"Быстрый путь: инструкции для {category} не прошли проверку, переход к обычному пути.")
+    elif category in NON_EXTRACTION_CATEGORIES:
+        state["next_node_to_call"] = category
+        logger.info(f"Быстрый путь: категория {category}")
     else:
-        state["system_message"] = "Не удалось извлечь детали для вставки текста (неверный формат ответа LLM)."
-        state["extracted_instructions"] = None
-        
-    logger.info(f"Извлеченные инструкции для вставки: {state.get('extracted_instructions')}")
+        logger.info(f"Быстрый путь: неверный ответ LLM ({response_json}), переход к обычному пути.")
     return state
 
-def clarification_node(state: GraphState) -> GraphState:
-    logger.info(">>> Вход в clarification_node")
-    prompt = prompts.GENERATE_CLARIFICATION_QUESTION_PROMPT.format(user_query=state["current_user_query"])
-    response_json = invoke_gemini_json_mode(prompt)
+def categorize_and_extract_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в categorize_and_extract_node")
+    return _categorize_and_extract_result(state, invoke_gemini_json_mode(_categorize_and_extract_prompt(state)))
 
-    if isinstance(response_json, dict) and "clarification_question" in response_json:
-        state["clarification_question"] = response_json["clarification_question"]
-        logger.info(f"Сгенерирован уточняющий вопрос: {state['clarification_question']}")
-    else:
-        state["clarification_question"] = "Не могли бы вы уточнить ваш запрос?"
-        logger.warning(f"Не удалось сгенерировать уточняющий вопрос, получен ответ: {response_json}")
-    state["extracted_instructions"] = None
-    return state
+async def acategorize_and_extract_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в categorize_and_extract_node (async)")
+    return _categorize_and_extract_result(state, await ainvoke_gemini_json_mode(_categorize_and_extract_prompt(state)))
 
-def extract_deletion_details_node(state: GraphState) -> GraphState:
-    logger.info(">>> Вход в extract_deletion_details_node")
+# Узлы извлечения деталей: категория -> промпт и сообщения
+# (нет корректных инструкций / ошибка LLM / неверный формат ответа / что извлекалось - для журнала)
+_EXTRACTION_SPECS = {
+    "REPLACE_TEXT": {
+        "prompt": prompts.EXTRACT_REPLACEMENT_DETAILS_PROMPT,
+        "invalid": "Не удалось извлечь детали для замены текста.",
+        "error": "Ошибка LLM при извлечении деталей",
+        "bad_format": "Не удалось извлечь детали для замены текста (неверный формат ответа LLM).",
+        "label": "для замены",
+    },
+    "INSERT_TEXT": {
+        "prompt": prompts.EXTRACT_INSERTION_DETAILS_PROMPT,
+        "invalid": "Не удалось извлечь корректные детали для вставки текста.",
+        "error": "Ошибка LLM при извлечении деталей вставки",
+        "bad_format": "Не удалось извлечь детали для вставки текста (неверный формат ответа LLM).",
+        "label": "для вставки",
+    },
+    "DELETE_ELEMENT": {
+        "prompt": prompts.EXTRACT_DELETION_DETAILS_PROMPT,
+        "invalid": "Не удалось извлечь корректные детали для удаления элемента.",
+        "error": "Ошибка LLM при извлечении деталей удаления",
+        "bad_format": "Не удалось извлечь детали для удаления (неверный формат ответа LLM).",
+        "label": "для удаления",
+    },
+    "APPLY_FORMATTING": {
+        "prompt": prompts.EXTRACT_FORMATTING_DETAILS_PROMPT,
+        "invalid": "Не удалось извлечь корректные детали для форматирования.",
+        "error": "Ошибка LLM при извлечении деталей форматирования",
+        "bad_format": "Не удалось извлечь детали для форматирования (неверный формат ответа LLM).",
+        "label": "для форматирования",
+    },
+}
+
+def _extraction_prompt(state: GraphState, category: str) -> Optional[str]:
+    """Промпт узла извлечения или None (в state записано сообщение об ошибке)."""
     user_query = state["current_user_query"]
-    doc_text = state["document_content_text"][:15000]
+    doc_text = _document_context(state)
 
     # Добавим проверки типов
     if not isinstance(user_query, str):
         logger.error(f"user_query не является строкой: {type(user_query)}")
         state["system_message"] = "Внутренняя ошибка: неверный тип запроса."
-        return state
-    if not isinstance(doc_text, str): # Проверяем уже укороченный текст
+        return None
+    if not isinstance(doc_text, str):
         logger.error(f"doc_text не является строкой: {type(state['document_content_text'])}")
         state["system_message"] = "Внутренняя ошибка: неверный тип контента документа."
-        return state
-    
-    prompt = prompts.EXTRACT_DELETION_DETAILS_PROMPT.format(
-         doc_text=doc_text,
-         user_query=user_query
-    )
-    response_json_list = invoke_gemini_json_mode(prompt)
+        return None
 
-    if isinstance(response_json_list, list) and response_json_list:
-        valid_instructions = []
-        for item in response_json_list:
-            if (isinstance(item, dict) and
-                    item.get("operation_type") == "DELETE_ELEMENT" and
-                    item.get("target_description", {}).get("element_type")):
-                valid_instructions.append(item)
+    return _EXTRACTION_SPECS[category]["prompt"].format(doc_text=doc_text, user_query=user_query)
 
+def _extraction_result(state: GraphState, category: str, response_json_list) -> GraphState:
+    spec = _EXTRACTION_SPECS[category]
+    if isinstance(response_json_list, list) and response_json_list:
+        valid_instructions = validate_instructions(category, response_json_list)
         state["extracted_instructions"] = valid_instructions if valid_instructions else None
         if not valid_instructions:
-            state["system_message"] = "Не удалось извлечь корректные детали для удаления элемента."
-            
+            state["system_message"] = spec["invalid"]
     elif isinstance(response_json_list, dict) and "error" in response_json_list:
-        state["system_message"] = f"Ошибка LLM при извлечении деталей удаления: {response_json_list['error']}"
+        state["system_message"] = f"{spec['error']}: {response_json_list['error']}"
         state["extracted_instructions"] = None
     else:
-        state["system_message"] = "Не удалось извлечь детали для удаления (неверный формат ответа LLM)."
+        state["system_message"] = spec["bad_format"]
         state["extracted_instructions"] = None
-        
-    logger.info(f"Извлеченные инструкции для удаления: {state.get('extracted_instructions')}")
+
+    logger.info(f"Извлеченные инструкции {spec['label']}: {state.get('extracted_instructions')}")
     return state
 
-# ЗАМЕНИТЕ ВАШУ ФУНКЦИЮ extract_formatting_details_node НА ЭТУ
+def _instruction_emitter(state: GraphState, category: str):
+    """
+    Обработчик элементов потокового ответа: каждая инструкция, прошедшая проверку, сразу
+    передается в поток событий графа (stream_mode="custom") как {"instruction", "category", "query"}.
+    Вне графа (узел вызван напрямую) возвращает None.
+    """
+    try:
+        writer = get_stream_writer()
+    except RuntimeError:
+        return None
+    query = state["current_user_query"]
+
+    def emit(item):
+        for instruction in validate_instructions(category, [item]):
+            writer({"instruction": instruction, "category": category, "query": query})
+    return emit
+
+def _extract_details(state: GraphState, category: str) -> GraphState:
+    prompt = _extraction_prompt(state, category)
+    if prompt is None:
+        return state
+    if STREAMING_ENABLED:
+        response = stream_gemini_json_mode(prompt, on_item=_instruction_emitter(state, category))
+    else:
+        response = invoke_gemini_json_mode(prompt)
+    return _extraction_result(state, category, response)
+
+async def _aextract_details(state: GraphState, category: str) -> GraphState:
+    prompt = _extraction_prompt(state, category)
+    if prompt is None:
+        return state
+    if STREAMING_ENABLED:
+        response = await astream_gemini_json_mode(prompt, on_item=_instruction_emitter(state, category))
+    else:
+        response = await ainvoke_gemini_json_mode(prompt)
+    return _extraction_result(state, category, response)
+
+def extract_replacement_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_replacement_details_node")
+    return _extract_details(state, "REPLACE_TEXT")
+
+async def aextract_replacement_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_replacement_details_node (async)")
+    return await _aextract_details(state, "REPLACE_TEXT")
+
+def extract_insertion_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_insertion_details_node")
+    return _extract_details(state, "INSERT_TEXT")
+
+async def aextract_insertion_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_insertion_details_node (async)")
+    return await _aextract_details(state, "INSERT_TEXT")
+
+def extract_deletion_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_deletion_details_node")
+    return _extract_details(state, "DELETE_ELEMENT")
+
+async def aextract_deletion_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_deletion_details_node (async)")
+    return await _aextract_details(state, "DELETE_ELEMENT")
+
 def extract_formatting_details_node(state: GraphState) -> GraphState:
     logger.info(">>> Вход в extract_formatting_details_node")
-    user_query = state["current_user_query"]
-    doc_text = state["document_content_text"][:15000]
+    return _extract_details(state, "APPLY_FORMATTING")
+
+async def aextract_formatting_details_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в extract_formatting_details_node (async)")
+    return await _aextract_details(state, "APPLY_FORMATTING")
 
-    prompt = prompts.EXTRACT_FORMATTING_DETAILS_PROMPT.format(
-        doc_text=doc_text,
-        user_query=user_query
+# --- Составной запрос: извлечение по подзапросам в параллельных ветвях ---
+
+def _intent_state(payload: dict) -> GraphState:
+    """Состояние ветви: запрос заменен фрагментом подзапроса, документ - общий."""
+    return GraphState(
+        original_user_query=payload["original_user_query"],
+        current_user_query=payload["intent"]["query"],
+        document_content_text=payload["document_content_text"],
+        document_version=payload.get("document_version"),
+        extracted_instructions=None, clarification_question=None, system_message=None,
+        next_node_to_call=payload["intent"]["category"], intents=None, intent_results=[],
     )
-    response_json_list = invoke_gemini_json_mode(prompt)
 
-    if isinstance(response_json_list, list) and response_json_list:
-        valid_instructions = []
-        for item in response_json_list:
-            if not isinstance(item, dict): continue
-
-            op_type = item.get("operation_type")
-            target = item.get("target_description", {})
-            params = item.get("parameters", {})
-            rules = params.get("formatting_rules")
-
-            # Валидация для форматирования абзаца
-            if (op_type == "APPLY_PARAGRAPH_FORMATTING" and 
-                    target.get("text_to_find") and rules):
-                valid_instructions.append(item)
-                
-            # Валидация для форматирования текста
-            elif (op_type == "APPLY_TEXT_FORMATTING" and 
-                  target.get("text_to_find") and 
-                  params.get("apply_to_text_segment") and rules):
-                valid_instructions.append(item)
+def _intent_result(payload: dict, branch_state: GraphState) -> dict:
+    """Ветвь возвращает только свой результат: общие ключи состояния параллельные ветви не пишут."""
+    intent = payload["intent"]
+    return {"intent_results": [{
+        "position": intent["position"], "category": intent["category"], "query": intent["query"],
+        "instructions": branch_state.get("extracted_instructions") or [],
+        "system_message": branch_state.get("system_message"),
+    }]}
 
-        state["extracted_instructions"] = valid_instructions if valid_instructions else None
-        if not valid_instructions:
-            state["system_message"] = "Не удалось извлечь корректные детали для форматирования."
-            
-    elif isinstance(response_json_list, dict) and "error" in response_json_list:
-        state["system_message"] = f"Ошибка LLM при извлечении деталей форматирования: {response_json_list['error']}"
-        state["extracted_instructions"] = None
+def extract_intent_node(payload: dict) -> dict:
+    """Ветвь составного запроса: извлечение деталей для одного подзапроса (payload передается через Send)."""
+    logger.info(f">>> Вход в extract_intent_node, подзапрос {payload['intent']['position']}")
+    branch_state = _intent_state(payload)
+    return _intent_result(payload, _extract_details(branch_state, payload["intent"]["category"]))
+
+async def aextract_intent_node(payload: dict) -> dict:
+    logger.info(f">>> Вход в extract_intent_node (async), подзапрос {payload['intent']['position']}")
+    branch_state = _intent_state(payload)
+    return _intent_result(payload, await _aextract_details(branch_state, payload["intent"]["category"]))
+
+def merge_intents_node(state: GraphState) -> GraphState:
+    """Объединяет инструкции всех подзапросов в один пакет для подтверждения (в порядке подзапросов)."""
+    logger.info(">>> Вход в merge_intents_node")
+    results = sorted(state.get("intent_results") or [], key=lambda result: result["position"])
+    handled = {result["position"] for result in results}
+    instructions = [instruction for result in results for instruction in result["instructions"]]
+
+    problems = [f"«{result['query']}»: {(result['system_message'] or 'инструкции не извлечены').rstrip('.')}"
+                for result in results if not result["instructions"]]
+    # Подзапросы без узла извлечения (уточнение, неизвестная операция) в ветви не отправлялись
+    problems += [f"«{intent['query']}»: такую операцию выполнить не могу"
+                 for intent in state.get("intents") or [] if intent["position"] not in handled]
+
+    state["extracted_instructions"] = instructions or None
+    state["system_message"] = None
+    if problems:
+        prefix = "Часть запроса не удалось обработать" if instructions else "Не удалось обработать запрос"
+        state["system_message"] = f"{prefix}: " + "; ".join(problems) + "."
+    logger.info(f"Составной запрос: инструкций {len(instructions)} из {len(results)} подзапрос(ов).")
+    return state
+
+def _clarification_prompt(state: GraphState) -> str:
+    return prompts.GENERATE_CLARIFICATION_QUESTION_PROMPT.format(user_query=state["current_user_query"])
+
+def _clarification_result(state: GraphState, response_json) -> GraphState:
+    if isinstance(response_json, dict) and "clarification_question" in response_json:
+        state["clarification_question"] = response_json["clarification_question"]
+        logger.info(f"Сгенерирован уточняющий вопрос: {state['clarification_question']}")
     else:
-        state["system_message"] = "Не удалось извлечь детали для форматирования (неверный формат ответа LLM)."
-        state["extracted_instructions"] = None
-        
-    logger.info(f"Извлеченные инструкции для форматирования: {state.get('extracted_instructions')}")
+        state["clarification_question"] = "Не могли бы вы уточнить ваш запрос?"
+        logger.warning(f"Не удалось сгенерировать уточняющий вопрос, получен ответ: {response_json}")
+    state["extracted_instructions"] = None
     return state
 
+def clarification_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в clarification_node")
+    return _clarification_result(state, invoke_gemini_json_mode(_clarification_prompt(state)))
+
+async def aclarification_node(state: GraphState) -> GraphState:
+    logger.info(">>> Вход в clarification_node (async)")
+    return _clarification_result(state, await ainvoke_gemini_json_mode(_clarification_prompt(state)))
+
 def unknown_operation_node(state: GraphState) -> GraphState:
     logger.info(">>> Вход в unknown_operation_node")
     state["system_message"] = "К сожалению, я не понял ваш запрос или не могу выполнить такую операцию. Пожалуйста, попробуйте переформулировать."
@@ -214,24 +389,29 @@ def unknown_operation_node(state: GraphState) -> GraphState:
 
 def tool_execution_node(state: GraphState) -> GraphState:
     logger.info(">>> Вход в tool_execution_node")
-    from core.docx_modifier import modify_document_with_structured_instructions
+    from core.docx_modifier import apply_instruction_plan
+    from core.batch_planner import plan_instructions
+    from core.docx_save import save_document_incremental
+    from core.blob_store import get_blob_store
     
     instructions = state.get("extracted_instructions")
-    current_doc_bytes = state.get("document_bytes")
+    current_version = state.get("document_version")
+    store = get_blob_store()
 
-    if not instructions or not current_doc_bytes:
+    if not instructions or not store.exists(current_version):
         state["system_message"] = "Нет инструкций для выполнения или документ не загружен."
         logger.warning("tool_execution_node: Нет инструкций или документа.")
         return state
 
     try:
-        doc_obj = Document(BytesIO(current_doc_bytes))
-        success = modify_document_with_structured_instructions(doc_obj, instructions)
+        source_path = store.path(current_version)
+        with telemetry.span("docx_parse"):
+            doc_obj = Document(source_path)
+        success = apply_instruction_plan(doc_obj, plan_instructions(doc_obj, instructions))
         
         if success:
-            bio = BytesIO()
-            doc_obj.save(bio)
-            state["document_bytes"] = bio.getvalue()
+            # Неизмененные части (изображения и т.п.) копируются из исходного архива без пересжатия
+            state["document_version"] = store.put(save_document_incremental(doc_obj, source_path))
             state["system_message"] = "Изменения успешно применены."
             logger.info("Изменения успешно применены к документу.")
         else:
@@ -243,4 +423,8 @@ def tool_execution_node(state: GraphState) -> GraphState:
         state["system_message"] = f"Ошибка при применении изменений: {e}"
     
     state["extracted_instructions"] = None
-    return state
\ No newline at end of file
+    return state
+
+async def atool_execution_node(state: GraphState) -> GraphState:
+    """Применение правок - работа процессора, а не ожидание: выполняется в отдельном потоке, не блокируя цикл событий."""
+    return await asyncio.to_thread(tool_execution_node, state)
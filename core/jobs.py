@@ -0,0 +1,234 @@
+# core/jobs.py
+"""
+Задания HTTP-сервиса (job_server.py): хранилище заданий в SQLite и их выполнение в процессах пула.
+
+Задание - документ (версия в BlobStore) и либо запрос на естественном языке (kind="query":
+граф build_graph извлекает инструкции, затем они применяются), либо готовые инструкции
+(kind="instructions": modify_document_with_structured_instructions без LLM). Результат -
+новая версия документа в BlobStore и JSON с инструкциями и отчетом по ним.
+
+Хранилище общее для сервера и процессов пула: каждый процесс открывает свое соединение,
+база работает в режиме WAL. Ход выполнения записывается событиями (job_events), по которым
+сервер отдает поток статуса.
+"""
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from docx import Document
+from loguru import logger
+
+from . import telemetry
+from .blob_store import get_blob_store
+
+DEFAULT_JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "docx_agent_jobs.sqlite3"))
+
+KIND_QUERY = "query"
+KIND_INSTRUCTIONS = "instructions"
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    request TEXT NOT NULL,
+    input_version TEXT NOT NULL,
+    output_version TEXT,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    at REAL NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+
+class JobStore:
+    """Задания и события их выполнения в SQLite."""
+
+    def __init__(self, path: str = DEFAULT_JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def create(self, kind: str, request: dict, input_version: str) -> str:
+        job_id = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO jobs (id, kind, status, request, input_version, created) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job_id, kind, STATUS_QUEUED, json.dumps(request, ensure_ascii=False), input_version, time.time()))
+        self.add_event(job_id, "status", {"status": STATUS_QUEUED})
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            columns = [c[0] for c in cursor.description]
+        if row is None:
+            return None
+        job = dict(zip(columns, row))
+        job["request"] = json.loads(job["request"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def set_status(self, job_id: str, status: str, **fields: Any) -> None:
+        """Меняет статус задания и записывает событие; started/finished проставляются автоматически."""
+        now = time.time()
+        if status == STATUS_RUNNING: fields["started"] = now
+        if status in FINAL_STATUSES: fields["finished"] = now
+        if "result" in fields: fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        assignments = ", ".join(f"{name} = ?" for name in ["status", *fields])
+        with self._transaction() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (status, *fields.values(), job_id))
+        self.add_event(job_id, "status", {"status": status, "error": fields.get("error")})
+
+    def add_event(self, job_id: str, event_type: str, data: dict) -> None:
+        with self._transaction() as conn:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE job_id = ?", (job_id,)).fetchone()[0]
+            conn.execute("INSERT INTO job_events (job_id, seq, at, type, data) VALUES (?, ?, ?, ?, ?)",
+                         (job_id, seq, time.time(), event_type, json.dumps(data, ensure_ascii=False)))
+
+    def events(self, job_id: str, after: int = 0) -> List[dict]:
+        """События задания с номером больше after, по порядку."""
+        with self._lock:
+            rows = self._conn.execute("SELECT seq, at, type, data FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                                      (job_id, after)).fetchall()
+        return [{"seq": seq, "at": at, "type": event_type, "data": json.loads(data)} for seq, at, event_type, data in rows]
+
+    def fail_unfinished(self, reason: str) -> int:
+        """Помечает ошибкой задания, оставшиеся в очереди или в работе (после перезапуска сервера)."""
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute("SELECT id FROM jobs WHERE status IN (?, ?)", (STATUS_QUEUED, STATUS_RUNNING))]
+        for job_id in ids:
+            self.set_status(job_id, STATUS_FAILED, error=reason)
+        return len(ids)
+
+
+_default_store: Optional[JobStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    """Общее для процесса хранилище заданий (создается при первом обращении)."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = JobStore()
+        return _default_store
+
+
+# --- Выполнение (в процессе пула) ---
+
+_graph = None
+
+
+def _get_graph():
+    """Граф собирается один раз на процесс пула."""
+    global _graph
+    if _graph is None:
+        from .llm_handler import build_graph
+        _graph = build_graph()
+    return _graph
+
+
+def _extract_instructions(job_id: str, store: JobStore, doc: Document, query: str, version: str) -> dict:
+    """Запрос через граф, как в app.py: узлы и инструкции по мере генерации пишутся событиями."""
+    from .async_runtime import iterate_async
+    from .docx_utils import extract_text_from_doc
+    from .state import GraphState
+
+    initial_state = GraphState(
+        original_user_query=query, current_user_query=query,
+        document_content_text=extract_text_from_doc(doc), document_version=version,
+        extracted_instructions=None, clarification_question=None, system_message=None, next_node_to_call=None
+    )
+    final_state = {}
+    events = _get_graph().astream(initial_state, {"recursion_limit": 15}, stream_mode=["custom", "updates", "values"])
+    for mode, chunk in iterate_async(events):
+        if mode == "values":
+            final_state = chunk
+        elif mode == "updates":
+            store.add_event(job_id, "node", {"nodes": list(chunk)})
+        elif isinstance(chunk, dict) and "instruction" in chunk:
+            store.add_event(job_id, "instruction", {"instruction": chunk["instruction"]})
+    return final_state
+
+
+def run_job(job_id: str) -> str:
+    """Выполняет задание (вызывается в процессе пула). Возвращает итоговый статус."""
+    from .batch_planner import plan_instructions
+    from .docx_modifier import apply_instruction_plan, modify_document_with_structured_instructions
+    from .docx_save import save_document_incremental
+
+    store = get_job_store()
+    job = store.get(job_id)
+    if job is None or job["status"] != STATUS_QUEUED:
+        return job["status"] if job else STATUS_FAILED
+    store.set_status(job_id, STATUS_RUNNING)
+    blobs = get_blob_store()
+    request = job["request"]
+    try:
+        with telemetry.trace_request(f"job_{job['kind']}", job_id=job_id) as trace:
+            source_path = blobs.path(job["input_version"])
+            with telemetry.span("docx_parse"):
+                doc = Document(source_path)
+            result = {"report": []}
+            if job["kind"] == KIND_QUERY:
+                final_state = _extract_instructions(job_id, store, doc, request["query"], job["input_version"])
+                instructions = final_state.get("extracted_instructions") or []
+                result.update(instructions=instructions,
+                              clarification_question=final_state.get("clarification_question"),
+                              system_message=final_state.get("system_message"))
+                success = False
+                if instructions and request.get("apply", True):
+                    with telemetry.span("plan"):
+                        plan = plan_instructions(doc, instructions)
+                    success = apply_instruction_plan(doc, plan, report=result["report"])
+            else:
+                instructions = request["instructions"]
+                result["instructions"] = instructions
+                success = modify_document_with_structured_instructions(doc, instructions, report=result["report"])
+            output_version = blobs.put(save_document_incremental(doc, source_path)) if success else None
+        result["applied"] = success
+        result["trace"] = trace.summary()
+        store.set_status(job_id, STATUS_DONE, output_version=output_version, result=result)
+        return STATUS_DONE
+    except Exception as e:
+        logger.error(f"Задание {job_id} завершилось ошибкой: {e}", exc_info=True)
+        store.set_status(job_id, STATUS_FAILED, error=f"{type(e).__name__}: {e}")
+        return STATUS_FAILED
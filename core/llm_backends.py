@@ -0,0 +1,368 @@
+# core/llm_backends.py
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from loguru import logger
+
+from . import prompts
+
+# Модель для вызовов LLM: gemini (по умолчанию), record (gemini с записью ответов в файл),
+# replay (ответы из файла, без сети), stub (ответы по правилам, без сети)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_FIXTURES_PATH = os.getenv("LLM_FIXTURES_PATH", "llm_fixtures.jsonl")
+# Задержка ответа при воспроизведении: число миллисекунд или "recorded" - как при записи
+LLM_REPLAY_LATENCY_MS = os.getenv("LLM_REPLAY_LATENCY_MS", "0")
+LLM_REPLAY_JITTER_MS = float(os.getenv("LLM_REPLAY_JITTER_MS", "0"))
+# Нет записи для промпта: error - ошибка, stub - ответ по правилам
+LLM_REPLAY_MISSING = os.getenv("LLM_REPLAY_MISSING", "error")
+# Размер фрагментов, на которые режется ответ при потоковом воспроизведении
+STREAM_CHUNK_CHARS = 40
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class FixtureStore:
+    """
+    Записанные пары промпт -> ответ в файле JSONL: одна строка
+    {"key", "prompt", "response", "latency_ms"} на ответ. Запись только дописывает строку,
+    при загрузке для повторяющегося промпта берется последний ответ.
+    """
+
+    def __init__(self, path: str = LLM_FIXTURES_PATH):
+        self.path = path
+        self._entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry["key"]] = entry
+                    except (json.JSONDecodeError, KeyError) as e:
+                        logger.warning(f"FixtureStore: строка {line_number} файла {path} пропущена ({e}).")
+        logger.info(f"FixtureStore: {len(self._entries)} записанных ответов в {path}.")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, prompt: str) -> Optional[dict]:
+        return self._entries.get(prompt_key(prompt))
+
+    def add(self, prompt: str, response: str, latency_ms: float) -> None:
+        entry = {"key": prompt_key(prompt), "prompt": prompt, "response": response, "latency_ms": round(latency_ms, 1)}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._entries[entry["key"]] = entry
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+def _chunks(text: str, size: int = STREAM_CHUNK_CHARS) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+
+class FakeChatModel(abc.ABC):
+    """
+    Основа моделей без сети: тот же интерфейс, что использует llm_invoker у ChatGoogleGenerativeAI
+    (invoke/ainvoke/stream/astream со строкой промпта, параметры генерации для ключа кэша).
+    Подклассы реализуют _respond(prompt) -> (текст ответа, задержка в секундах).
+    """
+
+    requires_api_key = False
+    temperature = None
+    top_p = None
+    top_k = None
+    max_output_tokens = None
+    safety_settings: dict = {}
+
+    def __init__(self, model: str):
+        self.model = model
+        self.calls = 0
+
+    @abc.abstractmethod
+    def _respond(self, prompt: str) -> Tuple[str, float]:
+        """Текст ответа на промпт и задержка в секундах перед ним."""
+
+    def _next(self, prompt: str) -> Tuple[str, float]:
+        self.calls += 1
+        return self._respond(prompt)
+
+    def invoke(self, prompt: str, **kwargs: Any) -> AIMessage:
+        text, delay = self._next(prompt)
+        if delay > 0:
+            time.sleep(delay)
+        return AIMessage(content=text)
+
+    async def ainvoke(self, prompt: str, **kwargs: Any) -> AIMessage:
+        text, delay = self._next(prompt)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return AIMessage(content=text)
+
+    def stream(self, prompt: str, **kwargs: Any) -> Iterator[AIMessageChunk]:
+        text, delay = self._next(prompt)
+        parts = _chunks(text)
+        for part in parts:
+            if delay > 0:
+                time.sleep(delay / len(parts))
+            yield AIMessageChunk(content=part)
+
+    async def astream(self, prompt: str, **kwargs: Any) -> AsyncIterator[AIMessageChunk]:
+        text, delay = self._next(prompt)
+        parts = _chunks(text)
+        for part in parts:
+            if delay > 0:
+                await asyncio.sleep(delay / len(parts))
+            yield AIMessageChunk(content=part)
+
+
+# --- Модель по правилам ---
+
+_QUERY_RE = re.compile(r'Запрос пользователя: "(.*)"\s*$', re.MULTILINE)
+_CLARIFICATION_QUERY_RE = re.compile(r'неоднозначен: "(.*)"')
+_QUOTED_RE = re.compile(r"[«\"'“„](.+?)[»\"'”“]")
+_INTENT_SPLIT_RE = re.compile(r"\s*(?:;|,\s*(?:а\s+)?(?:затем\s+|потом\s+)?|\s+и\s+(?:затем\s+|потом\s+)?)(?=\w)")
+
+# Ключевые слова (начала слов) категорий запроса, в порядке проверки
+CATEGORY_KEYWORDS = [
+    ("REPLACE_TEXT", ("замен", "измени", "исправ", "поменя")),
+    ("INSERT_TEXT", ("встав", "добав", "допиш")),
+    ("DELETE_ELEMENT", ("удал", "убер", "вычеркн")),
+    ("APPLY_FORMATTING", ("жирн", "курсив", "подчеркн", "выровн", "выдел", "шрифт", "формат", "центр")),
+]
+_FORMATTING_RULES = [
+    (("жирн",), {"style": "bold", "value": True}),
+    (("курсив",), {"style": "italic", "value": True}),
+    (("подчеркн",), {"style": "underline", "value": True}),
+]
+_ALIGNMENTS = [("центр", "center"), ("прав", "right"), ("лев", "left"), ("ширин", "justify")]
+
+
+def _first_line(template: str) -> str:
+    return template.strip().split("\n")[0]
+
+
+def classify_query(query: str) -> str:
+    lowered = query.lower()
+    for category, stems in CATEGORY_KEYWORDS:
+        if any(stem in lowered for stem in stems):
+            return category
+    return "UNKNOWN_OPERATION"
+
+
+def split_intents(query: str) -> List[dict]:
+    """Подзапросы: части запроса между "и", запятыми и точкой с запятой, у каждой своя категория."""
+    fragments = [part.strip() for part in _INTENT_SPLIT_RE.split(query) if part and part.strip()]
+    intents = []
+    for fragment in fragments:
+        category = classify_query(fragment)
+        if category == "UNKNOWN_OPERATION" and intents:
+            # Часть без своего глагола ("замени A на B и C на D") относится к предыдущему действию
+            intents[-1]["query"] += f" и {fragment}"
+            continue
+        intents.append({"category": category, "query": fragment})
+    return intents or [{"category": "UNKNOWN_OPERATION", "query": query}]
+
+
+def instructions_for(category: str, query: str) -> List[dict]:
+    """Инструкции для запроса по его кавычкам и ключевым словам; пустой список - извлечь не удалось."""
+    quoted = _QUOTED_RE.findall(query)
+    lowered = query.lower()
+    if category == "REPLACE_TEXT" and len(quoted) >= 2:
+        return [{"operation_type": "REPLACE_TEXT",
+                 "target_description": {"text_to_find": None, "placeholder": None},
+                 "parameters": {"old_text": quoted[0], "new_text": quoted[1]}}]
+    if category == "INSERT_TEXT" and len(quoted) >= 2:
+        position = "after_paragraph"
+        if "перед" in lowered:
+            position = "before_paragraph"
+        elif "в начал" in lowered:
+            position = "start_of_paragraph"
+        elif "в конец" in lowered or "в конце" in lowered:
+            position = "end_of_paragraph"
+        return [{"operation_type": "INSERT_TEXT",
+                 "target_description": {"text_to_find": quoted[1]},
+                 "parameters": {"text_to_insert": quoted[0], "position": position}}]
+    if category == "DELETE_ELEMENT" and quoted:
+        return [{"operation_type": "DELETE_ELEMENT",
+                 "target_description": {"element_type": "paragraph", "text_to_find": quoted[0]},
+                 "parameters": {}}]
+    if category == "APPLY_FORMATTING" and quoted:
+        rules = [rule for stems, rule in _FORMATTING_RULES if any(stem in lowered for stem in stems)]
+        if rules:
+            return [{"operation_type": "APPLY_TEXT_FORMATTING",
+                     "target_description": {"text_to_find": quoted[0]},
+                     "parameters": {"apply_to_text_segment": quoted[0], "formatting_rules": rules}}]
+        alignment = next((value for stem, value in _ALIGNMENTS if stem in lowered), None)
+        if alignment:
+            return [{"operation_type": "APPLY_PARAGRAPH_FORMATTING",
+                     "target_description": {"text_to_find": quoted[0]},
+                     "parameters": {"formatting_rules": [{"style": "alignment", "value": alignment}]}}]
+    return []
+
+
+class RuleBasedChatModel(FakeChatModel):
+    """
+    Детерминированная модель без сети: тип промпта определяется по его первой строке,
+    категория запроса - по ключевым словам, параметры правки - по фразам в кавычках
+    ("замени 'A' на 'B'", "удали абзац 'X'", "сделай 'Y' жирным"). Для прогонов графа целиком,
+    нагрузочных тестов и бенчмарков; задержку ответа можно задать (latency_ms, jitter_ms).
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, seed: Optional[int] = 0):
+        super().__init__(model="stub/rule-based")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self._random = random.Random(seed)
+        self._handlers: List[Tuple[str, Callable[[str], Any]]] = [
+            (_first_line(prompts.REPAIR_JSON_RESPONSE_PROMPT), lambda prompt: {}),
+            (_first_line(prompts.CATEGORIZE_AND_EXTRACT_PROMPT), self._categorize_and_extract),
+            (_first_line(prompts.CATEGORIZE_REQUEST_PROMPT), self._categorize),
+            (_first_line(prompts.EXTRACT_REPLACEMENT_DETAILS_PROMPT), lambda p: instructions_for("REPLACE_TEXT", self._query(p))),
+            (_first_line(prompts.EXTRACT_INSERTION_DETAILS_PROMPT), lambda p: instructions_for("INSERT_TEXT", self._query(p))),
+            (_first_line(prompts.EXTRACT_DELETION_DETAILS_PROMPT), lambda p: instructions_for("DELETE_ELEMENT", self._query(p))),
+            (_first_line(prompts.EXTRACT_FORMATTING_DETAILS_PROMPT), lambda p: instructions_for("APPLY_FORMATTING", self._query(p))),
+            (_first_line(prompts.GENERATE_CLARIFICATION_QUESTION_PROMPT).split("{")[0],
+             lambda p: {"clarification_question": "Уточните, пожалуйста, что именно и где нужно изменить?"}),
+        ]
+
+    @staticmethod
+    def _query(prompt: str) -> str:
+        match = _QUERY_RE.search(prompt) or _CLARIFICATION_QUERY_RE.search(prompt)
+        return match.group(1) if match else ""
+
+    def _categorize(self, prompt: str) -> dict:
+        intents = split_intents(self._query(prompt))
+        return {"category": intents[0]["category"], "intents": intents}
+
+    def _categorize_and_extract(self, prompt: str) -> dict:
+        intents = split_intents(self._query(prompt))
+        if len(intents) > 1:
+            # Составной запрос быстрый путь не извлекает: его разбирает полный путь по подзапросам
+            return {"category": intents[0]["category"], "instructions": []}
+        query = intents[0]["query"]
+        return {"category": intents[0]["category"], "instructions": instructions_for(intents[0]["category"], query)}
+
+    def _respond(self, prompt: str) -> Tuple[str, float]:
+        head = prompt.strip().split("\n")[0]
+        response: Any = {"error": "stub: неизвестный промпт"}
+        for first_line, handler in self._handlers:
+            if head.startswith(first_line):
+                response = handler(prompt)
+                break
+        else:
+            logger.warning(f"RuleBasedChatModel: промпт не распознан: {head[:100]}")
+        delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        return json.dumps(response, ensure_ascii=False), delay
+
+
+# --- Запись и воспроизведение ---
+
+class ReplayChatModel(FakeChatModel):
+    """
+    Ответы из файла, записанного RecordingChatModel, без сети. latency_ms - задержка каждого
+    ответа (None - задержка, измеренная при записи), jitter_ms - случайный разброс.
+    Для промпта без записи - ошибка LookupError или, если задан fallback, его ответ.
+    """
+
+    def __init__(self, path: str = LLM_FIXTURES_PATH, latency_ms: Optional[float] = 0.0, jitter_ms: float = 0.0,
+                 fallback: Optional[FakeChatModel] = None, seed: Optional[int] = 0):
+        super().__init__(model=f"replay/{os.path.basename(path)}")
+        self.store = FixtureStore(path)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fallback = fallback
+        self.misses = 0
+        self._random = random.Random(seed)
+
+    def _respond(self, prompt: str) -> Tuple[str, float]:
+        entry = self.store.get(prompt)
+        if entry is None:
+            self.misses += 1
+            if self.fallback is None:
+                raise LookupError(f"Нет записанного ответа для промпта {prompt_key(prompt)[:12]} "
+                                  f"(начало: {prompt.strip()[:80]!r}).")
+            return self.fallback._respond(prompt)
+        latency = entry.get("latency_ms", 0.0) if self.latency_ms is None else self.latency_ms
+        delay = max(0.0, latency + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        return entry["response"], delay
+
+
+class RecordingChatModel:
+    """
+    Обертка над настоящей моделью: вызовы проходят к ней, а каждый полученный ответ
+    (и полностью прочитанный поток) записывается в FixtureStore вместе с задержкой.
+    Параметры модели (имя, температура и т.д.) берутся у обернутой модели.
+    """
+
+    def __init__(self, inner: Any, path: str = LLM_FIXTURES_PATH):
+        self.inner = inner
+        self.store = FixtureStore(path)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    @property
+    def requires_api_key(self) -> bool:
+        return getattr(self.inner, "requires_api_key", True)
+
+    def invoke(self, prompt: str, **kwargs: Any) -> AIMessage:
+        started = time.monotonic()
+        message = self.inner.invoke(prompt, **kwargs)
+        self.store.add(prompt, message.content, (time.monotonic() - started) * 1000)
+        return message
+
+    async def ainvoke(self, prompt: str, **kwargs: Any) -> AIMessage:
+        started = time.monotonic()
+        message = await self.inner.ainvoke(prompt, **kwargs)
+        self.store.add(prompt, message.content, (time.monotonic() - started) * 1000)
+        return message
+
+    def stream(self, prompt: str, **kwargs: Any) -> Iterator[Any]:
+        started = time.monotonic()
+        parts = []
+        for chunk in self.inner.stream(prompt, **kwargs):
+            parts.append(chunk.content if isinstance(chunk.content, str) else "")
+            yield chunk
+        self.store.add(prompt, "".join(parts), (time.monotonic() - started) * 1000)
+
+    async def astream(self, prompt: str, **kwargs: Any) -> AsyncIterator[Any]:
+        started = time.monotonic()
+        parts = []
+        async for chunk in self.inner.astream(prompt, **kwargs):
+            parts.append(chunk.content if isinstance(chunk.content, str) else "")
+            yield chunk
+        self.store.add(prompt, "".join(parts), (time.monotonic() - started) * 1000)
+
+
+def create_llm_backend(backend: str = LLM_BACKEND, gemini_factory: Optional[Callable[[], Any]] = None) -> Any:
+    """Модель по имени режима (см. LLM_BACKEND); gemini_factory создает настоящую модель для gemini и record."""
+    if backend == "stub":
+        return RuleBasedChatModel(latency_ms=float(LLM_REPLAY_LATENCY_MS) if LLM_REPLAY_LATENCY_MS != "recorded" else 0.0,
+                                  jitter_ms=LLM_REPLAY_JITTER_MS)
+    if backend == "replay":
+        latency = None if LLM_REPLAY_LATENCY_MS == "recorded" else float(LLM_REPLAY_LATENCY_MS)
+        fallback = RuleBasedChatModel() if LLM_REPLAY_MISSING == "stub" else None
+        return ReplayChatModel(LLM_FIXTURES_PATH, latency_ms=latency, jitter_ms=LLM_REPLAY_JITTER_MS, fallback=fallback)
+    if gemini_factory is None:
+        raise ValueError(f"Для режима LLM_BACKEND={backend} нужна фабрика настоящей модели.")
+    if backend == "record":
+        return RecordingChatModel(gemini_factory(), LLM_FIXTURES_PATH)
+    if backend != "gemini":
+        logger.warning(f"Неизвестный LLM_BACKEND={backend}, используется gemini.")
+    return gemini_factory()
@@ -0,0 +1,151 @@
+# core/llm_cache.py
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from loguru import logger
+
+DEFAULT_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "docx_agent_llm_cache.sqlite3"))
+DEFAULT_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_MB", "64")) * 1024 * 1024
+# Ответы старше этого срока не используются и удаляются (по умолчанию неделя)
+DEFAULT_MAX_AGE_SECONDS = int(os.getenv("LLM_CACHE_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") not in ("0", "false", "False", "")
+# Вытеснение проверяется не на каждой записи, а раз в столько записей
+EVICT_EVERY_PUTS = 50
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access);
+"""
+
+
+def make_cache_key(model: str, prompt: str, settings: dict) -> str:
+    """Ключ ответа: модель, хэш точного текста промпта и параметры генерации."""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    payload = json.dumps({"model": model, "prompt": prompt_hash, "settings": settings},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Кэш разобранных JSON-ответов LLM на диске (SQLite). Хранятся только успешно разобранные ответы.
+    Запись живет не дольше max_age секунд с момента создания; при превышении max_bytes
+    вытесняются записи, к которым дольше всего не обращались (LRU по last_access).
+    Счетчики попаданий/промахов ведутся в памяти процесса.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age_seconds: int = DEFAULT_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, key: str) -> Optional[Any]:
+        """Разобранный ответ или None (нет записи или она устарела)."""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.max_age_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, response: Any) -> None:
+        """Сохраняет разобранный ответ (значение должно сериализоваться в JSON)."""
+        data = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, data, len(data.encode("utf-8")), now, now),
+            )
+        self.stores += 1
+        if self.stores % EVICT_EVERY_PUTS == 1:
+            self.evict()
+
+    def evict(self) -> int:
+        """Удаляет устаревшие записи, затем самые давно использованные сверх max_bytes. Возвращает число удаленных."""
+        with self._transaction() as conn:
+            removed = conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_seconds,)).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                victims = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                    victims.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                removed += len(victims)
+        if removed:
+            logger.debug(f"LLMResponseCache: удалено записей: {removed}.")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "stores": self.stores, "entries": entries, "bytes": total}
+
+    def clear(self) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+_default_cache: Optional[LLMResponseCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """Общий для процесса кэш ответов (None, если кэш отключен через LLM_CACHE_ENABLED=0 или недоступен)."""
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            try:
+                _default_cache = LLMResponseCache()
+            except sqlite3.Error as e:
+                logger.warning(f"LLMResponseCache: кэш недоступен ({e}), ответы не кэшируются.")
+                return None
+        return _default_cache
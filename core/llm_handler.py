@@ -1,20 +1,40 @@
 # core/llm_handler.py
 from langgraph.graph import StateGraph, END
+from langgraph.types import Send
+from langchain_core.runnables import RunnableLambda
 from loguru import logger
+from typing import Optional
 import os
 
 from .state import GraphState
+from . import telemetry
 from .graph_nodes import (
-    categorize_request_node,
-    extract_replacement_details_node,
-    extract_insertion_details_node,
-    extract_deletion_details_node,
-    extract_formatting_details_node,
-    clarification_node,
+    categorize_request_node, acategorize_request_node,
+    categorize_and_extract_node, acategorize_and_extract_node,
+    extract_replacement_details_node, aextract_replacement_details_node,
+    extract_insertion_details_node, aextract_insertion_details_node,
+    extract_deletion_details_node, aextract_deletion_details_node,
+    extract_formatting_details_node, aextract_formatting_details_node,
+    clarification_node, aclarification_node,
     unknown_operation_node,
-    tool_execution_node,
+    extract_intent_node, aextract_intent_node,
+    merge_intents_node,
+    CATEGORY_VALIDATORS,
+    tool_execution_node, atool_execution_node,
 )
 
+# Быстрый путь по умолчанию: категория и инструкции одним вызовом LLM (GRAPH_FAST_PATH=1)
+FAST_PATH_DEFAULT = os.getenv("GRAPH_FAST_PATH", "0") not in ("0", "false", "False", "")
+
+def _node(func, afunc=None):
+    """
+    Узел с синхронным и асинхронным вариантами: graph.invoke вызывает func, graph.ainvoke - afunc.
+    Оба варианта замеряются core.telemetry под именем узла (имя функции без суффикса _node).
+    """
+    name = func.__name__.removesuffix("_node")
+    return RunnableLambda(telemetry.instrument_node(name, func), afunc=telemetry.instrument_node(name, afunc),
+                          name=func.__name__)
+
 # --- Маршрутизаторы ---
 
 def route_after_categorization(state: GraphState):
@@ -23,6 +43,20 @@ def route_after_categorization(state: GraphState):
     """
     category = state.get("next_node_to_call")
     logger.info(f"Маршрутизация после категоризации, категория: {category}")
+
+    # Составной запрос: подзапросы с операциями извлекаются параллельно, каждый в своей ветви
+    branches = [intent for intent in state.get("intents") or [] if intent["category"] in CATEGORY_VALIDATORS]
+    if branches:
+        logger.info(f"Составной запрос: параллельное извлечение для {len(branches)} подзапрос(ов).")
+        return [
+            Send("extract_intent", {
+                "original_user_query": state["original_user_query"],
+                "document_content_text": state["document_content_text"],
+                "document_version": state.get("document_version"),
+                "intent": intent,
+            })
+            for intent in branches
+        ]
     
     # Словарь маршрутов для чистоты кода
     routing_map = {
@@ -61,28 +95,65 @@ def route_after_extraction(state: GraphState):
         return END
 
 
+def route_after_fast_path(state: GraphState):
+    """
+    Маршрутизатор ПОСЛЕ быстрого пути. Проверенные инструкции идут на подтверждение,
+    категории без инструкций - в свои обработчики, все остальное - на обычный путь.
+    """
+    if state.get("extracted_instructions"):
+        logger.info("Быстрый путь: инструкции извлечены. Остановка для подтверждения пользователем.")
+        return "awaiting_confirmation"
+    if state.get("next_node_to_call") is None:
+        return "categorize_request"
+    return route_after_categorization(state)
+
+
 # --- Построение графа ---
-def build_graph():
-    """Собирает и компилирует граф LangGraph."""
+def build_graph(fast_path: Optional[bool] = None):
+    """
+    Собирает и компилирует граф LangGraph. Граф поддерживает и invoke, и ainvoke:
+    при ainvoke узлы вызывают LLM асинхронно (см. core.async_runtime).
+    fast_path=True - сначала один объединенный вызов LLM (категория + инструкции); обычный
+    двухшаговый путь используется, только если его ответ не прошел проверку.
+    По умолчанию режим берется из переменной окружения GRAPH_FAST_PATH.
+    """
+    if fast_path is None:
+        fast_path = FAST_PATH_DEFAULT
     workflow = StateGraph(GraphState)
 
     # 1. Добавляем все узлы в граф
-    workflow.add_node("categorize_request", categorize_request_node)
-    workflow.add_node("extract_replacement_details", extract_replacement_details_node)
-    workflow.add_node("extract_insertion_details", extract_insertion_details_node)
-    workflow.add_node("extract_deletion_details", extract_deletion_details_node)
-    workflow.add_node("extract_formatting_details", extract_formatting_details_node)
-    workflow.add_node("clarification_handler", clarification_node)
-    workflow.add_node("unknown_operation_handler", unknown_operation_node)
+    workflow.add_node("categorize_request", _node(categorize_request_node, acategorize_request_node))
+    workflow.add_node("extract_replacement_details", _node(extract_replacement_details_node, aextract_replacement_details_node))
+    workflow.add_node("extract_insertion_details", _node(extract_insertion_details_node, aextract_insertion_details_node))
+    workflow.add_node("extract_deletion_details", _node(extract_deletion_details_node, aextract_deletion_details_node))
+    workflow.add_node("extract_formatting_details", _node(extract_formatting_details_node, aextract_formatting_details_node))
+    workflow.add_node("clarification_handler", _node(clarification_node, aclarification_node))
+    workflow.add_node("unknown_operation_handler", _node(unknown_operation_node))
+    workflow.add_node("extract_intent", _node(extract_intent_node, aextract_intent_node))
+    workflow.add_node("merge_intents", _node(merge_intents_node))
     
     # Узел выполнения теперь будет вызываться из UI, но он все еще часть графа
-    workflow.add_node("tool_executor", tool_execution_node)
+    workflow.add_node("tool_executor", _node(tool_execution_node, atool_execution_node))
     
     # Добавляем узел-заглушку, который служит точкой остановки для подтверждения
     workflow.add_node("awaiting_confirmation", lambda state: state)
 
     # 2. Устанавливаем точку входа
-    workflow.set_entry_point("categorize_request")
+    if fast_path:
+        workflow.add_node("categorize_and_extract", _node(categorize_and_extract_node, acategorize_and_extract_node))
+        workflow.set_entry_point("categorize_and_extract")
+        workflow.add_conditional_edges(
+            "categorize_and_extract",
+            route_after_fast_path,
+            {
+                "awaiting_confirmation": "awaiting_confirmation",
+                "categorize_request": "categorize_request",
+                "clarification_handler": "clarification_handler",
+                "unknown_operation_handler": "unknown_operation_handler",
+            }
+        )
+    else:
+        workflow.set_entry_point("categorize_request")
 
     # 3. Определяем условные ребра после категоризации
     workflow.add_conditional_edges(
@@ -96,6 +167,7 @@ def build_graph():
             "extract_formatting_details": "extract_formatting_details",
             "clarification_handler": "clarification_handler",
             "unknown_operation_handler": "unknown_operation_handler",
+            "extract_intent": "extract_intent",  # ветви составного запроса (Send)
         }
     )
     
@@ -105,6 +177,7 @@ def build_graph():
         "extract_insertion_details",
         "extract_deletion_details",
         "extract_formatting_details",
+        "merge_intents",
     ]
     for node_name in extraction_nodes:
         workflow.add_conditional_edges(
@@ -116,6 +189,9 @@ def build_graph():
             }
         )
 
+    # Все ветви составного запроса сходятся в merge_intents (он ждет завершения каждой)
+    workflow.add_edge("extract_intent", "merge_intents")
+
     # 5. Определяем прямые ребра (конечные точки)
     workflow.add_edge("awaiting_confirmation", END) # После ожидания граф завершает этот проход
     workflow.add_edge("clarification_handler", END)
@@ -139,7 +215,7 @@ if __name__ == "__main__":
         original_user_query="Замени Х на У в документе.",
         current_user_query="Замени Х на У в документе.",
         document_content_text="Это тестовый документ. В нем есть Х, который нужно заменить.",
-        document_bytes=b"some doc bytes",
+        document_version=None,
         extracted_instructions=None,
         clarification_question=None,
         system_message=None,
@@ -160,7 +236,7 @@ if __name__ == "__main__":
             original_user_query="Замени Х на У в документе.",
             current_user_query="[ПОДТВЕРЖДЕНИЕ]",
             document_content_text="Это тестовый документ. В нем есть Х, который нужно заменить.",
-            document_bytes=b"some doc bytes",
+            document_version=None,
             extracted_instructions=final_state["extracted_instructions"],
             clarification_question=None,
             system_message=None,
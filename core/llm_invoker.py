@@ -1,24 +1,57 @@
 # core/llm_invoker.py
-from typing import Any
-from langchain_google_genai import ChatGoogleGenerativeAI
+from typing import Any, Callable, List, Optional
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.exceptions import OutputParserException
-from langchain_google_genai import HarmCategory, HarmBlockThreshold
 from langchain_core.messages import AIMessage
+from langchain_core.messages.ai import add_usage
 from loguru import logger
+import asyncio
 import json
 import os
+import re
+import threading
+import time
+
+from .llm_cache import get_llm_cache, make_cache_key
+from .async_runtime import get_llm_semaphore, on_shared_loop
+from .llm_resilience import get_resilient_caller
+from .llm_backends import LLM_BACKEND, create_llm_backend
+from . import prompts
+from . import telemetry
+
+
+def _create_gemini():
+    # SDK Gemini (google-ai, grpc) импортируется только при создании клиента
+    from langchain_google_genai import ChatGoogleGenerativeAI, HarmCategory, HarmBlockThreshold
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        safety_settings={
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+        },
+        # Повторы, сроки и предохранитель - в core.llm_resilience; встроенные повторы клиента
+        # (до 6 попыток с паузами до минуты) сделали бы время ответа неограниченным
+        max_retries=1,
+    )
+
+
+# Модель выбирается через LLM_BACKEND (см. core.llm_backends): Gemini, запись его ответов,
+# воспроизведение записи или модель по правилам без сети. Создается при первом вызове
+_llm: Any = None
+_llm_lock = threading.Lock()
+
+
+def get_llm() -> Any:
+    """Общая для процесса модель (создается при первом обращении)."""
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = create_llm_backend(LLM_BACKEND, _create_gemini)
+        return _llm
+
 
-# Инициализация LLM и парсера остается без изменений
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-flash",
-    safety_settings={
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    },
-)
 json_parser = JsonOutputParser()
 # Цепочка json_chain больше не нужна, так как мы будем выполнять шаги вручную
 
@@ -51,25 +84,401 @@ def _extract_json_from_string(text: str) -> str | None:
     return text[start_pos : end_pos + 1]
 
 
-# --- ИЗМЕНЕНИЕ: Обновленная функция вызова с очисткой ---
-def invoke_gemini_json_mode(prompt: str) -> Any:
+_STRUCTURAL_RE = re.compile(r'[\[\]{}",]')
+_STRING_SPECIAL_RE = re.compile(r'["\\]')
+
+
+class IncrementalJSONArrayParser:
     """
-    Обертка для вызова Gemini, которая сначала очищает ответ, а затем парсит JSON.
+    Разбор потокового ответа модели: feed() получает очередной фрагмент текста и возвращает
+    элементы первого JSON-массива ответа, которые завершились в этом фрагменте.
+    Текст до массива (markdown, пояснения) пропускается; строки и экранирование учитываются,
+    поэтому скобки внутри строковых значений не ломают разбор. Текст просматривается один раз
+    (переходами между значимыми символами), а разобранные элементы удаляются из буфера.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0           # следующий непросмотренный символ буфера
+        self._depth = 0         # глубина вложенности относительно начала ответа
+        self._array_depth = None  # глубина, на которой лежат элементы найденного массива
+        self._item_start = None   # начало текущего элемента в буфере
+        self._in_string = False
+        self._escape = False
+        self.done = False        # массив закрыт
+        self.items_parsed = 0
+
+    def feed(self, chunk: str) -> List[Any]:
+        if self.done or not chunk:
+            return []
+        self._buffer += chunk
+        items = []
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            if self._in_string:
+                # Внутри строки важны только кавычка и обратная косая черта
+                if self._escape:
+                    self._escape = False
+                    i += 1
+                    continue
+                match = _STRING_SPECIAL_RE.search(buffer, i)
+                if match is None:
+                    i = len(buffer)
+                    break
+                i = match.start()
+                if buffer[i] == "\\":
+                    self._escape = True
+                else:
+                    self._in_string = False
+                i += 1
+                continue
+
+            match = _STRUCTURAL_RE.search(buffer, i)
+            j = match.start() if match else len(buffer)
+            if self._array_depth is not None and self._depth == self._array_depth and self._item_start is None:
+                # Начало скалярного элемента (число, true, null) - первый непробельный символ
+                stripped = len(buffer[i:j]) - len(buffer[i:j].lstrip())
+                if i + stripped < j:
+                    self._item_start = i + stripped
+            if match is None:
+                i = len(buffer)
+                break
+            i, ch = j, buffer[j]
+            if ch == '"':
+                self._in_string = True
+                if self._array_depth is not None and self._depth == self._array_depth and self._item_start is None:
+                    self._item_start = i
+            elif ch in "[{":
+                if self._array_depth is None and ch == "[":
+                    self._array_depth = self._depth + 1
+                elif self._depth == self._array_depth and self._item_start is None:
+                    self._item_start = i
+                self._depth += 1
+            elif ch in "]}":
+                self._depth -= 1
+                if self._array_depth is not None and self._depth == self._array_depth and self._item_start is not None:
+                    items.extend(self._emit(buffer[self._item_start:i + 1]))
+                elif self._array_depth is not None and self._depth == self._array_depth - 1:
+                    if self._item_start is not None:  # последний скалярный элемент перед "]"
+                        items.extend(self._emit(buffer[self._item_start:i]))
+                    self.done = True
+                    break
+            elif ch == "," and self._array_depth is not None and self._depth == self._array_depth:
+                if self._item_start is not None:  # скалярный элемент
+                    items.extend(self._emit(buffer[self._item_start:i]))
+            i += 1
+        # Просмотренный текст вне текущего элемента больше не нужен
+        cut = self._item_start if self._item_start is not None else i
+        self._buffer = buffer[cut:]
+        self._pos = i - cut
+        if self._item_start is not None:
+            self._item_start = 0
+        return items
+
+    def _emit(self, text: str) -> List[Any]:
+        self._item_start = None
+        text = text.strip()
+        if not text:
+            return []
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError as e:
+            logger.warning(f"IncrementalJSONArrayParser: элемент не разобран ({e}): {text[:100]}")
+            return []
+        self.items_parsed += 1
+        return [item]
+
+
+def _chunk_text(chunk: Any) -> str:
+    """Текст фрагмента потокового ответа (content бывает строкой или списком частей)."""
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content
+                       if isinstance(part, (str, dict)))
+    return ""
+
+
+def _generation_settings() -> dict:
+    """Параметры генерации, от которых зависит ответ: входят в ключ кэша вместе с моделью."""
+    llm = get_llm()
+    return {
+        "temperature": llm.temperature, "top_p": llm.top_p, "top_k": llm.top_k,
+        "max_output_tokens": llm.max_output_tokens,
+        "safety_settings": sorted((str(k), str(v)) for k, v in (llm.safety_settings or {}).items()),
+    }
+
+
+def _cached_response(prompt: str, use_cache: bool):
+    """(кэш, ключ, ответ из кэша или None); кэш равен None, если он отключен или обходится."""
+    cache = get_llm_cache() if use_cache else None
+    if cache is None:
+        return None, None, None
+    key = make_cache_key(get_llm().model, prompt, _generation_settings())
+    cached = cache.get(key)
+    if cached is not None:
+        logger.info(f"Ответ LLM взят из кэша (попаданий: {cache.hits}, промахов: {cache.misses}).")
+        telemetry.record_llm_call(prompt, outcome="cache")
+    return cache, key, cached
+
+
+def _store_response(cache, key: str, response: Any) -> None:
+    if cache is None or (isinstance(response, dict) and "error" in response):
+        return
+    try:
+        cache.put(key, get_llm().model, response)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить ответ LLM в кэш: {e}")
+
+
+def invoke_gemini_json_mode(prompt: str, use_cache: bool = True) -> Any:
+    """
+    Вызов Gemini с разбором JSON и кэшированием ответа на диске.
+    Повторный запрос с тем же промптом к той же модели с теми же параметрами возвращается из кэша;
+    кэшируются только успешно разобранные ответы. use_cache=False - обойти кэш (и не записывать в него).
+    """
+    cache, key, cached = _cached_response(prompt, use_cache)
+    if cached is not None:
+        return cached
+    response = _invoke_gemini_json_mode_uncached(prompt)
+    _store_response(cache, key, response)
+    return response
+
+
+async def ainvoke_gemini_json_mode(prompt: str, use_cache: bool = True) -> Any:
+    """
+    Асинхронный вариант invoke_gemini_json_mode (тот же кэш и разбор ответа).
+    Сам вызов выполняется в общем цикле событий (core.async_runtime) с общим клиентом;
+    число одновременных вызовов во всем процессе ограничено LLM_MAX_CONCURRENCY.
+    """
+    cache, key, cached = _cached_response(prompt, use_cache)
+    if cached is not None:
+        return cached
+    response = await on_shared_loop(_ainvoke_gemini_json_mode_uncached(prompt))
+    _store_response(cache, key, response)
+    return response
+
+
+def _replay_cached(cached: Any, on_item: Optional[Callable[[Any], None]]) -> None:
+    if on_item is not None and isinstance(cached, list):
+        for item in cached:
+            on_item(item)
+
+
+def stream_gemini_json_mode(prompt: str, on_item: Optional[Callable[[Any], None]] = None,
+                            use_cache: bool = True) -> Any:
+    """
+    Потоковый вариант invoke_gemini_json_mode для промптов, возвращающих JSON-массив:
+    on_item(элемент) вызывается для каждого элемента массива, как только модель его закрыла,
+    не дожидаясь конца генерации. Возвращает то же, что invoke_gemini_json_mode для полного
+    ответа (и пользуется тем же кэшем; ответ из кэша передается в on_item целиком).
+    """
+    cache, key, cached = _cached_response(prompt, use_cache)
+    if cached is not None:
+        _replay_cached(cached, on_item)
+        return cached
+    _check_api_key()
+    caller = get_resilient_caller()
+    deadline = caller.new_deadline()
+    emitted = []
+
+    def attempt() -> AIMessage:
+        parser = IncrementalJSONArrayParser()
+        parts = []
+        usage = None
+        logger.debug(f"Отправка промпта в LLM (поток, начало): {prompt[:200]}...")
+        with telemetry.llm_call(prompt) as call:
+            for chunk in get_llm().stream(prompt):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Истек срок ожидания ответа LLM ({caller.deadline_seconds} с).")
+                usage = add_usage(usage, getattr(chunk, "usage_metadata", None))
+                text = _chunk_text(chunk)
+                parts.append(text)
+                for item in parser.feed(text):
+                    emitted.append(item)
+                    if on_item is not None:
+                        on_item(item)
+            call.response = AIMessage(content="".join(parts), usage_metadata=usage)
+        return call.response
+
+    try:
+        # Повторять можно, пока из потока ничего не передано: иначе элементы пришли бы дважды
+        raw_response = caller.call(attempt, deadline=deadline, hedge=False, retryable=lambda: not emitted)
+        response = _repair_if_needed(prompt, raw_response, _parse_llm_response(raw_response), deadline)
+    except Exception as e:
+        return _api_error(e)
+    _store_response(cache, key, response)
+    return response
+
+
+async def astream_gemini_json_mode(prompt: str, on_item: Optional[Callable[[Any], None]] = None,
+                                   use_cache: bool = True) -> Any:
+    """Асинхронный вариант stream_gemini_json_mode (вызов в общем цикле событий, с общим ограничителем)."""
+    cache, key, cached = _cached_response(prompt, use_cache)
+    if cached is not None:
+        _replay_cached(cached, on_item)
+        return cached
+    caller_loop = asyncio.get_running_loop()
+
+    def deliver(item: Any) -> None:
+        # Элементы разбираются в общем цикле, а on_item вызывается в цикле вызывающего
+        if on_item is None:
+            return
+        if asyncio.get_running_loop() is caller_loop:
+            on_item(item)
+        else:
+            caller_loop.call_soon_threadsafe(on_item, item)
+
+    response = await on_shared_loop(_astream_gemini_json_mode_uncached(prompt, deliver))
+    _store_response(cache, key, response)
+    return response
+
+
+async def _astream_gemini_json_mode_uncached(prompt: str, on_item: Callable[[Any], None]) -> Any:
+    _check_api_key()
+    caller = get_resilient_caller()
+    deadline = caller.new_deadline()
+    emitted = []
+
+    async def attempt() -> AIMessage:
+        parser = IncrementalJSONArrayParser()
+        parts = []
+        usage = None
+        async with get_llm_semaphore():
+            logger.debug(f"Отправка промпта в LLM (async поток, начало): {prompt[:200]}...")
+            with telemetry.llm_call(prompt) as call:
+                async for chunk in get_llm().astream(prompt):
+                    usage = add_usage(usage, getattr(chunk, "usage_metadata", None))
+                    text = _chunk_text(chunk)
+                    parts.append(text)
+                    for item in parser.feed(text):
+                        emitted.append(item)
+                        on_item(item)
+                call.response = AIMessage(content="".join(parts), usage_metadata=usage)
+        return call.response
+
+    try:
+        raw_response = await caller.acall(attempt, deadline=deadline, hedge=False, retryable=lambda: not emitted)
+        return await _arepair_if_needed(prompt, raw_response, _parse_llm_response(raw_response), deadline)
+    except Exception as e:
+        return _api_error(e)
+
+
+def set_llm_backend(model: Any) -> Any:
+    """
+    Заменяет модель для всех последующих вызовов (например, на ReplayChatModel в бенчмарке).
+    Возвращает предыдущую модель (None, если модель еще не создавалась). Кэш ответов различает модели по имени.
     """
+    global _llm
+    with _llm_lock:
+        previous, _llm = _llm, model
+    logger.info(f"llm_invoker: модель заменена на {getattr(model, 'model', type(model).__name__)}.")
+    return previous
+
+
+def _check_api_key() -> None:
+    if not getattr(get_llm(), "requires_api_key", True):
+        return
     if not os.getenv("GOOGLE_API_KEY"):
         logger.error("GOOGLE_API_KEY не установлен. Невозможно вызвать Gemini.")
         raise ValueError("API ключ Google не найден.")
 
+
+# --- ИЗМЕНЕНИЕ: Обновленная функция вызова с очисткой ---
+def _invoke_gemini_json_mode_uncached(prompt: str) -> Any:
+    """
+    Обертка для вызова Gemini, которая сначала очищает ответ, а затем парсит JSON.
+    """
+    _check_api_key()
+    caller = get_resilient_caller()
+    deadline = caller.new_deadline()
     try:
-        # Шаг 1: Получаем сырой ответ от модели
+        # Шаг 1: Получаем сырой ответ от модели (с повторами при временных ошибках)
         logger.debug(f"Отправка промпта в LLM (начало): {prompt[:200]}...") # Логируем начало промпта
-        raw_response = llm.invoke(prompt)
-        
+        raw_response = caller.call(_invoke_llm, prompt, deadline=deadline)
+        return _repair_if_needed(prompt, raw_response, _parse_llm_response(raw_response), deadline)
+    except Exception as e:
+        return _api_error(e)
+
+
+async def _ainvoke_gemini_json_mode_uncached(prompt: str) -> Any:
+    """Асинхронный вызов Gemini; должен выполняться в общем цикле событий."""
+    _check_api_key()
+    caller = get_resilient_caller()
+    deadline = caller.new_deadline()
+    try:
+        logger.debug(f"Отправка промпта в LLM (async, начало): {prompt[:200]}...")
+        raw_response = await caller.acall(_ainvoke_llm, prompt, deadline=deadline, hedge_allowed=_has_free_slot)
+        return await _arepair_if_needed(prompt, raw_response, _parse_llm_response(raw_response), deadline)
+    except Exception as e:
+        return _api_error(e)
+
+
+def _invoke_llm(prompt: str) -> Any:
+    with telemetry.llm_call(prompt) as call:
+        call.response = get_llm().invoke(prompt)
+    return call.response
+
+
+async def _ainvoke_llm(prompt: str) -> Any:
+    async with get_llm_semaphore():
+        with telemetry.llm_call(prompt) as call:
+            call.response = await get_llm().ainvoke(prompt)
+        return call.response
+
+
+def _has_free_slot() -> bool:
+    """Дублирующий запрос отправляется, только если он не займет место в очереди ограничителя."""
+    return not get_llm_semaphore().locked()
+
+
+def _repair_prompt(prompt: str, raw_response: Any) -> Optional[str]:
+    """Промпт с просьбой исправить ответ, который не удалось разобрать (None - исправлять нечего)."""
+    if not isinstance(raw_response, AIMessage) or not isinstance(raw_response.content, str):
+        return None
+    return prompts.REPAIR_JSON_RESPONSE_PROMPT.format(original_prompt=prompt, bad_response=raw_response.content)
+
+
+def _repair_if_needed(prompt: str, raw_response: Any, response: Any, deadline: float) -> Any:
+    """Если ответ не разобран, переспрашивает модель (до REPAIR_ATTEMPTS раз) в пределах срока запроса."""
+    caller = get_resilient_caller()
+    for _ in range(caller.repair_attempts):
+        repair_prompt = _repair_prompt(prompt, raw_response)
+        if not (isinstance(response, dict) and "error" in response) or repair_prompt is None:
+            break
+        logger.warning(f"Ответ LLM не разобран ({response['error']}), запрошено исправление.")
+        raw_response = caller.call(_invoke_llm, repair_prompt, deadline=deadline)
+        response = _parse_llm_response(raw_response)
+    return response
+
+
+async def _arepair_if_needed(prompt: str, raw_response: Any, response: Any, deadline: float) -> Any:
+    caller = get_resilient_caller()
+    for _ in range(caller.repair_attempts):
+        repair_prompt = _repair_prompt(prompt, raw_response)
+        if not (isinstance(response, dict) and "error" in response) or repair_prompt is None:
+            break
+        logger.warning(f"Ответ LLM не разобран ({response['error']}), запрошено исправление.")
+        raw_response = await caller.acall(_ainvoke_llm, repair_prompt, deadline=deadline, hedge_allowed=_has_free_slot)
+        response = _parse_llm_response(raw_response)
+    return response
+
+
+def _api_error(e: Exception) -> dict:
+    logger.error(f"Ошибка при вызове LLM через LangChain: {e}")
+    if hasattr(e, 'message'): logger.error(f"Сообщение ошибки API: {e.message}")
+    return {"error": f"Ошибка API: {e}"}
+
+
+@telemetry.span("llm_json_parse")
+def _parse_llm_response(raw_response: Any) -> Any:
+    """Очищает сырой ответ модели и разбирает из него JSON (общая часть синхронного и асинхронного вызова)."""
+    json_string = None
+    try:
         logger.debug(f"Тип raw_response от llm.invoke: {type(raw_response)}")
-        if hasattr(raw_response, '__dict__'): # Посмотреть атрибуты, если это объект
-            logger.debug(f"Атрибуты raw_response: {raw_response.__dict__}")
-        else:
-            logger.debug(f"raw_response (repr): {raw_response!r}")
+        logger.debug(f"Токены ответа LLM: {getattr(raw_response, 'usage_metadata', None)}")
 
         if not isinstance(raw_response, AIMessage) or not hasattr(raw_response, 'content'):
             logger.error(f"Неожиданный тип ответа от llm.invoke: {type(raw_response)}. Ожидался AIMessage с атрибутом 'content'.")
@@ -107,6 +516,4 @@ def invoke_gemini_json_mode(prompt: str) -> Any:
         logger.error(f"Ошибка парсинга JSON после очистки: {e}. Строка для парсинга: {json_string}")
         return {"error": f"Ошибка парсинга ответа LLM: {e}"}
     except Exception as e:
-        logger.error(f"Ошибка при вызове LLM через LangChain: {e}")
-        if hasattr(e, 'message'): logger.error(f"Сообщение ошибки API: {e.message}")
-        return {"error": f"Ошибка API: {e}"}
\ No newline at end of file
+        return _api_error(e)
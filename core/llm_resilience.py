@@ -0,0 +1,353 @@
+# core/llm_resilience.py
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+
+from loguru import logger
+
+from .async_runtime import LLM_MAX_CONCURRENCY
+
+# Попыток на один вызов (первая + повторы при временных ошибках)
+MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+# Экспоненциальная задержка между попытками со случайным разбросом ("full jitter"): от 0 до base * 2^n, не больше max
+BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8"))
+# Общий срок на запрос, включая повторы, дублирование и исправление ответа
+DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+# Дублирующий запрос отправляется, если ответа нет дольше этого перцентиля задержки (0 - не дублировать)
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+# Сколько замеров задержки нужно, прежде чем перцентилю можно доверять
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = 200
+# Сколько раз переспрашивать модель с просьбой исправить неразбираемый JSON
+REPAIR_ATTEMPTS = int(os.getenv("LLM_REPAIR_ATTEMPTS", "1"))
+# Предохранитель: после стольких временных ошибок подряд вызовы сразу отклоняются на reset секунд
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+# HTTP-коды ошибок, после которых имеет смысл повторить запрос
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: LLM недавно была недоступна, вызов отклонен без обращения к ней."""
+
+
+def is_transient(error: BaseException) -> bool:
+    """Временная ли ошибка: перегрузка, сбой сервера, таймаут или обрыв соединения."""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    if callable(code):  # у ошибок gRPC code - метод
+        try:
+            code = code()
+        except Exception:
+            code = None
+    code = getattr(code, "value", code)
+    if isinstance(code, tuple):  # grpc.StatusCode: (номер, имя)
+        return code[0] in (4, 8, 13, 14)  # DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, INTERNAL, UNAVAILABLE
+    return code in TRANSIENT_STATUS_CODES
+
+
+class LatencyTracker:
+    """Задержки последних успешных вызовов; перцентиль - порог для дублирующего запроса."""
+
+    def __init__(self, window: int = LATENCY_WINDOW, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold временных ошибок подряд размыкается, и вызовы
+    отклоняются сразу. Через reset_seconds пропускается одна пробная попытка: успех замыкает
+    предохранитель, временная ошибка снова размыкает его на reset_seconds. Попытка, завершившаяся
+    без вывода о доступности LLM (постоянная ошибка, отмена), освобождает место пробы (release);
+    проба, о которой так и не сообщили, через reset_seconds заменяется новой.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if (self.state == self.OPEN and now - self._opened_at >= self.reset_seconds
+                    or self.state == self.HALF_OPEN and now - self._probe_started >= self.reset_seconds):
+                self.state = self.HALF_OPEN
+                self._probe_started = now
+                return True  # пробная попытка
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("CircuitBreaker: LLM снова отвечает, предохранитель замкнут.")
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def release(self) -> None:
+        """Попытка завершилась без вывода о доступности LLM: следующий вызов может стать пробой."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic() - self.reset_seconds
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                logger.warning(f"CircuitBreaker: предохранитель разомкнут на {self.reset_seconds} с "
+                               f"(ошибок подряд: {self._failures}).")
+
+
+class ResilientCaller:
+    """
+    Вызов LLM с повторами при временных ошибках (экспоненциальная задержка со случайным
+    разбросом), общим сроком на запрос, дублирующим запросом при медленном ответе и
+    предохранителем. Постоянные ошибки (например, неверный запрос) не повторяются.
+    """
+
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS, backoff_base: float = BACKOFF_BASE_SECONDS,
+                 backoff_max: float = BACKOFF_MAX_SECONDS, deadline_seconds: float = DEADLINE_SECONDS,
+                 hedge_percentile: float = HEDGE_PERCENTILE, repair_attempts: int = REPAIR_ATTEMPTS,
+                 breaker: Optional[CircuitBreaker] = None, latency: Optional[LatencyTracker] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline_seconds = deadline_seconds
+        self.hedge_percentile = hedge_percentile
+        self.repair_attempts = repair_attempts
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = latency or LatencyTracker()
+        self.counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "rejected": 0, "timeouts": 0}
+        # Синхронные вызовы выполняются в пуле, чтобы срок запроса соблюдался и во время ожидания ответа
+        self._executor = ThreadPoolExecutor(max_workers=max(4, LLM_MAX_CONCURRENCY * 2), thread_name_prefix="llm-call")
+
+    def new_deadline(self) -> float:
+        return time.monotonic() + self.deadline_seconds
+
+    def backoff_delay(self, retry_number: int, error: Optional[BaseException] = None) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry_number))
+        # Сервер может сам указать, когда повторить (ResourceExhausted.retry_after)
+        retry_after = getattr(error, "retry_after", None)
+        if isinstance(retry_after, (int, float)) and retry_after > delay:
+            delay = min(float(retry_after), self.backoff_max)
+        return delay
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile <= 0:
+            return None
+        return self.latency.percentile(self.hedge_percentile)
+
+    def _before_attempt(self, deadline: float) -> float:
+        """
+        Оставшееся время; исключение, если срок истек или предохранитель разомкнут. Срок проверяется
+        первым, чтобы истекший запрос не занимал место пробной попытки.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.counters["timeouts"] += 1
+            raise TimeoutError(f"Истек срок ожидания ответа LLM ({self.deadline_seconds} с).")
+        if not self.breaker.allow():
+            self.counters["rejected"] += 1
+            raise CircuitOpenError("LLM временно недоступна (слишком много ошибок подряд), повторите позже.")
+        return remaining
+
+    def _after_error(self, error: BaseException, attempt: int, deadline: float,
+                     retryable: Optional[Callable[[], bool]]) -> Optional[float]:
+        """Задержка перед повтором или None, если повторять не нужно (ошибка пробрасывается)."""
+        if not is_transient(error):
+            return None
+        self.breaker.record_failure()
+        if attempt + 1 >= self.max_attempts or (retryable is not None and not retryable()):
+            return None
+        delay = self.backoff_delay(attempt, error)
+        if time.monotonic() + delay >= deadline:
+            return None
+        self.counters["retries"] += 1
+        logger.warning(f"Временная ошибка LLM ({error}), повтор {attempt + 1} через {delay:.2f} с.")
+        return delay
+
+    def call(self, fn: Callable[..., Any], *args: Any, deadline: Optional[float] = None, hedge: bool = True,
+             retryable: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Синхронный вызов fn(*args) с повторами. hedge=False - без дублирования и без пула потоков
+        (для потоковых ответов: fn вызывается в текущем потоке, срок проверяет сама fn).
+        retryable() - можно ли еще повторять (например, пока из потока ничего не передано).
+        """
+        deadline = deadline or self.new_deadline()
+        self.counters["calls"] += 1
+        for attempt in range(self.max_attempts):
+            remaining = self._before_attempt(deadline)
+            settled = False  # сообщен ли предохранителю исход попытки
+            try:
+                result = self._hedged(fn, args, remaining) if hedge else fn(*args)
+                self.breaker.record_success()
+                settled = True
+                return result
+            except Exception as e:
+                settled = is_transient(e)
+                delay = self._after_error(e, attempt, deadline, retryable)
+                if delay is None:
+                    raise
+            finally:
+                if not settled:
+                    self.breaker.release()
+            time.sleep(delay)
+        raise AssertionError("недостижимо: последняя попытка возвращает результат или пробрасывает ошибку")
+
+    def _timed(self, fn: Callable[..., Any], args: tuple) -> Any:
+        started = time.monotonic()
+        result = fn(*args)
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    def _hedged(self, fn: Callable[..., Any], args: tuple, remaining: float) -> Any:
+        started = time.monotonic()
+        # Вызов идет в потоке пула с контекстом вызывающего: так его видит трассировка запроса
+        primary = self._executor.submit(contextvars.copy_context().run, self._timed, fn, args)
+        pending = {primary}
+        delay = self.hedge_delay()
+        if delay is not None and delay < remaining:
+            wait(pending, timeout=delay)
+            if not primary.done():
+                self.counters["hedges"] += 1
+                logger.info(f"Ответа LLM нет дольше {delay:.2f} с (p{self.hedge_percentile:g}), отправлен дублирующий запрос.")
+                pending.add(self._executor.submit(contextvars.copy_context().run, self._timed, fn, args))
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining - (time.monotonic() - started), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self.counters["hedge_wins"] += 1
+                    for other in pending:  # проигравший запрос не отменить, но его результат не нужен
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        self.counters["timeouts"] += 1
+        raise TimeoutError(f"Истек срок ожидания ответа LLM ({self.deadline_seconds} с).")
+
+    async def acall(self, afn: Callable[..., Awaitable[Any]], *args: Any, deadline: Optional[float] = None,
+                    hedge: bool = True, hedge_allowed: Optional[Callable[[], bool]] = None,
+                    retryable: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Асинхронный вариант call. Срок соблюдается отменой задачи; дублирующий запрос
+        отправляется, только если hedge_allowed() (например, есть свободный слот ограничителя).
+        """
+        deadline = deadline or self.new_deadline()
+        self.counters["calls"] += 1
+        for attempt in range(self.max_attempts):
+            remaining = self._before_attempt(deadline)
+            settled = False  # сообщен ли предохранителю исход попытки (отмена задачи его не сообщает)
+            try:
+                if hedge:
+                    result = await self._ahedged(afn, args, remaining, hedge_allowed)
+                else:
+                    result = await asyncio.wait_for(afn(*args), remaining)
+                self.breaker.record_success()
+                settled = True
+                return result
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.counters["timeouts"] += 1
+                settled = is_transient(e)
+                delay = self._after_error(e, attempt, deadline, retryable)
+                if delay is None:
+                    raise
+            finally:
+                if not settled:
+                    self.breaker.release()
+            await asyncio.sleep(delay)
+        raise AssertionError("недостижимо: последняя попытка возвращает результат или пробрасывает ошибку")
+
+    async def _atimed(self, afn: Callable[..., Awaitable[Any]], args: tuple) -> Any:
+        started = time.monotonic()
+        result = await afn(*args)
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    async def _ahedged(self, afn: Callable[..., Awaitable[Any]], args: tuple, remaining: float,
+                       hedge_allowed: Optional[Callable[[], bool]]) -> Any:
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self._atimed(afn, args))
+        pending = {primary}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None and delay < remaining:
+                await asyncio.wait(pending, timeout=delay)
+                if not primary.done() and (hedge_allowed is None or hedge_allowed()):
+                    self.counters["hedges"] += 1
+                    logger.info(f"Ответа LLM нет дольше {delay:.2f} с (p{self.hedge_percentile:g}), отправлен дублирующий запрос.")
+                    pending.add(asyncio.ensure_future(self._atimed(afn, args)))
+            error = None
+            while pending:
+                timeout = remaining - (time.monotonic() - started)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, timeout), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            if error is not None and not pending:
+                raise error
+            self.counters["timeouts"] += 1
+            raise TimeoutError(f"Истек срок ожидания ответа LLM ({self.deadline_seconds} с).")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {**self.counters, "breaker": self.breaker.state,
+                "hedge_delay": self.hedge_delay()}
+
+
+_default_caller: Optional[ResilientCaller] = None
+_default_caller_lock = threading.Lock()
+
+
+def get_resilient_caller() -> ResilientCaller:
+    """Общие для процесса повторы, предохранитель и статистика задержек вызовов LLM."""
+    global _default_caller
+    with _default_caller_lock:
+        if _default_caller is None:
+            _default_caller = ResilientCaller()
+        return _default_caller
@@ -0,0 +1,177 @@
+# core/mail_merge.py
+"""
+Слияние шаблона с данными: один .docx на каждую строку данных.
+
+compile_template() разбирает шаблон один раз: в теле документа (включая таблицы), колонтитулах и
+сносках находит поля {{ИМЯ}}, в том числе разбитые Word'ом на несколько run'ов, и переписывает
+каждое поле целиком в первый w:t, на который оно приходится. Результат - CompiledTemplate:
+нормализованный XML измененных частей и для каждой части список слотов (номер w:t в порядке
+документа и куски его текста: строки и имена полей). Остальные части пакета при рендеринге
+копируются из шаблона в сжатом виде.
+
+CompiledTemplate.render() подставляет значения строки прямо в текстовые узлы слотов и
+сериализует только части с полями - без python-docx, поиска текста и обхода документа.
+"""
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
+import re
+import zipfile
+
+from docx.oxml.ns import qn
+from lxml import etree
+
+from .docx_save import _copy_raw_entry
+
+PLACEHOLDER_RE = re.compile(r"\{\{\s*([\w.\-]+)\s*\}\}")
+# Части пакета, в которых могут быть поля
+_TEXT_PART_RE = re.compile(r"^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$")
+# Символы, недопустимые в XML 1.0: lxml не принимает их в тексте узла
+_XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f￾￿]")
+_W_P, _W_T = qn("w:p"), qn("w:t")
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+# Кусок текста слота: строка выводится как есть, кортеж (имя,) - значение поля
+Piece = Union[str, Tuple[str]]
+
+
+@dataclass
+class PartTemplate:
+    """Часть пакета с полями: нормализованный XML и слоты (номер w:t, куски текста)."""
+    name: str
+    xml: bytes
+    slots: List[Tuple[int, Tuple[Piece, ...]]]
+    # Дерево разбирается лениво в каждом процессе и переиспользуется: render перезаписывает все слоты
+    _tree: Optional[tuple] = field(default=None, repr=False, compare=False)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tree"] = None  # элементы lxml не сериализуются pickle, у процесса пула дерево свое
+        return state
+
+    def render(self, values: Mapping[str, str]) -> bytes:
+        if self._tree is None:
+            root = etree.fromstring(self.xml)
+            texts = list(root.iter(_W_T))
+            self._tree = (root, [texts[index] for index, _ in self.slots])
+        root, elements = self._tree
+        for element, (_, pieces) in zip(elements, self.slots):
+            element.text = "".join(piece if isinstance(piece, str) else values[piece[0]] for piece in pieces)
+        return etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+
+@dataclass
+class CompiledTemplate:
+    """Скомпилированный шаблон; сериализуется pickle и передается процессам пула целиком."""
+    source: bytes
+    parts: Dict[str, PartTemplate]
+    fields: List[str]
+
+    def placeholders(self) -> Dict[str, int]:
+        """Сколько раз каждое поле встречается в шаблоне."""
+        counts = dict.fromkeys(self.fields, 0)
+        for part in self.parts.values():
+            for _, pieces in part.slots:
+                for piece in pieces:
+                    if not isinstance(piece, str):
+                        counts[piece[0]] += 1
+        return counts
+
+    def render(self, row: Mapping[str, object], missing: str = "") -> bytes:
+        """
+        Документ для одной строки данных. Поле, которого нет в строке (или None), заменяется на
+        missing; missing=None - KeyError.
+        """
+        values = {}
+        for name in self.fields:
+            value = row.get(name)
+            if value is None:
+                if missing is None:
+                    raise KeyError(f"Нет значения поля '{name}'")
+                value = missing
+            values[name] = _XML_INVALID_RE.sub("", str(value))
+
+        out = BytesIO()
+        source_view = memoryview(self.source)
+        with zipfile.ZipFile(BytesIO(self.source)) as src_zip, \
+                zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as out_zip:
+            for info in src_zip.infolist():
+                part = self.parts.get(info.filename)
+                if part is None:
+                    _copy_raw_entry(out_zip, info, source_view)
+                else:
+                    out_zip.writestr(info.filename, part.render(values))
+        return out.getvalue()
+
+
+def _own_texts(p_element) -> List:
+    """w:t абзаца без w:t вложенных абзацев (надписи внутри run'а - отдельные абзацы)."""
+    return [t for t in p_element.iter(_W_T) if next(t.iterancestors(_W_P)) is p_element]
+
+
+def _paragraph_slots(texts: List) -> Iterator[Tuple[object, Tuple[Piece, ...]]]:
+    """
+    Находит поля в сквозном тексте абзаца и переписывает w:t: поле целиком переходит в w:t,
+    где оно начинается, а его продолжение удаляется из следующих w:t. Возвращает слоты -
+    w:t, в тексте которых есть поля, с кусками их текста.
+    """
+    strings = [t.text or "" for t in texts]
+    full = "".join(strings)
+    matches = list(PLACEHOLDER_RE.finditer(full))
+    if not matches:
+        return
+    offset = 0
+    for t, text in zip(texts, strings):
+        start, end = offset, offset + len(text)
+        offset = end
+        pieces: List[Piece] = []
+        literal = []
+        pos = start
+        touched = False
+        for match in matches:
+            if match.end() <= start or match.start() >= end:
+                continue
+            touched = True
+            if match.start() >= start:
+                literal.append(full[pos:match.start()])
+                pieces.append("".join(literal))
+                pieces.append((match.group(1),))
+                literal = []
+            pos = max(pos, min(match.end(), end))
+        if not touched:
+            continue
+        literal.append(full[pos:end])
+        pieces.append("".join(literal))
+        pieces = [piece for piece in pieces if piece != ""]
+        # Значения и края run'ов могут содержать пробелы, Word без этого атрибута их отбрасывает
+        t.set(_XML_SPACE, "preserve")
+        if any(not isinstance(piece, str) for piece in pieces):
+            yield t, tuple(pieces)
+        else:
+            t.text = "".join(pieces)
+
+
+def compile_template(source: Union[bytes, str]) -> CompiledTemplate:
+    """Компилирует шаблон .docx (байты или путь к файлу)."""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            source = f.read()
+    parts = {}
+    fields: Dict[str, None] = {}
+    with zipfile.ZipFile(BytesIO(source)) as zf:
+        for info in zf.infolist():
+            if not _TEXT_PART_RE.match(info.filename):
+                continue
+            root = etree.fromstring(zf.read(info))
+            slot_elements = []
+            for p_element in root.iter(_W_P):
+                slot_elements.extend(_paragraph_slots(_own_texts(p_element)))
+            if not slot_elements:
+                continue
+            positions = {id(t): index for index, t in enumerate(root.iter(_W_T))}
+            slots = [(positions[id(t)], pieces) for t, pieces in slot_elements]
+            for _, pieces in slots:
+                fields.update((piece[0], None) for piece in pieces if not isinstance(piece, str))
+            parts[info.filename] = PartTemplate(
+                info.filename, etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True), slots)
+    return CompiledTemplate(source, parts, list(fields))
@@ -0,0 +1,82 @@
+# core/pattern_matcher.py
+from collections import deque
+from typing import Iterable, List, Tuple
+
+# Совпадение: (начало, конец, индекс шаблона) - полуинтервал [начало, конец)
+Match = Tuple[int, int, int]
+
+
+class MultiPatternMatcher:
+    """
+    Автомат Ахо-Корасик: находит все вхождения набора шаблонов за один проход по тексту.
+    Шаблоны индексируются в порядке передачи; пустые шаблоны игнорируются.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = list(patterns)
+        self._goto: List[dict] = [{}]
+        self._fail: List[int] = [0]
+        # Шаблоны, заканчивающиеся в узле, и ссылка на ближайший узел-суффикс с шаблоном
+        self._out: List[List[int]] = [[]]
+        self._dict_link: List[int] = [0]
+
+        for pattern_id, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            node = 0
+            for ch in pattern:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][ch] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._dict_link.append(0)
+                node = next_node
+            self._out[node].append(pattern_id)
+        self._build_links()
+
+    def _build_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                child_fail = self._goto[fail].get(ch, 0)
+                self._fail[child] = child_fail if child_fail != child else 0
+                self._dict_link[child] = child_fail if self._out[child_fail] else self._dict_link[child_fail]
+
+    def iter_matches(self, text: str) -> Iterable[Match]:
+        """Перечисляет все (в том числе перекрывающиеся) вхождения шаблонов в text."""
+        goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict_link
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if out[node] else dict_link[node]
+            while hit:
+                for pattern_id in out[hit]:
+                    yield pos + 1 - len(self.patterns[pattern_id]), pos + 1, pattern_id
+                hit = dict_link[hit]
+
+    def has_match(self, text: str) -> bool:
+        return next(iter(self.iter_matches(text)), None) is not None
+
+
+def select_leftmost_longest(matches: Iterable[Match]) -> List[Match]:
+    """
+    Выбирает непересекающиеся совпадения: на каждой позиции берется самое левое,
+    среди начинающихся в ней - самое длинное, при равной длине - шаблон с меньшим индексом.
+    """
+    selected: List[Match] = []
+    last_end = 0
+    for start, end, pattern_id in sorted(matches, key=lambda m: (m[0], -(m[1] - m[0]), m[2])):
+        if start >= last_end:
+            selected.append((start, end, pattern_id))
+            last_end = end
+    return selected
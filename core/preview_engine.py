@@ -0,0 +1,223 @@
+# core/preview_engine.py
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+import re
+
+from docx import Document
+from loguru import logger
+
+from .docx_index import DocumentIndex, IndexedParagraph, CONTAINER_BODY
+
+_WORD_RE = re.compile(r"\S+")
+# Сколько слов контекста показывается до и после найденного фрагмента
+CONTEXT_WORDS = 10
+
+
+@dataclass
+class PreviewOccurrence:
+    """Найденный фрагмент: контейнер абзаца, сам фрагмент и контекст вокруг него."""
+    container: str
+    context_before: str
+    target: str
+    context_after: str
+    start: int
+    end: int
+
+
+class PreviewIndex:
+    """
+    Позиционный индекс документа для предпросмотра правок. Строится один раз на версию:
+    сквозной текст всех абзацев (тело, таблицы, колонтитулы), границы слов и
+    инвертированный индекс слово -> номера слов. Фраза ищется без учета различий в пробелах:
+    кандидаты берутся из списка вхождений самого редкого слова фразы и проверяются по соседним
+    словам, поэтому поиск стоит O(k) от числа кандидатов, а не O(n) от длины документа.
+    """
+
+    def __init__(self, doc: Document):
+        self.index = DocumentIndex(doc)
+        self.entries: List[IndexedParagraph] = list(self.index)  # обход пересчитывает смещения
+        self.text = self.index.full_text
+        self._word_starts = array("q")
+        self._word_ends = array("q")
+        postings: Dict[str, array] = defaultdict(lambda: array("q"))
+        for i, match in enumerate(_WORD_RE.finditer(self.text)):
+            self._word_starts.append(match.start())
+            self._word_ends.append(match.end())
+            postings[match.group()].append(i)
+        self._postings = dict(postings)
+        self._vocabulary = list(self._postings)
+        # Отсортированные слова и их обращения: поиск слов по префиксу и суффиксу бинарным поиском
+        self._sorted_words = sorted(self._vocabulary)
+        self._sorted_reversed = sorted(word[::-1] for word in self._vocabulary)
+        # Абзацы по тексту без крайних пробелов - точное совпадение, как в paragraph_text_matches
+        self._by_text: Dict[str, List[int]] = defaultdict(list)
+        for pos, entry in enumerate(self.entries):
+            self._by_text[entry.text.strip()].append(pos)
+        self._entry_starts = [entry.start for entry in self.entries]
+        logger.debug(f"PreviewIndex: {len(self.entries)} абзац(ев), {len(self._word_starts)} слов, "
+                     f"{len(self._vocabulary)} различных.")
+
+    @property
+    def size_bytes(self) -> int:
+        """Приблизительный объем индекса в памяти."""
+        return len(self.text) * 2 + len(self._word_starts) * 24 + len(self._vocabulary) * 192
+
+    def _entry_pos(self, offset: int) -> int:
+        return bisect_right(self._entry_starts, offset) - 1
+
+    def _word(self, i: int) -> str:
+        return self.text[self._word_starts[i]:self._word_ends[i]]
+
+    @staticmethod
+    def _with_prefix(sorted_words: List[str], prefix: str) -> List[str]:
+        found = []
+        for i in range(bisect_left(sorted_words, prefix), len(sorted_words)):
+            if not sorted_words[i].startswith(prefix):
+                break
+            found.append(sorted_words[i])
+        return found
+
+    def _postings_of(self, words: Iterable[str]) -> List[int]:
+        return [i for word in words for i in self._postings[word]]
+
+    def exact_paragraphs(self, text: str, containers: Optional[Iterable[str]] = None) -> List[int]:
+        """Позиции абзацев, текст которых совпадает с text (без учета крайних пробелов)."""
+        allowed = set(containers) if containers else None
+        return [pos for pos in self._by_text.get((text or "").strip(), [])
+                if allowed is None or self.entries[pos].container in allowed]
+
+    def find_phrase(self, phrase: str, entry_positions: Optional[Iterable[int]] = None,
+                    containers: Optional[Iterable[str]] = None) -> List[Tuple[int, int]]:
+        """
+        Все вхождения фразы в пределах одного абзаца как (начало, конец) в сквозном тексте.
+        Любая последовательность пробельных символов во фразе совпадает с любой в документе;
+        первое слово фразы может быть концом слова документа, последнее - началом.
+        Одно слово ищется в словах документа, которые им начинаются или заканчиваются (бинарным
+        поиском); словарь просматривается целиком, только если таких слов нет, - ради вхождений
+        строго внутри слова.
+        """
+        words = (phrase or "").split()
+        if not words:
+            return []
+        if len(words) == 1:
+            containing = dict.fromkeys(self._with_prefix(self._sorted_words, words[0]))
+            containing.update((w[::-1], None) for w in self._with_prefix(self._sorted_reversed, words[0][::-1]))
+            if not containing:
+                containing = [word for word in self._vocabulary if words[0] in word]
+            candidates = self._postings_of(containing)
+        else:
+            middle = words[1:-1]
+            if middle:
+                # Опорное слово - самое редкое из целых слов фразы
+                k = min(range(len(middle)), key=lambda j: len(self._postings.get(middle[j], ())))
+                candidates = [i - k - 1 for i in self._postings.get(middle[k], ())]
+            else:
+                # Только два слова: опора - меньшее из множеств "слова с таким окончанием" и "с таким началом"
+                ending = [w[::-1] for w in self._with_prefix(self._sorted_reversed, words[0][::-1])]
+                starting = self._with_prefix(self._sorted_words, words[-1])
+                if sum(len(self._postings[w]) for w in ending) <= sum(len(self._postings[w]) for w in starting):
+                    candidates = self._postings_of(ending)
+                else:
+                    candidates = [i - 1 for i in self._postings_of(starting)]
+
+        allowed_entries = set(entry_positions) if entry_positions is not None else None
+        allowed_containers = set(containers) if containers else None
+        found = []
+        for i in candidates:
+            last = i + len(words) - 1
+            if i < 0 or last >= len(self._word_starts):
+                continue
+            if len(words) == 1:
+                word, word_start = self._word(i), self._word_starts[i]
+                spans, at = [], word.find(words[0])
+                while at != -1:
+                    spans.append((word_start + at, word_start + at + len(words[0])))
+                    at = word.find(words[0], at + len(words[0]))
+            else:
+                if not self._word(i).endswith(words[0]) or not self._word(last).startswith(words[-1]):
+                    continue
+                if any(self._word(i + j) != words[j] for j in range(1, len(words) - 1)):
+                    continue
+                spans = [(self._word_ends[i] - len(words[0]), self._word_starts[last] + len(words[-1]))]
+            for start, end in spans:
+                pos = self._entry_pos(start)
+                entry = self.entries[pos]
+                if end > entry.end:
+                    continue  # фраза переходит через границу абзаца
+                if allowed_entries is not None and pos not in allowed_entries:
+                    continue
+                if allowed_containers is not None and entry.container not in allowed_containers:
+                    continue
+                found.append((start, end))
+        found.sort()
+        return found
+
+    def occurrence(self, start: int, end: int, context_words: int = CONTEXT_WORDS) -> PreviewOccurrence:
+        """Фрагмент [start, end) с контекстом из context_words слов с каждой стороны (в пределах абзаца)."""
+        entry = self.entries[self._entry_pos(start)]
+        n_words = len(self._word_starts)
+        first = bisect_right(self._word_starts, start) - 1  # слово, в котором начинается фрагмент
+        if first < 0 or self._word_ends[first] <= start:
+            first += 1
+        last = bisect_right(self._word_starts, max(start, end - 1)) - 1  # слово, в котором он заканчивается
+        left = max(bisect_left(self._word_starts, entry.start), first - context_words)
+        right = min(bisect_right(self._word_starts, entry.end) - 1, last + context_words)
+        before = self.text[self._word_starts[left]:start] if left < n_words and self._word_starts[left] < start else ""
+        after = self.text[end:self._word_ends[right]] if right >= 0 and self._word_ends[right] > end else ""
+        return PreviewOccurrence(
+            container=entry.container,
+            context_before=" ".join(before.split()) + (" " if before[-1:].isspace() else ""),
+            target=self.text[start:end],
+            context_after=(" " if after[:1].isspace() else "") + " ".join(after.split()),
+            start=start, end=end,
+        )
+
+    def paragraph_occurrences(self, entry_positions: Iterable[int]) -> List[PreviewOccurrence]:
+        return [self.occurrence(self.entries[pos].start, self.entries[pos].end) for pos in entry_positions]
+
+    def preview_instruction(self, instruction: dict) -> dict:
+        """
+        Где в документе сработает инструкция: цели ищутся по тем же правилам, что и в обработчиках,
+        но без учета различий в пробелах. Возвращает словарь
+        {"found", "search_text", "occurrences": [PreviewOccurrence], "new_text", "whole_paragraphs"}:
+        new_text - текст, который заменит или дополнит цель; whole_paragraphs - цели являются абзацами целиком.
+        """
+        op_type = instruction.get("operation_type")
+        target = instruction.get("target_description", {}) or {}
+        params = instruction.get("parameters", {}) or {}
+        context = target.get("text_to_find")
+        result = {"found": False, "search_text": None, "occurrences": [], "new_text": None, "whole_paragraphs": False}
+
+        if op_type == "REPLACE_TEXT":
+            search = params.get("old_text") or target.get("placeholder")
+            scope = self.exact_paragraphs(context) if context else []
+            spans = self.find_phrase(search, entry_positions=scope or None)
+            result.update(search_text=search, new_text=params.get("new_text", "") or "",
+                          occurrences=[self.occurrence(s, e) for s, e in spans])
+        elif op_type == "INSERT_TEXT":
+            anchors = self.exact_paragraphs(context, containers=(CONTAINER_BODY,))[:1]
+            result.update(search_text=context, new_text=params.get("text_to_insert"), whole_paragraphs=True,
+                          occurrences=self.paragraph_occurrences(anchors))
+        elif op_type in ("APPLY_TEXT_FORMATTING", "APPLY_FORMATTING"):
+            search = params.get("apply_to_text_segment") or context
+            spans = self.find_phrase(search, containers=(CONTAINER_BODY,))
+            result.update(search_text=search, occurrences=[self.occurrence(s, e) for s, e in spans])
+        elif op_type == "APPLY_PARAGRAPH_FORMATTING":
+            spans = self.find_phrase(context, containers=(CONTAINER_BODY,))
+            positions = sorted({self._entry_pos(s) for s, _ in spans})
+            result.update(search_text=context, whole_paragraphs=True, occurrences=self.paragraph_occurrences(positions))
+        elif op_type == "DELETE_ELEMENT":
+            positions = self.exact_paragraphs(context)
+            if not positions:
+                positions = sorted({self._entry_pos(s) for s, _ in self.find_phrase(context)})
+            result.update(search_text=context, whole_paragraphs=True, occurrences=self.paragraph_occurrences(positions))
+        else:
+            search = context or params.get("old_text")
+            spans = self.find_phrase(search)
+            result.update(search_text=search, new_text=params.get("new_cell_text"),
+                          occurrences=[self.occurrence(s, e) for s, e in spans])
+        result["found"] = bool(result["occurrences"])
+        return result
@@ -19,13 +19,73 @@ CATEGORIZE_REQUEST_PROMPT = """
 ---
 Запрос пользователя: "{user_query}"
 
-Верни JSON с одним ключом "category", значение которого - одна из перечисленных выше категорий.
-Пример: {{"category": "REPLACE_TEXT"}}
+Запрос может содержать несколько независимых действий (например, "замени дату, удали третий пункт
+и сделай заголовок жирным"). Тогда раздели его на подзапросы: у каждого своя категория и
+фрагмент исходного запроса, описывающий только это действие (понятный без остальной части запроса).
+
+Верни JSON с ключами:
+- "category" - категория запроса (для составного запроса - категория первого действия);
+- "intents" - массив подзапросов [{{"category": ..., "query": ...}}] в порядке их упоминания;
+  для запроса с одним действием - массив из одного элемента.
+Пример: {{"category": "REPLACE_TEXT", "intents": [{{"category": "REPLACE_TEXT", "query": "замени дату на 01.02.2025"}},
+{{"category": "APPLY_FORMATTING", "query": "сделай заголовок 'Договор' жирным"}}]}}
+"""
+
+# Быстрый путь: категория и инструкции за один вызов LLM
+CATEGORIZE_AND_EXTRACT_PROMPT = """
+Проанализируй запрос пользователя и текст документа. За один ответ определи категорию операции
+и извлеки инструкции для ее выполнения.
+
+Категории:
+- "REPLACE_TEXT": Замена текста.
+- "INSERT_TEXT": Вставка текста.
+- "DELETE_ELEMENT": Удаление абзаца, таблицы, строки/колонки таблицы.
+- "APPLY_FORMATTING": Изменение стиля, шрифта, выравнивания.
+- "TABLE_OPERATION": Любая операция с таблицей (изменение ячейки, добавление/удаление строк/колонок).
+- "CLARIFICATION_NEEDED": Запрос слишком неоднозначен, нужно уточнение от пользователя.
+- "UNKNOWN_OPERATION": Запрос не соответствует ни одной из известных категорий.
+
+Структуры инструкций по категориям:
+- REPLACE_TEXT:
+  {{"operation_type": "REPLACE_TEXT",
+    "target_description": {{"text_to_find": "контекст или null", "placeholder": "плейсхолдер или null"}},
+    "parameters": {{"old_text": "точный старый текст", "new_text": "новый текст"}}}}
+  Если заменить нужно "везде", text_to_find оставь null, а old_text - то, что ищем везде.
+- INSERT_TEXT:
+  {{"operation_type": "INSERT_TEXT",
+    "target_description": {{"text_to_find": "текст, который поможет найти нужный абзац"}},
+    "parameters": {{"text_to_insert": "новый текст",
+                    "position": "'before_paragraph' | 'after_paragraph' | 'start_of_paragraph' | 'end_of_paragraph'"}}}}
+- DELETE_ELEMENT:
+  {{"operation_type": "DELETE_ELEMENT",
+    "target_description": {{"text_to_find": "ПОЛНЫЙ текст удаляемого абзаца ИЛИ его уникальное длинное начало",
+                            "element_type": "paragraph" | "table_row" | "table_column" | "table"}},
+    "parameters": {{}}}}
+- APPLY_FORMATTING: для целого абзаца (выравнивание и т.п.)
+  {{"operation_type": "APPLY_PARAGRAPH_FORMATTING",
+    "target_description": {{"text_to_find": "текст, который поможет найти абзац"}},
+    "parameters": {{"formatting_rules": [{{"style": "alignment", "value": "center"}}]}}}}
+  для части текста (жирный, курсив и т.п.)
+  {{"operation_type": "APPLY_TEXT_FORMATTING",
+    "target_description": {{"text_to_find": "текст, который поможет найти абзац"}},
+    "parameters": {{"apply_to_text_segment": "ТОЧНАЯ фраза", "formatting_rules": [{{"style": "italic", "value": true}}]}}}}
+
+Текст документа (фрагменты, относящиеся к запросу; [...] - пропущенные части):
+---
+{doc_text}
+---
+Запрос пользователя: "{user_query}"
+
+Верни JSON-объект с ключами "category" (одна из категорий выше) и "instructions" (JSON-массив с ОДНИМ
+объектом инструкции для этой категории). Для категорий без инструкций (TABLE_OPERATION,
+CLARIFICATION_NEEDED, UNKNOWN_OPERATION) и если детали извлечь не удается, "instructions" - пустой массив.
+Пример: {{"category": "REPLACE_TEXT", "instructions": [{{"operation_type": "REPLACE_TEXT",
+"target_description": {{"text_to_find": null, "placeholder": null}}, "parameters": {{"old_text": "X", "new_text": "Y"}}}}]}}
 """
 
 EXTRACT_REPLACEMENT_DETAILS_PROMPT = """
 Извлеки детали для замены текста из запроса пользователя.
-Текст документа (фрагмент):
+Текст документа (фрагменты, относящиеся к запросу; [...] - пропущенные части):
 ---
 {doc_text}
 ---
@@ -59,7 +119,7 @@ EXTRACT_INSERTION_DETAILS_PROMPT = """
 Извлеки детали для вставки текста из запроса пользователя.
 Проанализируй текст документа и запрос, чтобы понять, куда и что нужно вставить.
 
-Текст документа (фрагмент):
+Текст документа (фрагменты, относящиеся к запросу; [...] - пропущенные части):
 ---
 {doc_text}
 ---
@@ -100,7 +160,7 @@ EXTRACT_DELETION_DETAILS_PROMPT = """
 Пользователь хочет удалить элемент из документа. Проанализируй его запрос и текст документа.
 Твоя задача - извлечь детали для операции DELETE_ELEMENT.
 
-Текст документа (фрагмент):
+Текст документа (фрагменты, относящиеся к запросу; [...] - пропущенные части):
 ---
 {doc_text} 
 ---
@@ -144,7 +204,7 @@ EXTRACT_FORMATTING_DETAILS_PROMPT = """
     - text_to_find: Текст, который поможет найти абзац, содержащий фразу.
     - apply_to_text_segment: ТОЧНАЯ фраза, которую нужно отформатировать.
 
-Текст документа (фрагмент):
+Текст документа (фрагменты, относящиеся к запросу; [...] - пропущенные части):
 ---
 {doc_text}
 ---
@@ -170,4 +230,19 @@ EXTRACT_FORMATTING_DETAILS_PROMPT = """
       "formatting_rules": [{{ "style": "italic", "value": true }}]
     }}
   }}]
-"""
\ No newline at end of file
+"""
+
+# Повторный запрос, если ответ модели не удалось разобрать как JSON
+REPAIR_JSON_RESPONSE_PROMPT = """
+Твой предыдущий ответ на задание ниже не является корректным JSON и не может быть разобран.
+
+Задание:
+---
+{original_prompt}
+---
+Твой ответ:
+---
+{bad_response}
+---
+Верни ТОЛЬКО исправленный JSON той структуры, которую требует задание, без пояснений и markdown.
+"""
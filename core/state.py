@@ -1,13 +1,30 @@
 # core/state.py
-from typing import TypedDict, List, Optional
+from typing import Annotated, TypedDict, List, Optional
+
+
+def merge_intent_results(existing: List[dict], new: Optional[List[dict]]) -> List[dict]:
+    """
+    Редьюсер результатов параллельных ветвей извлечения. Ветви добавляют по одному результату;
+    узлы, возвращающие состояние целиком, повторно передают уже собранные результаты -
+    они распознаются по позиции подзапроса и не дублируются.
+    """
+    if not new:
+        return existing or []
+    known = {result["position"] for result in existing or []}
+    return (existing or []) + [result for result in new if result["position"] not in known]
+
 
 class GraphState(TypedDict):
     """Определяет состояние, передаваемое между узлами графа."""
     original_user_query: str
     current_user_query: str
     document_content_text: str
-    document_bytes: Optional[bytes]
+    document_version: Optional[str]  # хэш версии документа в BlobStore (байты в состоянии не хранятся)
     extracted_instructions: Optional[List[dict]]
     clarification_question: Optional[str]
     system_message: Optional[str]
-    next_node_to_call: Optional[str]
\ No newline at end of file
+    next_node_to_call: Optional[str]
+    # Подзапросы составного запроса: [{"position", "category", "query"}] (None - запрос с одним намерением)
+    intents: Optional[List[dict]]
+    # Результаты параллельного извлечения по подзапросам (собираются редьюсером из всех ветвей)
+    intent_results: Annotated[List[dict], merge_intent_results]
@@ -0,0 +1,396 @@
+# core/telemetry.py
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+
+from loguru import logger
+
+# Локальная точка /metrics (формат Prometheus) и /traces (последние трассировки в JSON); 0 - отключить
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Сколько последних трассировок запросов хранится в памяти процесса
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", "50"))
+METRIC_PREFIX = "docmodifier_"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+_attrs_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    """
+    Счетчики и гистограммы процесса с выводом в текстовом формате Prometheus.
+    Метрика регистрируется при первом обновлении; метки - словарь строк.
+    """
+
+    def __init__(self, prefix: str = METRIC_PREFIX, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}  # имя -> (тип, описание)
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, List[float]]] = {}  # [счетчики корзин..., сумма, число]
+
+    @staticmethod
+    def _key(labels: Optional[Dict[str, Any]]) -> LabelKey:
+        return tuple(sorted((name, str(value)) for name, value in (labels or {}).items()))
+
+    def inc(self, name: str, value: float = 1, labels: Optional[Dict[str, Any]] = None, help: str = "") -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._help.setdefault(name, ("counter", help))
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, Any]] = None, help: str = "") -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help))
+            series = self._histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def value(self, name: str, labels: Optional[Dict[str, Any]] = None) -> float:
+        """Значение счетчика (или число наблюдений гистограммы) для меток."""
+        key = self._key(labels)
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name].get(key, 0)
+            state = self._histograms.get(name, {}).get(key)
+            return state[-1] if state else 0
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted(self._help):
+                kind, help_text = self._help[name]
+                full_name = self.prefix + name
+                if help_text:
+                    lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                if kind == "counter":
+                    for key, value in sorted(self._counters[name].items()):
+                        lines.append(f"{full_name}{_format_labels(key)} {value:g}")
+                    continue
+                for key, state in sorted(self._histograms[name].items()):
+                    for bound, count in zip(self.buckets, state):
+                        lines.append(f"{full_name}_bucket{_format_labels(key, (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{full_name}_bucket{_format_labels(key, (('le', '+Inf'),))} {state[-1]}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {state[-2]:.6f}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {state[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+_registry: Optional[MetricsRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+        return _registry
+
+
+# --- Трассировка запроса ---
+
+class Span:
+    """Отрезок трассировки: узел графа, обработчик операции, этап (разбор, сохранение) или вызов LLM."""
+
+    def __init__(self, name: str, kind: str, parent: Optional["Span"], trace_started: float):
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.started = time.perf_counter()
+        self.offset = self.started - trace_started
+        self.seconds: Optional[float] = None
+        self.attrs: Dict[str, Any] = {}
+
+    def add(self, name: str, value: float) -> None:
+        with _attrs_lock:  # отрезок могут дополнять несколько потоков (ветви графа, дублирующие запросы)
+            self.attrs[name] = self.attrs.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "kind": self.kind, "parent": self.parent.name if self.parent else None,
+                "offset_ms": round(self.offset * 1000, 1),
+                "ms": None if self.seconds is None else round(self.seconds * 1000, 1), **self.attrs}
+
+
+class RequestTrace:
+    """
+    Трассировка одного запроса пользователя: все отрезки, выполненные в его контексте
+    (в том числе в потоках и в общем цикле событий - контекст передается туда вместе с вызовом).
+    """
+
+    def __init__(self, name: str, **attrs: Any):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.seconds: Optional[float] = None
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> dict:
+        """Итоги: время по видам отрезков и суммы токенов, символов промптов и абзацев."""
+        totals: Dict[str, float] = {}
+        by_kind: Dict[str, float] = {}
+        with self._lock, _attrs_lock:
+            for span in self.spans:
+                if span.seconds is not None and span.parent is None:
+                    by_kind[span.kind] = by_kind.get(span.kind, 0) + span.seconds
+                for name, value in span.attrs.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        totals[name] = totals.get(name, 0) + value
+        return {"ms": None if self.seconds is None else round(self.seconds * 1000, 1),
+                "top_level_ms_by_kind": {kind: round(s * 1000, 1) for kind, s in by_kind.items()}, **totals}
+
+    def to_dict(self) -> dict:
+        with self._lock, _attrs_lock:
+            spans = [span.to_dict() for span in sorted(self.spans, key=lambda s: s.started)]
+        return {"id": self.id, "name": self.name, "started_at": self.started_at, **self.attrs,
+                "summary": self.summary(), "spans": spans}
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("docmodifier_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("docmodifier_span", default=None)
+_recent_traces: deque = deque(maxlen=TRACE_HISTORY)
+_recent_lock = threading.Lock()
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+def recent_traces() -> List[dict]:
+    with _recent_lock:
+        traces = list(_recent_traces)
+    return [trace.to_dict() for trace in traces]
+
+
+@contextmanager
+def trace_request(name: str, **attrs: Any) -> Iterator[RequestTrace]:
+    """Трассировка запроса: отрезки, выполненные внутри блока, попадают в возвращаемый объект."""
+    trace = RequestTrace(name, **attrs)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        trace.seconds = time.perf_counter() - trace.started
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        with _recent_lock:
+            _recent_traces.append(trace)
+        get_metrics_registry().observe("request_seconds", trace.seconds, {"request": name},
+                                       help="Время обработки запроса целиком")
+
+
+@contextmanager
+def span(name: str, kind: str = "stage") -> Iterator[Optional[Span]]:
+    """
+    Отрезок работы: время попадает в гистограмму {kind}_seconds{name} и, если идет трассировка
+    запроса, в трассировку. Можно использовать и как декоратор: @telemetry.span("docx_save").
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    current = Span(name, kind, parent, trace.started if trace else time.perf_counter())
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - current.started
+        _current_span.reset(token)
+        if trace is not None:
+            trace.add_span(current)
+        get_metrics_registry().observe(f"{kind}_seconds", current.seconds, {kind: name},
+                                       help=f"Время выполнения ({kind})")
+
+
+def _innermost(kind: str) -> Optional[Span]:
+    current = _current_span.get()
+    while current is not None and current.kind != kind:
+        current = current.parent
+    return current
+
+
+def add_paragraphs(scanned: int = 0, modified: int = 0) -> None:
+    """Учитывает просмотренные и измененные абзацы в текущем обработчике операции (или этапе)."""
+    current = _current_span.get()
+    owner = _innermost("handler") or current
+    label = {"operation": owner.name if owner else "none"}
+    registry = get_metrics_registry()
+    if scanned:
+        registry.inc("paragraphs_scanned_total", scanned, label, help="Просмотрено абзацев при поиске целей")
+    if modified:
+        registry.inc("paragraphs_modified_total", modified, label, help="Изменено, вставлено или удалено абзацев")
+    if owner is not None:
+        if scanned:
+            owner.add("paragraphs_scanned", scanned)
+        if modified:
+            owner.add("paragraphs_modified", modified)
+
+
+def _usage(response: Any) -> Tuple[int, int]:
+    usage = getattr(response, "usage_metadata", None) or {}
+    return int(usage.get("input_tokens") or 0), int(usage.get("output_tokens") or 0)
+
+
+def record_llm_call(prompt: str, response: Any = None, seconds: Optional[float] = None, outcome: str = "ok") -> None:
+    """
+    Учитывает вызов LLM в узле, из которого он сделан: число вызовов по исходу (ok, error,
+    cancelled - проигравший дублирующий запрос, cache), символы промпта, токены промпта и ответа из usage_metadata ответа модели.
+    """
+    node = _innermost("node")
+    labels = {"node": node.name if node else "none"}
+    prompt_tokens, completion_tokens = _usage(response)
+    registry = get_metrics_registry()
+    registry.inc("llm_calls_total", 1, {**labels, "outcome": outcome}, help="Вызовы LLM по исходу")
+    registry.inc("llm_prompt_chars_total", len(prompt), labels, help="Символов в промптах LLM")
+    if prompt_tokens or completion_tokens:
+        registry.inc("llm_tokens_total", prompt_tokens, {**labels, "kind": "prompt"}, help="Токены LLM по usage_metadata")
+        registry.inc("llm_tokens_total", completion_tokens, {**labels, "kind": "completion"}, help="Токены LLM по usage_metadata")
+    if seconds is not None:
+        registry.observe("llm_call_seconds", seconds, {**labels, "outcome": outcome}, help="Время одного вызова LLM")
+
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    call = Span("llm", "llm", _current_span.get(), trace.started)
+    call.offset -= seconds or 0
+    call.seconds = seconds
+    call.attrs.update({"outcome": outcome, "llm_calls": 1, "prompt_chars": len(prompt),
+                       "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+    trace.add_span(call)
+
+
+@contextmanager
+def llm_call(prompt: str) -> Iterator[Any]:
+    """Замер вызова модели: with llm_call(prompt) as call: call.response = llm.invoke(prompt)."""
+    class _Call:
+        response = None
+    call = _Call()
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        outcome = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+        record_llm_call(prompt, None, time.perf_counter() - started, outcome=outcome)
+        raise
+    record_llm_call(prompt, call.response, time.perf_counter() - started)
+
+
+def instrument_node(name: str, func: Optional[Callable]) -> Optional[Callable]:
+    """Обертка узла графа (синхронного или асинхронного): отрезок вида node с именем узла."""
+    if func is None:
+        return None
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def anode(*args, **kwargs):
+            with span(name, "node"):
+                return await func(*args, **kwargs)
+        return anode
+
+    @wraps(func)
+    def node(*args, **kwargs):
+        with span(name, "node"):
+            return func(*args, **kwargs)
+    return node
+
+
+def instrument_handler(op_type: str, handler: Callable[..., bool]) -> Callable[..., bool]:
+    """Обертка обработчика операции: время, исход (applied, not_applied, error) и счетчики абзацев."""
+    @wraps(handler)
+    def instrumented(*args, **kwargs):
+        result = "error"
+        try:
+            with span(op_type, "handler"):
+                applied = handler(*args, **kwargs)
+            result = "applied" if applied else "not_applied"
+            return applied
+        finally:
+            get_metrics_registry().inc("handler_results_total", 1, {"operation": op_type, "result": result},
+                                       help="Результаты обработчиков операций")
+    return instrumented
+
+
+# --- Локальная точка доступа ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = get_metrics_registry().render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/traces":
+            body = json.dumps(recent_traces(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"telemetry: {self.address_string()} {format % args}")
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """
+    Запускает (один раз на процесс) HTTP-сервер с /metrics и /traces в фоновом потоке.
+    None - сервер отключен (port=0) или порт занят.
+    """
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                logger.warning(f"telemetry: не удалось открыть {host}:{port} для метрик ({e}).")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            logger.info(f"telemetry: метрики доступны на http://{host}:{port}/metrics")
+        return _server
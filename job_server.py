@@ -0,0 +1,282 @@
+# job_server.py
+"""
+HTTP-сервис заданий, отдельный от Streamlit: конвейер build_graph и применение готовых инструкций
+выполняются пулом процессов (core/jobs.py), задания и их события хранятся в SQLite.
+
+Запуск из корня проекта:
+    python job_server.py
+    LLM_BACKEND=stub python job_server.py     # без сети и ключа API (см. core/llm_backends.py)
+
+Точки доступа:
+    POST /jobs                  JSON {"document": base64 .docx, "query": "..."[, "apply": false]}
+                                или {"document": ..., "instructions": [...]}; либо тело - сам .docx,
+                                а query / instructions (JSON) - параметры строки запроса.
+                                202 {"id", "status", ...}; 429, если очередь заполнена;
+                                503, если пул процессов не удалось пересоздать
+    GET  /jobs/<id>             статус, результат (инструкции, отчет по ним) или ошибка
+    GET  /jobs/<id>/events      поток событий (text/event-stream) до завершения задания;
+                                ?after=N - продолжить после события N
+    GET  /jobs/<id>/result      измененный документ (404, пока его нет)
+    GET  /health                размер пула и число заданий в работе
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import base64
+import binascii
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+from loguru import logger
+
+from core.async_runtime import available_cpus
+from core.blob_store import get_blob_store
+from core import jobs
+
+JOB_SERVER_HOST = os.getenv("JOB_SERVER_HOST", "127.0.0.1")
+JOB_SERVER_PORT = int(os.getenv("JOB_SERVER_PORT", "8600"))
+# Процессов пула (0 - по числу доступных ядер) и заданий, ожидающих сверх них
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "0")) or available_cpus()
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "16"))
+JOB_MAX_UPLOAD_BYTES = int(os.getenv("JOB_MAX_UPLOAD_MB", "50")) * 1024 * 1024
+# Как часто поток событий проверяет новые записи в хранилище
+EVENTS_POLL_SECONDS = 0.2
+# Клиенту, получившему 429, предлагается повторить не раньше чем через столько секунд
+RETRY_AFTER_SECONDS = 1
+
+DOCX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_JOB_PATH_RE = re.compile(r"^/jobs/([0-9a-f]{32})(/events|/result)?$")
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobRunner:
+    """
+    Пул процессов с ограниченной очередью: одновременно принимается не больше workers + queue_size
+    заданий, остальные отклоняются сразу (сервер отвечает 429), а не копятся в памяти.
+    Если процесс пула упал, пул становится непригодным: он пересоздается при следующей отправке.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.active = 0
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn: процессы пула создаются из многопоточного сервера, fork унаследовал бы чужие блокировки
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, job_id: str) -> None:
+        """Отправляет задание в пул; JobQueueFull - мест нет, BrokenProcessPool - пул не удалось пересоздать."""
+        with self._lock:
+            if self.active >= self.capacity:
+                raise JobQueueFull()
+            try:
+                future = self._executor.submit(jobs.run_job, job_id)
+            except BrokenProcessPool:
+                # Процесс пула упал при предыдущем задании: старый пул больше не принимает задания
+                logger.warning("job_server: пул процессов сломан, создается новый")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._new_executor()
+                self.restarts += 1
+                future = self._executor.submit(jobs.run_job, job_id)
+            self.active += 1
+        future.add_done_callback(lambda f: self._done(job_id, f))
+
+    def _done(self, job_id: str, future) -> None:
+        with self._lock:
+            self.active -= 1
+        error = future.exception()
+        if error is not None:
+            # Процесс пула упал (например, по памяти): задание не должно остаться в работе навсегда
+            logger.error(f"Задание {job_id}: процесс пула завершился с ошибкой: {error}")
+            job = jobs.get_job_store().get(job_id)
+            if job and job["status"] not in jobs.FINAL_STATUSES:
+                jobs.get_job_store().set_status(job_id, jobs.STATUS_FAILED, error=f"{type(error).__name__}: {error}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "capacity": self.capacity, "active": self.active, "restarts": self.restarts}
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor = self._executor
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_submission(content_type: str, body: bytes, query: dict) -> Tuple[str, dict, bytes]:
+    """Тип задания, параметры и байты документа из тела POST /jobs."""
+    if content_type.startswith("application/json"):
+        try:
+            payload = json.loads(body)
+            document = base64.b64decode(payload.pop("document"), validate=True)
+        except (ValueError, KeyError, TypeError, AttributeError, binascii.Error) as e:
+            raise RequestError(400, f"Ожидается JSON с документом в base64 в поле 'document': {e}")
+    else:
+        document = body
+        payload = {name: values[-1] for name, values in query.items()}
+        try:
+            if "instructions" in payload: payload["instructions"] = json.loads(payload["instructions"])
+        except ValueError as e:
+            raise RequestError(400, f"Параметр instructions должен быть JSON: {e}")
+        if "apply" in payload: payload["apply"] = payload["apply"] not in ("0", "false", "False", "")
+    if not document.startswith(b"PK"):
+        raise RequestError(400, "Документ должен быть файлом .docx")
+
+    if isinstance(payload.get("instructions"), list):
+        return jobs.KIND_INSTRUCTIONS, {"instructions": payload["instructions"]}, document
+    if isinstance(payload.get("query"), str) and payload["query"].strip():
+        return jobs.KIND_QUERY, {"query": payload["query"], "apply": bool(payload.get("apply", True))}, document
+    raise RequestError(400, "Нужен запрос 'query' (строка) или список инструкций 'instructions'")
+
+
+def job_view(job: dict) -> dict:
+    """Задание в ответе API: без внутренних версий BlobStore, со ссылками на события и результат."""
+    view = {name: job[name] for name in ("id", "kind", "status", "request", "result", "error", "created", "started", "finished")}
+    view["events_url"] = f"/jobs/{job['id']}/events"
+    view["result_url"] = f"/jobs/{job['id']}/result" if job["output_version"] else None
+    return view
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    runner: JobRunner = None  # задается при запуске сервера
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[dict] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data, headers: Optional[dict] = None) -> None:
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8", headers)
+
+    def _error(self, status: int, message: str, headers: Optional[dict] = None) -> None:
+        self._send_json(status, {"error": message}, headers)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/jobs":
+            self._error(404, "Не найдено")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > JOB_MAX_UPLOAD_BYTES:
+            self._error(413, f"Документ больше {JOB_MAX_UPLOAD_BYTES // (1024 * 1024)} МБ")
+            return
+        try:
+            kind, request, document = parse_submission(self.headers.get("Content-Type", ""), self.rfile.read(length), parse_qs(url.query))
+        except RequestError as e:
+            self._error(e.status, str(e))
+            return
+
+        # Проверка очереди до записи задания: отклоненный запрос не оставляет следов в хранилище
+        if self.runner.stats()["active"] >= self.runner.capacity:
+            self._error(429, "Очередь заданий заполнена", {"Retry-After": str(RETRY_AFTER_SECONDS)})
+            return
+        store = jobs.get_job_store()
+        job_id = store.create(kind, request, get_blob_store().put(document))
+        try:
+            self.runner.submit(job_id)
+        except JobQueueFull:
+            store.set_status(job_id, jobs.STATUS_FAILED, error="Очередь заданий заполнена")
+            self._error(429, "Очередь заданий заполнена", {"Retry-After": str(RETRY_AFTER_SECONDS)})
+            return
+        except BrokenProcessPool as e:
+            logger.error(f"job_server: задание {job_id} не отправлено в пул: {e}")
+            store.set_status(job_id, jobs.STATUS_FAILED, error=f"Пул процессов недоступен: {e}")
+            self._error(503, "Пул процессов недоступен, повторите позже", {"Retry-After": str(RETRY_AFTER_SECONDS)})
+            return
+        self._send_json(202, job_view(store.get(job_id)), {"Location": f"/jobs/{job_id}"})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            self._send_json(200, {"status": "ok", **self.runner.stats()})
+            return
+        match = _JOB_PATH_RE.match(url.path)
+        job = jobs.get_job_store().get(match.group(1)) if match else None
+        if job is None:
+            self._error(404, "Задание не найдено")
+            return
+        if match.group(2) == "/events":
+            self._stream_events(job["id"], int(parse_qs(url.query).get("after", ["0"])[-1] or 0))
+        elif match.group(2) == "/result":
+            if not job["output_version"] or not get_blob_store().exists(job["output_version"]):
+                self._error(404, "Результата нет" if job["status"] in jobs.FINAL_STATUSES else "Задание еще выполняется")
+                return
+            self._send(200, get_blob_store().read_bytes(job["output_version"]), DOCX_CONTENT_TYPE,
+                       {"Content-Disposition": f'attachment; filename="{job["id"]}.docx"'})
+        else:
+            self._send_json(200, job_view(job))
+
+    def _stream_events(self, job_id: str, after: int) -> None:
+        """События задания в формате Server-Sent Events; поток закрывается после итогового статуса."""
+        store = jobs.get_job_store()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                finished = False
+                for event in store.events(job_id, after):
+                    after = event["seq"]
+                    self.wfile.write(f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    finished = finished or (event["type"] == "status" and event["data"]["status"] in jobs.FINAL_STATUSES)
+                self.wfile.flush()
+                if finished:
+                    return
+                time.sleep(EVENTS_POLL_SECONDS)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug(f"job_server: клиент отключился от событий задания {job_id}")
+
+    def log_message(self, format, *args):
+        logger.debug(f"job_server: {self.address_string()} {format % args}")
+
+
+def create_server(host: str = JOB_SERVER_HOST, port: int = JOB_SERVER_PORT,
+                  runner: Optional[JobRunner] = None) -> ThreadingHTTPServer:
+    interrupted = jobs.get_job_store().fail_unfinished("Сервер был перезапущен до завершения задания")
+    if interrupted:
+        logger.warning(f"job_server: незавершенных заданий после перезапуска: {interrupted}")
+    handler = type("BoundJobRequestHandler", (JobRequestHandler,), {"runner": runner or JobRunner()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    server = create_server()
+    runner = server.RequestHandlerClass.runner
+    logger.info(f"job_server: http://{JOB_SERVER_HOST}:{JOB_SERVER_PORT}, процессов: {runner.workers}, "
+                f"мест в очереди: {runner.capacity - runner.workers}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        runner.shutdown()
+
+
+if __name__ == "__main__":
+    main()
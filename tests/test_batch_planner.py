@@ -0,0 +1,61 @@
+# tests/test_batch_planner.py
+"""План пакета инструкций дает тот же документ, что и последовательное применение инструкций."""
+import copy
+
+import pytest
+from docx import Document
+
+from core.batch_planner import plan_instructions
+from core.docx_modifier import apply_instruction_plan, modify_document_with_structured_instructions
+
+
+def make_document(*paragraphs: str) -> Document:
+    doc = Document()
+    for text in paragraphs:
+        doc.add_paragraph(text)
+    return doc
+
+
+def replace(old_text: str, new_text: str, text_to_find: str = None) -> dict:
+    target = {"text_to_find": text_to_find} if text_to_find else {}
+    return {"operation_type": "REPLACE_TEXT", "target_description": target,
+            "parameters": {"old_text": old_text, "new_text": new_text}}
+
+
+def texts(doc: Document) -> list:
+    return [p.text for p in doc.paragraphs]
+
+
+CHAINED_CASES = [
+    pytest.param(["alpha beta"], [replace("alpha", "beta"), replace("beta", "gamma")], id="chain"),
+    pytest.param(["alpha beta", "beta"], [replace("alpha", "beta gamma"), replace("gamma", "delta")], id="inside-new-text"),
+    pytest.param(["alpha beta"], [replace("alpha", "x"), replace("beta", "y"), replace("y", "z")], id="chain-after-independent"),
+]
+
+
+@pytest.mark.parametrize("paragraphs, instructions", CHAINED_CASES)
+def test_plan_matches_sequential_application_for_chained_replacements(paragraphs, instructions):
+    sequential = make_document(*paragraphs)
+    modify_document_with_structured_instructions(sequential, copy.deepcopy(instructions), batch_replace=False)
+
+    planned = make_document(*paragraphs)
+    plan = plan_instructions(planned, copy.deepcopy(instructions))
+    apply_instruction_plan(planned, plan)
+
+    assert texts(planned) == texts(sequential)
+
+
+def test_chained_replacements_are_split_into_separate_steps():
+    doc = make_document("alpha beta")
+    plan = plan_instructions(doc, [replace("alpha", "beta"), replace("beta", "gamma")])
+    assert plan.steps == [[0], [1]]
+    apply_instruction_plan(doc, plan)
+    assert texts(doc) == ["gamma gamma"]
+
+
+def test_independent_replacements_share_one_step():
+    doc = make_document("alpha beta")
+    plan = plan_instructions(doc, [replace("alpha", "one"), replace("beta", "two")])
+    assert plan.steps == [[0, 1]]
+    apply_instruction_plan(doc, plan)
+    assert texts(doc) == ["one two"]
@@ -0,0 +1,78 @@
+# tests/test_edit_history.py
+"""Дельты правок: состояние до правки сохраняется только у затронутых блоков, отмена и повтор восстанавливают документ."""
+import pytest
+from docx import Document
+
+from core.docx_index import DocumentIndex
+from core.docx_modifier import apply_structured_instruction, modify_document_with_structured_instructions
+from core.edit_history import DeltaRecorder, EditHistory, _serialize_block, _story_containers, apply_delta
+
+
+def make_document() -> Document:
+    doc = Document()
+    doc.sections[0].header.add_paragraph("Колонтитул Энск")
+    for i in range(30):
+        doc.add_paragraph(f"Абзац {i} в г. Энск")
+    table = doc.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Ячейка Энск"
+    table.cell(1, 1).add_paragraph("второй абзац ячейки")
+    doc.add_paragraph("Последний абзац")
+    return doc
+
+
+def blocks(doc: Document) -> dict:
+    return {name: [_serialize_block(el) for el in container] for name, container in _story_containers(doc).items()}
+
+
+INSTRUCTIONS = {
+    "replace": {"operation_type": "REPLACE_TEXT", "target_description": {},
+                "parameters": {"old_text": "Энск", "new_text": "Москва"}},
+    "insert_after": {"operation_type": "INSERT_TEXT", "target_description": {"text_to_find": "Абзац 5 в г. Энск"},
+                     "parameters": {"text_to_insert": "Новый", "position": "after_paragraph"}},
+    "insert_start": {"operation_type": "INSERT_TEXT", "target_description": {"text_to_find": "Абзац 7 в г. Энск"},
+                     "parameters": {"text_to_insert": "Начало", "position": "start_of_paragraph"}},
+    "delete": {"operation_type": "DELETE_ELEMENT", "target_description": {"text_to_find": "Абзац 3 в г. Энск", "element_type": "paragraph"},
+               "parameters": {}},
+    "delete_nested": {"operation_type": "DELETE_ELEMENT", "target_description": {"text_to_find": "второй абзац ячейки", "element_type": "paragraph"},
+                      "parameters": {}},
+    "paragraph_formatting": {"operation_type": "APPLY_PARAGRAPH_FORMATTING", "target_description": {"text_to_find": "Абзац 9"},
+                             "parameters": {"formatting_rules": [{"style": "bold", "value": True}]}},
+    "text_formatting": {"operation_type": "APPLY_TEXT_FORMATTING", "target_description": {},
+                        "parameters": {"apply_to_text_segment": "Абзац 11 ", "formatting_rules": [{"style": "italic", "value": True}]}},
+    "modify_cell": {"operation_type": "TABLE_MODIFY_CELL", "target_description": {"table_index": 0, "table_coords": {"row": 1, "col": 1}},
+                    "parameters": {"new_cell_text": "X"}},
+    "add_row": {"operation_type": "TABLE_ADD_ROW", "target_description": {"table_index": 0},
+                "parameters": {"row_data": ["a", "b"]}},
+}
+
+
+@pytest.mark.parametrize("name", list(INSTRUCTIONS))
+def test_lazy_delta_matches_full_snapshot_and_round_trips(name):
+    doc = make_document()
+    before = blocks(doc)
+    index = DocumentIndex(doc)
+    lazy, full = DeltaRecorder(doc, index), DeltaRecorder(doc)
+    assert apply_structured_instruction(doc, INSTRUCTIONS[name], index=index)
+    after = blocks(doc)
+
+    delta = lazy.finish()
+    assert delta and delta == full.finish()
+    apply_delta(doc, delta, reverse=True)
+    assert blocks(doc) == before
+    apply_delta(doc, delta)
+    assert blocks(doc) == after
+
+
+def test_change_without_will_change_clears_history():
+    doc = make_document()
+    history = EditHistory()
+    assert modify_document_with_structured_instructions(doc, [INSTRUCTIONS["replace"]], history=history)
+    assert history.can_undo
+
+    index = DocumentIndex(doc)
+    recorder = DeltaRecorder(doc, index)
+    paragraph = doc.paragraphs[0]
+    paragraph.text = "Изменен в обход will_change"
+    index.update(paragraph)
+    history.record(recorder.finish(), "обход")
+    assert not history.can_undo and not history.can_redo
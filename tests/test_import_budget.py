@@ -0,0 +1,26 @@
+# tests/test_import_budget.py
+"""
+Бюджет импорта: import core и первая отрисовка app.py не тянут модули, нужные только для запросов
+к LLM, и укладываются в пороги. Каждый замер - в новом процессе (python -X importtime), берется
+лучший из нескольких, чтобы единичная задержка диска не роняла тест.
+"""
+import pytest
+
+from benchmarks.import_budget import APP_BUDGET_MS, APP_PROBE, CORE_BUDGET_MS, CORE_PROBE, run_probe
+
+REPEAT = 3
+
+
+def best_run(code: str):
+    return min((run_probe(code) for _ in range(REPEAT)), key=lambda run: run[0])
+
+
+@pytest.mark.parametrize("code, budget_ms", [
+    pytest.param(CORE_PROBE, CORE_BUDGET_MS, id="import-core"),
+    pytest.param(APP_PROBE, APP_BUDGET_MS, id="app-first-render"),
+])
+def test_imports_fit_the_budget(code, budget_ms):
+    total_ms, top, heavy, extra = best_run(code)
+    assert heavy == [], f"Импортированы модули, нужные только для запросов: {heavy}"
+    assert not (extra and extra[0]), f"Ошибки при отрисовке: {extra[0]}"
+    assert total_ms <= budget_ms, f"Импорты заняли {total_ms:.1f} мс при пороге {budget_ms} мс; дороже всего: {top[:5]}"
@@ -0,0 +1,202 @@
+# tests/test_job_server.py
+"""HTTP-сервис заданий на модели по правилам (LLM_BACKEND=stub): прием, опрос, события, результат, очередь, падение процесса пула."""
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+import base64
+import json
+import threading
+import time
+
+import pytest
+from docx import Document
+
+import job_server
+from core import blob_store, jobs
+
+JOB_TIMEOUT_SECONDS = 90
+
+
+def make_docx(*paragraphs: str) -> bytes:
+    doc = Document()
+    for text in paragraphs:
+        doc.add_paragraph(text)
+    out = BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+DOCUMENT = make_docx("Договор поставки с ООО Ромашка.", "Поставщик: ООО Ромашка, г. Энск.")
+REPLACE_INSTRUCTIONS = [{"operation_type": "REPLACE_TEXT", "target_description": {},
+                         "parameters": {"old_text": "Ромашка", "new_text": "Лютик"}}]
+
+
+class Client:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        """(статус, заголовки, тело); ошибки HTTP возвращаются так же, а не исключением."""
+        try:
+            with urlopen(Request(self.base_url + path, body, headers or {}, method=method), timeout=JOB_TIMEOUT_SECONDS) as response:
+                return response.status, response.headers, response.read()
+        except HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def get_json(self, path: str):
+        status, _, body = self.request("GET", path)
+        return status, json.loads(body)
+
+    def submit(self, document: bytes = DOCUMENT, **payload):
+        body = json.dumps({"document": base64.b64encode(document).decode("ascii"), **payload}).encode("utf-8")
+        status, headers, body = self.request("POST", "/jobs", body, {"Content-Type": "application/json"})
+        return status, headers, json.loads(body)
+
+    def wait(self, job_id: str, statuses=jobs.FINAL_STATUSES) -> dict:
+        deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            _, job = self.get_json(f"/jobs/{job_id}")
+            if job["status"] in statuses:
+                return job
+            time.sleep(0.05)
+        raise AssertionError(f"Задание {job_id} не перешло в {statuses}: {job}")
+
+
+def start_server(tmp_path, monkeypatch, workers: int = 1, queue_size: int = 1, llm_latency_ms: int = 0):
+    # Процессы пула запускаются через spawn и читают настройки из окружения
+    monkeypatch.setenv("LLM_BACKEND", "stub")
+    monkeypatch.setenv("LLM_REPLAY_LATENCY_MS", str(llm_latency_ms))
+    monkeypatch.setenv("JOB_DB_PATH", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setenv("DOC_BLOB_DIR", str(tmp_path / "blobs"))
+    monkeypatch.setenv("METRICS_PORT", "0")
+    monkeypatch.setattr(jobs, "_default_store", jobs.JobStore(str(tmp_path / "jobs.sqlite3")))
+    monkeypatch.setattr(blob_store, "_default_store", blob_store.BlobStore(str(tmp_path / "blobs")))
+
+    runner = job_server.JobRunner(workers=workers, queue_size=queue_size)
+    server = job_server.create_server("127.0.0.1", 0, runner)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, runner, Client(f"http://127.0.0.1:{server.server_address[1]}")
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    server, runner, client = start_server(tmp_path, monkeypatch)
+    yield runner, client
+    server.shutdown()
+    server.server_close()
+    runner.shutdown()
+
+
+@pytest.fixture
+def slow_service(tmp_path, monkeypatch):
+    """Каждый ответ модели занимает 1.5 с: задания с запросом успевают постоять в очереди и в работе."""
+    server, runner, client = start_server(tmp_path, monkeypatch, llm_latency_ms=1500)
+    yield runner, client
+    server.shutdown()
+    server.server_close()
+    runner.shutdown()
+
+
+def read_events(client: Client, job_id: str, after: int = 0) -> list:
+    status, headers, body = client.request("GET", f"/jobs/{job_id}/events?after={after}")
+    assert status == 200
+    assert headers["Content-Type"].startswith("text/event-stream")
+    events = []
+    for block in body.decode("utf-8").strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append(json.loads(fields["data"]))
+    return events
+
+
+def test_instructions_job_is_submitted_polled_and_returns_the_document(service):
+    _, client = service
+    status, headers, job = client.submit(instructions=REPLACE_INSTRUCTIONS)
+    assert status == 202
+    assert headers["Location"] == f"/jobs/{job['id']}"
+    assert job["status"] == jobs.STATUS_QUEUED
+
+    job = client.wait(job["id"])
+    assert job["status"] == jobs.STATUS_DONE, job["error"]
+    assert job["result"]["applied"] is True
+    assert job["result"]["report"] == [{"operation_type": "REPLACE_TEXT", "success": True, "hits": 2}]
+
+    status, headers, body = client.request("GET", job["result_url"])
+    assert status == 200
+    assert headers["Content-Type"] == job_server.DOCX_CONTENT_TYPE
+    texts = [p.text for p in Document(BytesIO(body)).paragraphs]
+    assert texts == ["Договор поставки с ООО Лютик.", "Поставщик: ООО Лютик, г. Энск."]
+
+
+def test_query_job_uses_the_graph_and_streams_events(service):
+    _, client = service
+    query = urlencode({"query": "замени 'Энск' на 'Москва'"})
+    status, _, body = client.request("POST", f"/jobs?{query}", DOCUMENT, {"Content-Type": job_server.DOCX_CONTENT_TYPE})
+    assert status == 202
+    job = client.wait(json.loads(body)["id"])
+    assert job["status"] == jobs.STATUS_DONE, job["error"]
+    assert job["result"]["instructions"][0]["parameters"]["new_text"] == "Москва"
+
+    events = read_events(client, job["id"])
+    statuses = [event["data"]["status"] for event in events if event["type"] == "status"]
+    assert statuses == [jobs.STATUS_QUEUED, jobs.STATUS_RUNNING, jobs.STATUS_DONE]
+    assert any(event["type"] == "node" for event in events)
+    assert [event["seq"] for event in events] == list(range(1, len(events) + 1))
+    # Продолжение потока после события N
+    assert read_events(client, job["id"], after=events[-2]["seq"]) == events[-1:]
+
+
+def test_result_is_missing_for_an_unchanged_document(service):
+    _, client = service
+    _, _, job = client.submit(instructions=[{"operation_type": "REPLACE_TEXT", "target_description": {},
+                                             "parameters": {"old_text": "Нет такого текста", "new_text": "x"}}])
+    job = client.wait(job["id"])
+    assert job["status"] == jobs.STATUS_DONE
+    assert job["result"]["applied"] is False and job["result_url"] is None
+    assert client.request("GET", f"/jobs/{job['id']}/result")[0] == 404
+
+
+def test_invalid_requests_are_rejected(service):
+    _, client = service
+    assert client.submit(b"not a docx", instructions=[])[0] == 400
+    assert client.submit(query="   ")[0] == 400
+    assert client.request("POST", "/jobs", b"{", {"Content-Type": "application/json"})[0] == 400
+    assert client.request("GET", "/jobs/" + "0" * 32)[0] == 404
+    assert client.request("GET", "/unknown")[0] == 404
+
+
+def test_full_queue_returns_429(slow_service):
+    runner, client = slow_service
+    accepted = [client.submit(query="замени 'Энск' на 'Москва'") for _ in range(runner.capacity)]
+    assert [status for status, _, _ in accepted] == [202] * runner.capacity
+
+    status, headers, body = client.submit(query="замени 'Энск' на 'Москва'")
+    assert status == 429
+    assert headers["Retry-After"] == str(job_server.RETRY_AFTER_SECONDS)
+    assert "error" in body
+    assert client.get_json("/health")[1]["active"] == runner.capacity
+
+    for _, _, job in accepted:
+        assert client.wait(job["id"])["status"] == jobs.STATUS_DONE
+    assert client.get_json("/health")[1]["active"] == 0
+    assert client.submit(instructions=REPLACE_INSTRUCTIONS)[0] == 202
+
+
+def test_worker_crash_fails_the_running_job_and_the_pool_recovers(slow_service):
+    runner, client = slow_service
+    _, _, job = client.submit(query="замени 'Энск' на 'Москва'")
+    client.wait(job["id"], statuses=(jobs.STATUS_RUNNING,))
+    for process in list(runner._executor._processes.values()):
+        process.kill()
+
+    job = client.wait(job["id"])
+    assert job["status"] == jobs.STATUS_FAILED
+    assert "BrokenProcessPool" in job["error"]
+
+    # Сломанный пул заменяется при следующей отправке, а не отвечает ошибкой на каждое задание
+    status, _, job = client.submit(instructions=REPLACE_INSTRUCTIONS)
+    assert status == 202
+    assert client.wait(job["id"])["status"] == jobs.STATUS_DONE
+    health = client.get_json("/health")[1]
+    assert health["restarts"] == 1 and health["active"] == 0
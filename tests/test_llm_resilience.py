@@ -0,0 +1,279 @@
+# tests/test_llm_resilience.py
+"""Повторы, срок запроса, дублирование, исправление ответа и предохранитель на моделях без сети."""
+import asyncio
+import time
+
+import pytest
+
+from core import llm_invoker, prompts
+from core.llm_backends import FakeChatModel, ReplayChatModel, RuleBasedChatModel
+from core.llm_resilience import CircuitBreaker, CircuitOpenError, LatencyTracker, ResilientCaller
+
+
+class ScriptedChatModel(FakeChatModel):
+    """Ответы по сценарию: шаг - текст, (текст, задержка в секундах) или исключение. Последний шаг повторяется."""
+
+    def __init__(self, *steps):
+        super().__init__(model="test/scripted")
+        self.steps = list(steps)
+        self.prompts = []
+
+    def _respond(self, prompt):
+        self.prompts.append(prompt)
+        step = self.steps.pop(0) if len(self.steps) > 1 else self.steps[0]
+        if isinstance(step, BaseException):
+            raise step
+        return step if isinstance(step, tuple) else (step, 0.0)
+
+
+class ServiceUnavailable(Exception):
+    code = 503
+
+
+def make_caller(**kwargs) -> ResilientCaller:
+    options = dict(max_attempts=3, backoff_base=0.001, backoff_max=0.01, deadline_seconds=5,
+                   hedge_percentile=0, breaker=CircuitBreaker(failure_threshold=100, reset_seconds=60))
+    options.update(kwargs)
+    return ResilientCaller(**options)
+
+
+# --- Повторы ---
+
+def test_backoff_delay_is_bounded_by_exponent_and_max():
+    caller = make_caller(backoff_base=0.5, backoff_max=3)
+    for retry_number in range(6):
+        for _ in range(50):
+            assert 0 <= caller.backoff_delay(retry_number) <= min(3, 0.5 * 2 ** retry_number)
+
+
+def test_backoff_delay_honors_retry_after_up_to_max():
+    caller = make_caller(backoff_base=0.001, backoff_max=2)
+    error = ServiceUnavailable()
+    error.retry_after = 1.5
+    assert caller.backoff_delay(0, error) == 1.5
+    error.retry_after = 10
+    assert caller.backoff_delay(0, error) == 2
+
+
+def test_transient_errors_are_retried_until_success():
+    model = ScriptedChatModel(ConnectionError("обрыв"), ServiceUnavailable(), '{"ok": true}')
+    caller = make_caller()
+    assert caller.call(model.invoke, "промпт").content == '{"ok": true}'
+    assert model.calls == 3
+    assert caller.counters["retries"] == 2
+
+
+def test_retries_stop_at_max_attempts():
+    model = ScriptedChatModel(ConnectionError("обрыв"))
+    caller = make_caller(max_attempts=3)
+    with pytest.raises(ConnectionError):
+        caller.call(model.invoke, "промпт")
+    assert model.calls == 3
+
+
+def test_permanent_error_is_not_retried():
+    model = ScriptedChatModel(ValueError("неверный запрос"))
+    caller = make_caller()
+    with pytest.raises(ValueError):
+        caller.call(model.invoke, "промпт")
+    assert model.calls == 1
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_async_transient_errors_are_retried():
+    model = ScriptedChatModel(TimeoutError("медленно"), '{"ok": true}')
+    caller = make_caller()
+    assert asyncio.run(caller.acall(model.ainvoke, "промпт")).content == '{"ok": true}'
+    assert model.calls == 2
+
+
+# --- Срок запроса ---
+
+def test_deadline_bounds_a_slow_call():
+    model = ScriptedChatModel(("{}", 2.0))
+    caller = make_caller(max_attempts=1)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        caller.call(model.invoke, "промпт", deadline=time.monotonic() + 0.1)
+    assert time.monotonic() - started < 1.0
+    assert caller.counters["timeouts"] == 1
+
+
+def test_async_deadline_bounds_a_slow_call():
+    model = ScriptedChatModel(("{}", 2.0))
+    caller = make_caller(max_attempts=1)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(caller.acall(model.ainvoke, "промпт", deadline=time.monotonic() + 0.1))
+    assert time.monotonic() - started < 1.0
+
+
+def test_expired_deadline_does_not_call_the_model():
+    model = ScriptedChatModel("{}")
+    caller = make_caller()
+    with pytest.raises(TimeoutError):
+        caller.call(model.invoke, "промпт", deadline=time.monotonic() - 1)
+    assert model.calls == 0
+
+
+# --- Дублирующий запрос ---
+
+def warmed_latency(seconds: float = 0.01, samples: int = 5) -> LatencyTracker:
+    latency = LatencyTracker(window=50, min_samples=samples)
+    for _ in range(samples):
+        latency.record(seconds)
+    return latency
+
+
+def test_slow_call_is_hedged_and_the_hedge_wins():
+    model = ScriptedChatModel(('"медленный"', 1.0), '"быстрый"')
+    caller = make_caller(hedge_percentile=95, latency=warmed_latency())
+    assert caller.call(model.invoke, "промпт").content == '"быстрый"'
+    assert caller.counters["hedges"] == 1
+    assert caller.counters["hedge_wins"] == 1
+
+
+def test_async_hedge_respects_hedge_allowed():
+    caller = make_caller(hedge_percentile=95, latency=warmed_latency())
+    model = ScriptedChatModel(('"медленный"', 0.3), '"быстрый"')
+    result = asyncio.run(caller.acall(model.ainvoke, "промпт", hedge_allowed=lambda: True))
+    assert result.content == '"быстрый"'
+    assert caller.counters["hedge_wins"] == 1
+
+    model = ScriptedChatModel(('"медленный"', 0.3), '"быстрый"')
+    result = asyncio.run(caller.acall(model.ainvoke, "промпт", hedge_allowed=lambda: False))
+    assert result.content == '"медленный"'
+    assert model.calls == 1
+
+
+def test_no_hedge_without_enough_latency_samples():
+    model = ScriptedChatModel(('"медленный"', 0.2), '"быстрый"')
+    caller = make_caller(hedge_percentile=95, latency=LatencyTracker(window=50, min_samples=5))
+    assert caller.call(model.invoke, "промпт").content == '"медленный"'
+    assert caller.counters["hedges"] == 0
+
+
+# --- Исправление неразбираемого ответа ---
+
+@pytest.fixture
+def llm_backend():
+    """Подменяет модель llm_invoker на время теста."""
+    previous = llm_invoker.set_llm_backend(None)
+    yield lambda model: llm_invoker.set_llm_backend(model)
+    llm_invoker.set_llm_backend(previous)
+
+
+def test_unparsable_response_is_repaired(llm_backend):
+    model = ScriptedChatModel("Вот ответ без JSON", '{"category": "REPLACE_TEXT"}')
+    llm_backend(model)
+    assert llm_invoker.invoke_gemini_json_mode("Исходный промпт", use_cache=False) == {"category": "REPLACE_TEXT"}
+    assert model.calls == 2
+    repair_prompt = model.prompts[1]
+    assert repair_prompt.strip().startswith(prompts.REPAIR_JSON_RESPONSE_PROMPT.strip().split("\n")[0])
+    assert "Исходный промпт" in repair_prompt and "Вот ответ без JSON" in repair_prompt
+
+
+def test_repair_is_not_requested_for_a_parsed_response(llm_backend):
+    model = RuleBasedChatModel()
+    llm_backend(model)
+    prompt = prompts.CATEGORIZE_REQUEST_PROMPT.format(doc_text_snippet="Текст", user_query="замени 'А' на 'Б'")
+    response = llm_invoker.invoke_gemini_json_mode(prompt, use_cache=False)
+    assert response["category"] == "REPLACE_TEXT"
+    assert model.calls == 1
+
+
+# --- Предохранитель ---
+
+def open_breaker(caller: ResilientCaller) -> None:
+    model = ScriptedChatModel(ConnectionError("обрыв"))
+    for _ in range(caller.breaker.failure_threshold):
+        with pytest.raises(ConnectionError):
+            caller.call(model.invoke, "промпт")
+    assert caller.breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_opens_and_rejects_without_calling_the_model():
+    caller = make_caller(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=60))
+    open_breaker(caller)
+    model = ScriptedChatModel("{}")
+    with pytest.raises(CircuitOpenError):
+        caller.call(model.invoke, "промпт")
+    assert model.calls == 0
+    assert caller.counters["rejected"] == 1
+
+
+def test_successful_probe_closes_the_breaker():
+    caller = make_caller(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+    assert caller.call(ScriptedChatModel("{}").invoke, "промпт").content == "{}"
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_the_breaker():
+    caller = make_caller(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+    with pytest.raises(ConnectionError):
+        caller.call(ScriptedChatModel(ConnectionError("обрыв")).invoke, "промпт")
+    assert caller.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        caller.call(ScriptedChatModel("{}").invoke, "промпт")
+
+
+def test_only_one_probe_while_half_open():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_permanent_error_during_probe_releases_the_breaker():
+    caller = make_caller(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+    with pytest.raises(ValueError):
+        caller.call(ScriptedChatModel(ValueError("неверный запрос")).invoke, "промпт")
+    assert caller.breaker.state != CircuitBreaker.HALF_OPEN
+    # Следующий вызов становится пробой сразу, не дожидаясь reset_seconds
+    assert caller.call(ScriptedChatModel("{}").invoke, "промпт").content == "{}"
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_missing_replay_fixture_during_probe_releases_the_breaker(tmp_path):
+    caller = make_caller(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+    replay = ReplayChatModel(str(tmp_path / "fixtures.jsonl"))
+    with pytest.raises(LookupError):
+        asyncio.run(caller.acall(replay.ainvoke, "промпт без записи"))
+    assert caller.breaker.allow()
+
+
+def test_cancelled_probe_releases_the_breaker():
+    caller = make_caller(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(caller.acall(ScriptedChatModel(("{}", 5.0)).ainvoke, "промпт"))
+        await asyncio.sleep(0.02)
+        assert caller.breaker.state == CircuitBreaker.HALF_OPEN
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert caller.breaker.allow()
+
+
+def test_unreported_probe_is_replaced_after_reset():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()  # проба, о которой так и не сообщили
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()